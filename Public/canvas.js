@@ -0,0 +1,197 @@
+let currentTool = 'brush'; // Initially set the current tool to brush
+updateToolButtonStyles();
+
+function selectTool(tool) {
+    currentTool = tool;
+    if (tool === 'eraser') {
+        ctx.globalCompositeOperation = 'destination-out';
+        ctx.lineWidth = 20; // Eraser size
+    } else {
+        ctx.globalCompositeOperation = 'source-over';
+        ctx.strokeStyle = currentColor; // Use the selected color
+        ctx.lineWidth = document.getElementById('strokeSizeSlider').value; // Use the slider value
+    }
+    updateToolButtonStyles(); // Update button styles based on the selected tool
+}
+
+function updateToolButtonStyles() {
+    // Remove active class from all buttons
+    document.getElementById('brushButton').classList.remove('active-tool');
+    document.getElementById('eraserButton').classList.remove('active-tool');
+    document.getElementById('backButton').classList.remove('active-tool');
+
+    // Add active class to the current tool button
+    if (currentTool === 'brush') {
+        document.getElementById('brushButton').classList.add('active-tool');
+    } else if (currentTool === 'eraser') {
+        document.getElementById('eraserButton').classList.add('active-tool');
+    }
+}
+
+function undoLastAction() {
+    if (undoLastStroke()) {
+        document.getElementById('backButton').classList.add('active-tool');
+        setTimeout(() => {
+            document.getElementById('backButton').classList.remove('active-tool');
+        }, 500); // Remove the active class after 500 ms
+    }
+}
+
+// Bind tool buttons
+document.getElementById('brushButton').addEventListener('click', () => selectTool('brush'));
+document.getElementById('eraserButton').addEventListener('click', () => selectTool('eraser'));
+document.getElementById('backButton').addEventListener('click', undoLastAction);
+
+
+const canvas = document.getElementById('drawingCanvas');
+const ctx = canvas.getContext('2d');
+let painting = false;
+// Undo history: per stroke, the rectangle it painted over as it was before
+// the stroke ({x, y, pixels}), not a snapshot of the whole canvas. Past
+// UNDO_MEMORY_LIMIT bytes the oldest steps are forgotten.
+const UNDO_MEMORY_LIMIT = 32 * 1024 * 1024;
+let undoStack = [];
+let undoBytes = 0;
+// The canvas as it was when the current stroke started, copied on the GPU
+// without reading the pixels back
+const strokeStartCanvas = document.createElement('canvas');
+strokeStartCanvas.width = canvas.width;
+strokeStartCanvas.height = canvas.height;
+const strokeStartCtx = strokeStartCanvas.getContext('2d');
+// The strokes that made the drawing, sent instead of its pixels:
+// {color, width, points: [x0, y0, x1, y1, ...], erase}. Once a picture is
+// drawn onto the canvas the strokes no longer describe it.
+let strokes = [];
+let currentStroke = null;
+let canvasHasImage = false;
+
+// Save the current state of the canvas, before a stroke
+function saveCanvasState() {
+    strokeStartCtx.clearRect(0, 0, canvas.width, canvas.height);
+    strokeStartCtx.drawImage(canvas, 0, 0);
+}
+
+// Keep what the finished stroke painted over, from the saved state
+function pushUndoStep(stroke) {
+    const margin = stroke.width / 2 + 2;  // the round caps and antialiasing
+    let left = Infinity, top = Infinity, right = -Infinity, bottom = -Infinity;
+    for (let i = 0; i < stroke.points.length; i += 2) {
+        left = Math.min(left, stroke.points[i]);
+        right = Math.max(right, stroke.points[i]);
+        top = Math.min(top, stroke.points[i + 1]);
+        bottom = Math.max(bottom, stroke.points[i + 1]);
+    }
+    const x = Math.max(0, Math.floor(left - margin));
+    const y = Math.max(0, Math.floor(top - margin));
+    const width = Math.max(1, Math.min(canvas.width, Math.ceil(right + margin)) - x);
+    const height = Math.max(1, Math.min(canvas.height, Math.ceil(bottom + margin)) - y);
+    const step = { x: x, y: y, pixels: strokeStartCtx.getImageData(x, y, width, height), canvas: null };
+    undoStack.push(step);
+    undoBytes += undoStepBytes(step);
+    while (undoBytes > UNDO_MEMORY_LIMIT && undoStack.length > 1) {
+        undoBytes -= undoStepBytes(undoStack.shift());
+    }
+}
+
+function undoStepBytes(step) {
+    return step.pixels.data.length + (step.canvas ? step.canvas.data.length : 0);
+}
+
+// Called before anything other than a stroke changes the canvas: undoing
+// the last stroke then puts the whole canvas back as it was, as well
+function saveCanvasBeforeChange() {
+    const last = undoStack[undoStack.length - 1];
+    if (last && !last.canvas) {
+        last.canvas = ctx.getImageData(0, 0, canvas.width, canvas.height);
+        undoBytes += last.canvas.data.length;
+    }
+}
+
+// Put back the canvas as it was before the last stroke
+function undoLastStroke() {
+    if (undoStack.length === 0) {
+        return false;
+    }
+    const step = undoStack.pop();
+    undoBytes -= undoStepBytes(step);
+    if (step.canvas) {
+        ctx.putImageData(step.canvas, 0, 0);
+    }
+    ctx.putImageData(step.pixels, step.x, step.y);
+    strokes.pop();
+    return true;
+}
+
+// Draw on the canvas
+function draw(event) {
+    if (!painting) return;
+    ctx.lineWidth = document.getElementById('strokeSizeSlider').value;
+    ctx.lineCap = 'round';
+    ctx.lineTo(event.offsetX, event.offsetY);
+    ctx.stroke();
+    currentStroke.points.push(event.offsetX, event.offsetY);
+    ctx.beginPath();
+    ctx.moveTo(event.offsetX, event.offsetY);
+}
+
+// Start painting with mouse down
+function startPainting(event) {
+    painting = true;
+    currentStroke = {
+        color: ctx.strokeStyle,
+        width: Number(document.getElementById('strokeSizeSlider').value),
+        points: [],
+        erase: ctx.globalCompositeOperation === 'destination-out'
+    };
+    strokes.push(currentStroke);
+    saveCanvasState();
+    draw(event);
+}
+
+// Stop painting
+function stopPainting() {
+    painting = false;
+    if (currentStroke) {
+        pushUndoStep(currentStroke);
+    }
+    currentStroke = null;
+    ctx.beginPath();
+}
+
+// Undo the last action
+function undoLastAction() {
+    undoLastStroke();
+}
+
+// Set the tool used for drawing
+function selectTool(tool) {
+    if (tool === 'eraser') {
+        ctx.globalCompositeOperation = 'destination-out';
+        ctx.lineWidth = 20;  // Make the eraser bigger
+    } else {
+        ctx.globalCompositeOperation = 'source-over';
+        ctx.strokeStyle = document.getElementById('currentColor').value;
+    }
+}
+
+// Event listeners for canvas interactions
+canvas.addEventListener('mousedown', startPainting);
+canvas.addEventListener('mousemove', draw);
+canvas.addEventListener('mouseup', stopPainting);
+canvas.addEventListener('mouseout', stopPainting);
+
+// Change color
+function changeColor(color) {
+    ctx.strokeStyle = color;
+    document.getElementById('currentColor').value = color;
+}
+
+// Buttons for tool selection
+document.getElementById('brushButton').addEventListener('click', function() { selectTool('brush'); });
+document.getElementById('eraserButton').addEventListener('click', function() { selectTool('eraser'); });
+document.getElementById('backButton').addEventListener('click', undoLastAction);
+
+// Set initial color
+let currentColor = '#000000'; // Default black
+ctx.strokeStyle = currentColor;
+ctx.lineWidth = 5;
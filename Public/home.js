@@ -0,0 +1,370 @@
+function sendResponse() {
+    const response = document.getElementById('response').value;
+    document.getElementById('response').value = ''; // Clear the response box
+    if (!window.ReadableStream || !window.TextDecoder) {
+        return sendResponseWithoutStreaming(response);
+    }
+    // Once the server has sent 'meta' it has recorded the answer, so if the
+    // stream fails after that the question is asked for again without it
+    let started = false, finished = false;
+    function retry(error) {
+        console.error('Error:', error);
+        if (!finished) {
+            finished = true;
+            sendResponseWithoutStreaming(response, started);
+        }
+    }
+    fetch('/api/question/stream', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({'response': response})
+    })
+    .then(res => {
+        if (!res.ok) {
+            throw new Error(`HTTP ${res.status}`);
+        }
+        return readEvents(res, (event, data) => {
+            const question = document.getElementById('question');
+            if (event === 'meta') {
+                started = true;
+                question.textContent = '';
+                document.querySelector('progress').value = data.progress;
+            } else if (event === 'token') {
+                question.textContent += data.text;
+            } else if (event === 'done') {
+                finished = true;
+                question.textContent = data.question;
+                showReflectionIfDone(data);
+            } else if (event === 'error') {
+                retry(data.error);
+            }
+        });
+    })
+    .then(() => {
+        if (!finished) {
+            retry('The question stream ended early');
+        }
+    })
+    .catch(retry);
+    return false;
+}
+
+// Parse a text/event-stream response body, calling onEvent(event, data) per event
+function readEvents(res, onEvent) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    function pump() {
+        return reader.read().then(({done, value}) => {
+            if (done) return;
+            buffer += decoder.decode(value, {stream: true});
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = 'message', data = '';
+                block.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                onEvent(event, JSON.parse(data));
+            }
+            return pump();
+        });
+    }
+    return pump();
+}
+
+// With retry, asks again for the question of the turn a failed stream began
+function sendResponseWithoutStreaming(response, retry) {
+    fetch('/api/question', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(retry ? {'response': response, 'retry': true} : {'response': response})
+    })
+    .then(response => response.json())
+    .then(data => {
+        document.getElementById('question').textContent = data.question;
+        document.querySelector('progress').value = data.progress;
+        showReflectionIfDone(data);
+    })
+    .catch(error => console.error('Error:', error));
+    return false;
+}
+
+function showReflectionIfDone(data) {
+    if (data.progress === 100) {
+        // Show the reflection area when the last question is reached
+        //document.getElementById('reflectionContainer').style.display = 'block';
+        document.getElementById('reflectionContainer').innerHTML = `<div class="responses">${data.responses}</div>`;
+    }
+}
+
+
+function viewReflection() {
+    document.getElementById('reflectionContainer').scrollIntoView({ behavior: 'smooth' });
+}
+
+
+function updateProgressBar() {
+    var currentQuestionNumber = session['question_number'] - 1;  // Assumes this variable is updated correctly from server
+    var progressPercent = currentQuestionNumber * 20;  // Assuming there are 5 questions
+    document.querySelector('progress').value = progressPercent;
+}
+
+
+
+// What the spinner says while a drawing job is in each stage
+const JOB_STAGE_TEXT = {
+    'queued': 'Waiting for a free painter...',
+    'running': 'Getting started...',
+    'colors': 'Looking at your colors...',
+    'generating': 'Painting your pictures and thinking of some advice...',
+    'images': 'Your advice is ready, finishing the pictures...',
+    'reappraisal': 'Your pictures are ready, finishing the advice...'
+};
+const JOB_POLL_INTERVAL = 500;
+
+function generateImage(event) {
+    event.preventDefault();  // Prevent the form from submitting traditionally
+
+    const canvas = document.getElementById('drawingCanvas');
+    const description = document.getElementById('description').value;
+
+    document.getElementById('loadingText').textContent = 'Loading...';
+    document.getElementById('loading').style.display = 'block'; // Show loading indicator
+
+    drawingUpload(canvas, description, document.getElementById('freshImages').checked).then(upload => {
+        function processInOneRequest() {
+            return fetch('/api/process-drawing', { method: 'POST', ...upload }).then(res => res.json().then(data => {
+                if (!res.ok) {
+                    throw new Error(data.error);
+                }
+                return data;
+            }));
+        }
+        // Where the server keeps jobs, start a background job and poll it. If
+        // it isn't queued, or the job is lost (the poll reached another
+        // instance, or the one that had it was stopped), wait on the whole
+        // generation in one request instead.
+        const processed = canvas.dataset.jobs !== '1' ? processInOneRequest() :
+            fetch('/api/process-drawing/jobs', { method: 'POST', ...upload })
+            .then(res => {
+                if (res.status !== 202) {
+                    return processInOneRequest();
+                }
+                return res.json().then(job => pollDrawingJob(job.status_url).catch(error => {
+                    if (error.jobLost) {
+                        return processInOneRequest();
+                    }
+                    throw error;
+                }));
+            });
+        processed
+        .then(showDrawingResult)
+        .catch(error => {
+            console.error('Error:', error);
+            document.getElementById('loading').style.display = 'none'; // Hide loading indicator if there is an error
+        });
+    });
+
+    return false;
+}
+
+// The request body and headers for a drawing: its strokes as JSON, a few
+// KB the server measures colors from without pixels, or once a picture has
+// been put on the canvas, a palette-indexed PNG in a multipart form
+function drawingUpload(canvas, description, fresh) {
+    if (!canvasHasImage) {
+        return Promise.resolve({
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                canvas: [canvas.width, canvas.height],
+                strokes: strokes,
+                description: description,
+                fresh: fresh
+            })
+        });
+    }
+    return drawingPng(canvas).then(blob => {
+        const form = new FormData();
+        form.append('drawing', blob, 'drawing.png');
+        form.append('description', description);
+        form.append('fresh', fresh ? '1' : '');
+        return { body: form };
+    });
+}
+
+function drawingPng(canvas) {
+    if (typeof CompressionStream === 'undefined' || !canvas.dataset.palette) {
+        return new Promise(resolve => canvas.toBlob(resolve, 'image/png'));
+    }
+    return indexedPng(canvas);
+}
+
+// The canvas as a palette-indexed PNG, one byte a pixel instead of four.
+// Pixels are snapped here to the nearest of the colors the server measures
+// drawings against (the canvas's data-palette), so all the server has to do
+// is count indices. Index 0 is transparent.
+function indexedPng(canvas) {
+    const palette = canvas.dataset.palette.split(' ').map(hex => parseInt(hex, 16));
+    const width = canvas.width;
+    const height = canvas.height;
+    const rgba = canvas.getContext('2d').getImageData(0, 0, width, height).data;
+    const rows = new Uint8Array((width + 1) * height);  // each row starts with filter type 0, none
+    const nearest = new Map();
+    let o = 0;
+    for (let i = 0; i < rgba.length; i += 4) {
+        if (i % (width * 4) === 0) {
+            rows[o++] = 0;
+        }
+        if (rgba[i + 3] === 0) {
+            rows[o++] = 0;
+            continue;
+        }
+        const rgb = (rgba[i] << 16) | (rgba[i + 1] << 8) | rgba[i + 2];
+        let index = nearest.get(rgb);
+        if (index === undefined) {
+            index = nearestPaletteIndex(palette, rgba[i], rgba[i + 1], rgba[i + 2]) + 1;
+            nearest.set(rgb, index);
+        }
+        rows[o++] = index;
+    }
+
+    const header = new Uint8Array(13);
+    new DataView(header.buffer).setUint32(0, width);
+    new DataView(header.buffer).setUint32(4, height);
+    header.set([8, 3, 0, 0, 0], 8);  // 8 bit, palette-indexed
+    const colors = new Uint8Array(3 * (palette.length + 1));
+    palette.forEach((rgb, i) => colors.set([rgb >> 16, (rgb >> 8) & 255, rgb & 255], 3 * (i + 1)));
+
+    const deflated = new Blob([rows]).stream().pipeThrough(new CompressionStream('deflate'));
+    return new Response(deflated).arrayBuffer().then(data => new Blob([
+        new Uint8Array([137, 80, 78, 71, 13, 10, 26, 10]),
+        pngChunk('IHDR', header),
+        pngChunk('PLTE', colors),
+        pngChunk('tRNS', new Uint8Array([0])),  // entries past the first are opaque
+        pngChunk('IDAT', new Uint8Array(data)),
+        pngChunk('IEND', new Uint8Array(0))
+    ], { type: 'image/png' }));
+}
+
+function nearestPaletteIndex(palette, r, g, b) {
+    let best = 0;
+    let bestDistance = Infinity;
+    palette.forEach((rgb, i) => {
+        const dr = (rgb >> 16) - r;
+        const dg = ((rgb >> 8) & 255) - g;
+        const db = (rgb & 255) - b;
+        const distance = dr * dr + dg * dg + db * db;
+        if (distance < bestDistance) {
+            best = i;
+            bestDistance = distance;
+        }
+    });
+    return best;
+}
+
+const CRC_TABLE = Array.from({ length: 256 }, (_, n) => {
+    let c = n;
+    for (let k = 0; k < 8; k++) {
+        c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+    }
+    return c >>> 0;
+});
+
+function pngChunk(type, data) {
+    const chunk = new Uint8Array(12 + data.length);
+    const view = new DataView(chunk.buffer);
+    view.setUint32(0, data.length);
+    for (let i = 0; i < 4; i++) {
+        chunk[4 + i] = type.charCodeAt(i);
+    }
+    chunk.set(data, 8);
+    let crc = 0xffffffff;
+    for (let i = 4; i < 8 + data.length; i++) {
+        crc = CRC_TABLE[(crc ^ chunk[i]) & 255] ^ (crc >>> 8);
+    }
+    view.setUint32(8 + data.length, (crc ^ 0xffffffff) >>> 0);
+    return chunk;
+}
+
+function pollDrawingJob(statusUrl) {
+    return new Promise((resolve, reject) => {
+        function poll() {
+            fetch(statusUrl)
+            .then(res => {
+                if (res.status === 404) {
+                    const error = new Error('Unknown or expired job');
+                    error.jobLost = true;
+                    throw error;
+                }
+                return res.json();
+            })
+            .then(job => {
+                if (job.status === 'done') {
+                    resolve(job.result);
+                } else if (job.status === 'failed' || job.error) {
+                    reject(new Error(job.error));
+                } else {
+                    document.getElementById('loadingText').textContent = JOB_STAGE_TEXT[job.stage] || 'Loading...';
+                    setTimeout(poll, JOB_POLL_INTERVAL);
+                }
+            })
+            .catch(reject);
+        }
+        poll();
+    });
+}
+
+function showDrawingResult(data) {
+    const imagesContainer = document.getElementById('images');
+    data.image_urls.forEach(url => {
+        const img = new Image();
+        img.onload = function() {
+            imagesContainer.insertBefore(img, imagesContainer.firstChild); // Insert new images at the top
+        };
+        img.onclick = function() {
+            replaceCanvas(url); // the canvas loads the full-size original
+            // and the chosen picture goes into the reflection
+            fetch('/api/reflection/image', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ url: url })
+            });
+        };
+        img.src = '/proxy?url=' + encodeURIComponent(url) + '&w=256'; // a 256px thumbnail, WebP where the browser takes it
+        img.width = 256;
+        img.height = 256;
+    });
+
+    // Display reappraisal text
+    let reappraisalText = data.reappraisal_text;
+    if (data.retry) {
+        reappraisalText += ' (The pictures are taking a while. Press Generate to try again!)';
+    }
+    document.getElementById('reappraisalText').textContent = reappraisalText;
+    document.getElementById('loading').style.display = 'none'; // Hide loading indicator
+}
+
+
+function replaceCanvas(imgSrc) {
+    const canvas = document.getElementById('drawingCanvas');
+    const ctx = canvas.getContext('2d');
+    const img = new Image();
+    img.crossOrigin = "anonymous";  // Set cross-origin to anonymous
+    img.onload = function() {
+        saveCanvasBeforeChange();
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
+        canvasHasImage = true;
+    };
+    img.onerror = function() {
+        alert('What do you think about this image?');
+    };
+    img.src = '/proxy?url=' + encodeURIComponent(imgSrc);
+
+    // After setting the new image, allow the canvas to be used for new drawings or image generations
+    painting = false;  // Reset painting state if needed
+    ctx.beginPath();  // Clear any existing drawing paths
+}
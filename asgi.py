@@ -0,0 +1,450 @@
+"""ASGI entry point: uvicorn asgi:app
+
+/api/question, /api/process-drawing and /proxy spend nearly all their time
+waiting on OpenAI, so here they are served natively on the event loop with
+aiohttp instead of holding a worker thread each. Every other route (pages,
+assets, the SSE stream, stats) is handed to the Flask app in a thread. Both
+sides share the session store, the caches and the question pool in index.
+"""
+import asyncio
+import contextvars
+import io
+import json
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import openai
+from werkzeug.exceptions import HTTPException, InternalServerError
+
+import index
+import metrics
+import upstream
+from assets import compress_response
+from cache import AsyncSingleFlight
+from keypool import KeysExhausted
+from resilience import CircuitOpen
+
+flask_app = index.app
+
+# Upstream connections kept open by the event loop, shared by every request
+ASYNC_UPSTREAM_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_CONNECTIONS', 100))
+
+# Threads running the Flask routes, color analysis and session stores
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+generation_flights = AsyncSingleFlight(max_waiters=index.GENERATION_MAX_WAITERS)
+proxy_fetches = AsyncSingleFlight()
+
+_client = None
+
+
+def client():
+    global _client
+    if _client is None or _client.closed:
+        # Every response is shown to the OpenAI key pools, as index's
+        # requests session does
+        observer = aiohttp.TraceConfig()
+        observer.on_request_end.append(observe_response)
+        _client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_UPSTREAM_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(sock_connect=upstream.CONNECT_TIMEOUT, sock_read=upstream.READ_TIMEOUT),
+            trace_configs=[observer],
+        )
+    return _client
+
+
+async def observe_response(session, context, params):
+    index.observe_openai_response(str(params.url), params.headers.get('Authorization'),
+                                  params.response.status, params.response.headers)
+
+
+def backoff_delay(retry_number, retry_after=None):
+    # Same schedule as upstream.make_retry()
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return upstream.BACKOFF_FACTOR * 2 ** (retry_number - 1) + random.uniform(0, upstream.BACKOFF_JITTER)
+
+
+async def fetch(method, url, **kwargs):
+    # Returns (status, headers, body), retrying connection errors and
+    # 429/5xx answers like the requests session in upstream does
+    for retry_number in range(upstream.MAX_RETRIES + 1):
+        last = retry_number == upstream.MAX_RETRIES
+        try:
+            async with client().request(method, url, **kwargs) as response:
+                body = await response.read()
+        except aiohttp.ClientConnectorError:
+            if last:
+                raise
+            await asyncio.sleep(backoff_delay(retry_number + 1))
+            continue
+        if response.status in upstream.RETRY_STATUSES and not last:
+            await asyncio.sleep(backoff_delay(retry_number + 1, response.headers.get('Retry-After')))
+            continue
+        return response.status, response.headers, body
+
+
+async def create_completion(guard, **kwargs):
+    # Hedged and behind the operation's circuit breaker, like index's
+    return await guard.acall(lambda: create_completion_attempt(**kwargs))
+
+
+async def create_completion_attempt(**kwargs):
+    # openai's async client doesn't retry, so do it here. Each try takes a
+    # key of its own, so a rate-limited key isn't tried again.
+    openai.aiosession.set(client())
+    tokens = index.completion_tokens(kwargs)
+    for retry_number in range(upstream.MAX_RETRIES + 1):
+        try:
+            async with index.completion_keys.alease(tokens) as api_key:
+                with metrics.timed('completion'):
+                    return await openai.Completion.acreate(api_key=api_key, **kwargs)
+        except openai.error.OpenAIError as e:
+            retryable = isinstance(e, openai.error.APIConnectionError) or e.http_status in upstream.RETRY_STATUSES
+            if not retryable or retry_number == upstream.MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(retry_number + 1, (e.headers or {}).get('retry-after')))
+
+
+async def next_question(question_number, session_history, context_state):
+    if index.opening_questions.size and index.is_opening_question(question_number, session_history):
+        return index.opening_questions.take()
+    if not 1 <= question_number <= 6:
+        return "Do you want to restart the session?"
+    prompt_text = index.build_question_prompt(question_number, session_history, context_state)
+    try:
+        response = await create_completion(index.upstream_guards['questions'],
+                                           **index.question_completion_args(prompt_text))
+    except (CircuitOpen, KeysExhausted):
+        return index.fallback_question(question_number)
+    return f"{index.question_prefix(question_number)}{response.choices[0].text.strip()}"
+
+
+async def generate_reappraisal_text(description):
+    try:
+        response = await create_completion(index.upstream_guards['reappraisal'],
+                                           **index.reappraisal_completion_args(description))
+        return index.reappraisal_text_from(response)
+    except CircuitOpen:
+        return index.REAPPRAISAL_FAILED_TEXTS[2]
+    except Exception as e:
+        print(f"Error generating reappraisal text: {str(e)}")
+        return index.REAPPRAISAL_FAILED_TEXTS[1]
+
+
+class UpstreamStatusError(Exception):
+    # An API call answered with an error status
+    def __init__(self, status, message):
+        super().__init__(f"Upstream answered {status}: {message}")
+        self.status = status
+
+
+async def call_dalle_api(prompt, n=2):
+    async def attempt():
+        async with index.image_keys.alease() as api_key:
+            url, headers, payload = index.dalle_request(prompt, n, api_key)
+            status, _, body = await fetch('POST', url, json=payload, headers=headers)
+        if status >= 400:
+            raise UpstreamStatusError(status, body[:200].decode(errors='replace'))
+        return json.loads(body)
+
+    try:
+        with metrics.timed('dalle'):
+            return index.dalle_image_urls(await index.upstream_guards['dalle'].acall(attempt))
+    except (UpstreamStatusError, aiohttp.ClientError, asyncio.TimeoutError, ValueError, CircuitOpen,
+            KeysExhausted) as e:
+        print(f"Error from OpenAI API: {e}")
+        return []
+
+
+async def cached_generation(key, fresh, generate, is_usable):
+    # index.cached_generation for coroutines
+    if not fresh:
+        value = index.response_cache.get(key)
+        if value is not None:
+            return value
+
+    async def generate_and_store():
+        value = await generate()
+        if is_usable(value):
+            index.response_cache.set(key, value)
+        return value
+
+    return await generation_flights.do(key, generate_and_store)
+
+
+async def fetch_proxied_image(image_url):
+    entry = index.proxy_cache.get(image_url)
+    if entry is not None:
+        return entry
+
+    async def fetch_image():
+        with metrics.timed('proxy_fetch'):
+            status, headers, body = await fetch('GET', image_url)
+        if status >= 400:
+            raise index.ProxyFetchError(status)
+        fetched = index.make_proxy_entry(body, headers.get('Content-Type'))
+        index.proxy_cache.set(image_url, fetched)
+        return fetched
+
+    return await proxy_fetches.do(image_url, fetch_image)
+
+
+async def fetch_proxy_variant(image_url, width, fmt):
+    key = (image_url, width, fmt)
+    entry = index.proxy_cache.get(key)
+    if entry is not None:
+        return entry
+
+    async def transcode():
+        original = await fetch_proxied_image(image_url)
+        content = await run_in_thread(index.transcode_image, original['content'], width, fmt)
+        variant = index.make_proxy_entry(content, index.PROXY_FORMATS[fmt][1])
+        index.proxy_cache.set(key, variant)
+        return variant
+
+    return await proxy_fetches.do(key, transcode)
+
+
+async def run_in_thread(fn, *args):
+    # In the default executor, keeping the request's context (and timings)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, fn, *args)
+
+
+def json_response(data, status=200):
+    response = flask_app.json.response(data)
+    response.status_code = status
+    return response
+
+
+async def api_question(request, session):
+    data = request.json
+    question_number, history, restart, progress = index.question_turn(session, data)
+    question_text = await next_question(question_number, history, index.session_context_state(session))
+    index.add_question(session, question_text)
+    return json_response({'question': question_text, 'progress': progress, 'restart': restart})
+
+
+async def api_process_drawing(request, session):
+    try:
+        # Parsing, decoding and color analysis are CPU work, keep them off the loop
+        data = await run_in_thread(index.read_drawing, request)
+        text_description = data['description']
+        used_colors_names = await run_in_thread(index.drawing_colors, data)
+
+        prompt = index.generate_prompt(text_description, used_colors_names)
+        print(f"Generated prompt for DALL-E: {prompt}")
+
+        # Still-running generations are left to finish and fill the cache
+        fresh = data['fresh']
+        description_key, colors_key = index.prompt_cache_key(text_description, used_colors_names)
+        images_task = asyncio.ensure_future(cached_generation(
+            ('images', description_key, colors_key), fresh, lambda: call_dalle_api(prompt, n=2), bool
+        ))
+        text_task = asyncio.ensure_future(cached_generation(
+            ('reappraisal', description_key), fresh, lambda: generate_reappraisal_text(text_description),
+            lambda text: text not in index.REAPPRAISAL_FAILED_TEXTS
+        ))
+        await asyncio.wait([images_task, text_task], timeout=index.PROCESS_DRAWING_DEADLINE)
+
+        image_urls = images_task.result() if images_task.done() else []
+        reappraisal_text = text_task.result() if text_task.done() else None
+        result = index.drawing_result(image_urls, reappraisal_text)
+        index.record_drawing_result(session, result)
+        return json_response(result)
+    except index.DrawingRejected as e:
+        return json_response({'error': str(e)}, e.status_code)
+    except Exception as e:
+        print(f"Error processing drawing: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+
+
+async def proxy_image(request, session):
+    image_url = request.args.get('url')
+    if not image_url:
+        return json_response({'error': 'Missing url parameter'}, 400)
+    try:
+        width, fmt, negotiated = index.proxy_variant(request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    try:
+        if fmt is None:
+            entry = await fetch_proxied_image(image_url)
+        else:
+            entry = await fetch_proxy_variant(image_url, width, fmt)
+    except (index.ProxyFetchError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error proxying image: {str(e)}")
+        return json_response({'error': str(e)}, 502)
+    except (OSError, index.Image.DecompressionBombError) as e:
+        print(f"Error transcoding image: {str(e)}")
+        return json_response({'error': 'Upstream content is not a readable image'}, 502)
+    response = index.proxy_response(entry, request)
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+
+ROUTES = {
+    ('POST', '/api/question'): api_question,
+    ('POST', '/api/process-drawing'): api_process_drawing,
+    ('GET', '/proxy'): proxy_image,
+}
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(receive, limit=None):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if limit is not None and size > limit:
+            raise BodyTooLarge()
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_response(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.to_wsgi_list()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def read_request_body(scope, receive, send):
+    # Bodies over MAX_CONTENT_LENGTH are refused, from the Content-Length
+    # header when there is one, and answered here; returns None then
+    limit = flask_app.config['MAX_CONTENT_LENGTH']
+    length = dict(scope['headers']).get(b'content-length')
+    try:
+        if limit is not None and length is not None and int(length) > limit:
+            raise BodyTooLarge()
+        return await read_body(receive, limit)
+    except BodyTooLarge:
+        await send_response(send, json_response({'error': f"Request is larger than {limit} bytes"}, 413))
+        return None
+
+
+async def serve_native(handler, scope, receive, send):
+    body = await read_request_body(scope, receive, send)
+    if body is None:
+        return
+    started = metrics.start_request()
+    environ = wsgi_environ(scope, body)
+    request = flask_app.request_class(environ)
+    interface = flask_app.session_interface
+    # A server-side store may read and write disk (sqlite), off the loop
+    session = await run_in_thread(interface.open_session, flask_app, request)
+    if session is None:
+        session = interface.make_null_session(flask_app)
+    try:
+        index.merge_finished_streams_into(session)
+        response = await handler(request, session)
+        if not interface.is_null_session(session):
+            await run_in_thread(interface.save_session, flask_app, session, response)
+    except HTTPException as e:
+        # e.g. a body that isn't JSON: 400, as Flask would answer
+        response = e.get_response(environ)
+    except Exception:
+        flask_app.logger.exception(f"Exception on {request.path} [{request.method}]")
+        response = InternalServerError().get_response(environ)
+    metrics.finish_request(started, request.path, request.method, response.status_code, response.headers)
+    await send_response(send, compress_response(response, request.accept_encodings))
+
+
+async def serve_flask(scope, receive, send):
+    # The WSGI app runs in a thread; its body is pulled chunk by chunk so
+    # streamed responses still go out as they are produced. Every step runs
+    # in the same context, as stream_with_context needs.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    body = await read_request_body(scope, receive, send)
+    if body is None:
+        return
+    environ = wsgi_environ(scope, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    iterable = await loop.run_in_executor(None, context.run, flask_app, environ, start_response)
+    chunks = iter(iterable)
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while True:
+            chunk = await loop.run_in_executor(None, context.run, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(None, context.run, iterable.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASGI_THREADS))
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is not None:
+        await serve_native(handler, scope, receive, send)
+    else:
+        await serve_flask(scope, receive, send)
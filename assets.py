@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static files are served under a name containing a hash of their contents,
+# so browsers may cache them forever: a changed file gets a new URL.
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Types worth compressing. Pages and API responses are compressed per
+# response, static text files once per encoding, when it is first asked for
+# (not at startup: each cold start would pay for every file and encoding).
+DYNAMIC_COMPRESS_TYPES = {'text/html', 'application/json'}
+STATIC_COMPRESS_TYPES = {'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+MIN_COMPRESS_BYTES = 500
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encodings):
+    for encoding in available_encodings():
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6)
+
+
+def compress_response(response, accept_encodings):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in DYNAMIC_COMPRESS_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_COMPRESS_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class AssetManifest:
+    def __init__(self, directory, url_prefix='/assets/'):
+        self.urls = {}
+        self.files = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            stem, ext = os.path.splitext(name)
+            fingerprinted = f"{stem}.{digest}{ext}"
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if mimetype in STATIC_COMPRESS_TYPES:
+                # Small text files: kept in memory in each encoding once sent
+                variants = {None: data}
+            else:
+                variants = None
+            self.files[fingerprinted] = {'path': path, 'mimetype': mimetype, 'etag': digest, 'variants': variants}
+            self.urls[name] = url_prefix + fingerprinted
+
+    def url(self, name):
+        return self.urls[name]
+
+    def response(self, fingerprinted, request):
+        asset = self.files.get(fingerprinted)
+        if asset is None:
+            return None
+        if asset['variants'] is None:
+            # Images are streamed from disk; send_file handles If-None-Match
+            response = send_file(asset['path'], mimetype=asset['mimetype'], etag=asset['etag'])
+        else:
+            encoding = choose_encoding(request.accept_encodings)
+            variants = asset['variants']
+            if encoding not in variants:
+                # Two first requests may both compress; either result is kept
+                variants[encoding] = compress(variants[None], encoding, static=True)
+            response = Response(variants[encoding], mimetype=asset['mimetype'])
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            response.set_etag(f"{asset['etag']}-{encoding}" if encoding else asset['etag'])
+            response = response.make_conditional(request)
+        response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+        return response
@@ -0,0 +1,264 @@
+"""Batch entry point: python batch.py INPUT --out results.jsonl
+
+Runs saved drawings through the same pipeline as /api/process-drawing:
+color extraction, generate_prompt, DALL-E and the reappraisal text. Nothing
+is cached, so each item gets a fresh generation.
+
+INPUT is either a directory of PNGs, each with its description in a .txt
+file of the same name, or a JSONL manifest with one item per line:
+
+    {"id": "s01", "drawing": "drawings/s01.png", "description": "..."}
+    {"id": "s02", "canvas": [500, 330], "strokes": [...], "description": "..."}
+
+Drawing paths are relative to the manifest. Items without an id are known
+by their line number.
+
+Items run --concurrency at a time. OpenAI calls are paced to
+--images-per-minute and --completions-per-minute in all, and spread over
+the keys in OPENAI_API_KEYS as the app spreads them. A 429 pauses every
+worker for as long as it asks, and the item is retried; so does a call held
+back because every key is still benched by one. Results are appended to
+--out as they finish, one JSON object per line, so the output file is also
+the checkpoint: running the same command again skips the items already done
+and retries the failed ones. Throughput is reported at the end.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+# The batch serves no pages: don't pre-generate opening questions
+os.environ.setdefault('QUESTION_POOL_SIZE', '0')
+
+import openai  # noqa: E402
+
+import index  # noqa: E402
+import metrics  # noqa: E402
+import upstream  # noqa: E402
+from keypool import KeysExhausted  # noqa: E402
+
+
+class RateLimited(Exception):
+    # upstream is False when our own key pool held the call back: no call
+    # was made, so waiting it out doesn't use up a retry
+    def __init__(self, retry_after, upstream=True):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.upstream = upstream
+
+
+class RateLimiter:
+    # Spaces calls out to at most per_minute, across threads. pause() holds
+    # every caller back, for when upstream answers 429.
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.waited += start - now
+            time.sleep(start - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def retry_after_seconds(value, default=10):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def generate_images(prompt, n, limiter):
+    limiter.acquire()
+    try:
+        with index.image_keys.lease() as api_key, metrics.timed('dalle'):
+            url, headers, payload = index.dalle_request(prompt, n, api_key)
+            response = upstream.session.post(url, json=payload, headers=headers, timeout=upstream.TIMEOUT)
+    except KeysExhausted as e:
+        # Every key is benched by an earlier 429: wait as that 429 asked
+        raise RateLimited(e.retry_after, upstream=False)
+    if response.status_code == 429:
+        raise RateLimited(retry_after_seconds(response.headers.get('Retry-After')))
+    response.raise_for_status()
+    return index.dalle_image_urls(response.json())
+
+
+def generate_reappraisal_text(description, limiter):
+    limiter.acquire()
+    try:
+        with metrics.timed('completion'):
+            response = index.create_completion(index.reappraisal_completion_args(description))
+    except openai.error.RateLimitError as e:
+        raise RateLimited(retry_after_seconds((e.headers or {}).get('retry-after')))
+    except KeysExhausted as e:
+        raise RateLimited(e.retry_after, upstream=False)
+    return index.reappraisal_text_from(response)
+
+
+def with_retries(call, limiter, retries):
+    retried = 0
+    while True:
+        try:
+            return call()
+        except RateLimited as e:
+            if e.upstream:
+                if retried == retries:
+                    raise
+                retried += 1
+            limiter.pause(e.retry_after)
+            print(f"{e}, pausing", file=sys.stderr)
+
+
+def read_items(path):
+    # (id, item) pairs, item being a manifest line with 'drawing' made absolute
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() != '.png':
+                continue
+            description_path = os.path.join(path, stem + '.txt')
+            description = None
+            if os.path.exists(description_path):
+                with open(description_path, encoding='utf-8') as f:
+                    description = f.read().strip()
+            yield stem, {'drawing': os.path.join(path, name), 'description': description}
+        return
+
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item.get('drawing'), str):
+                item['drawing'] = os.path.join(base, item['drawing'])
+            yield str(item.get('id', line_number)), item
+
+
+def drawing_data(item):
+    # The item in the form read_drawing() returns
+    if not item.get('description'):
+        raise index.DrawingRejected("Missing description")
+    if 'strokes' in item:
+        strokes, size = index.read_strokes(item['strokes'], item.get('canvas'))
+        return {'drawing': None, 'strokes': strokes, 'size': size, 'description': item['description']}
+    if not item.get('drawing'):
+        raise index.DrawingRejected("Missing drawing")
+    with open(item['drawing'], 'rb') as f:
+        png = BytesIO(f.read())
+    index.open_drawing(png)
+    png.seek(0)
+    return {'drawing': png, 'description': item['description']}
+
+
+def process_item(item_id, item, args, limiters, upstream_executor):
+    started = time.monotonic()
+    data = drawing_data(item)
+    colors = index.drawing_colors(data)
+    prompt = index.generate_prompt(data['description'], colors)
+
+    images = upstream_executor.submit(with_retries, lambda: generate_images(prompt, args.images, limiters['images']),
+                                      limiters['images'], args.retries)
+    text = with_retries(lambda: generate_reappraisal_text(data['description'], limiters['completions']),
+                        limiters['completions'], args.retries)
+    image_urls = images.result()
+
+    if not image_urls or text in index.REAPPRAISAL_FAILED_TEXTS:
+        raise RuntimeError("No images returned from DALL-E" if not image_urls else text)
+    return {
+        'id': item_id,
+        'status': 'ok',
+        'description': data['description'],
+        'colors': colors,
+        'prompt': prompt,
+        'image_urls': image_urls,
+        'reappraisal_text': text,
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+def finished_ids(out_path):
+    # Items with an 'ok' result in an earlier run's output
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a line cut short when the last run was stopped
+            if result.get('status') == 'ok':
+                done.add(result['id'])
+    return done
+
+
+def run(args):
+    done = finished_ids(args.out)
+    items = [(item_id, item) for item_id, item in read_items(args.input) if item_id not in done]
+    limiters = {'images': RateLimiter(args.images_per_minute),
+                'completions': RateLimiter(args.completions_per_minute)}
+    counts = {'ok': 0, 'failed': 0}
+    print(f"{len(items)} items to process, {len(done)} already done", file=sys.stderr)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as upstream_executor, \
+            open(args.out, 'a+', encoding='utf-8') as out:
+        out.seek(0, os.SEEK_END)
+        if out.tell():
+            # Don't append to a line cut short when the last run was stopped
+            out.seek(out.tell() - 1)
+            if out.read(1) != '\n':
+                out.write('\n')
+        futures = {executor.submit(process_item, item_id, item, args, limiters, upstream_executor): item_id
+                   for item_id, item in items}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'id': futures[future], 'status': 'failed', 'error': str(e)}
+            counts[result['status']] += 1
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    elapsed = time.monotonic() - started
+
+    processed = counts['ok'] + counts['failed']
+    per_minute = processed / elapsed * 60 if elapsed else 0
+    print(f"{counts['ok']} ok, {counts['failed']} failed in {elapsed:.1f}s: {per_minute:.1f} items/min "
+          f"(waited {limiters['images'].waited:.1f}s for image and "
+          f"{limiters['completions'].waited:.1f}s for completion rate limits)", file=sys.stderr)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="directory of PNG + .txt pairs, or a JSONL manifest")
+    parser.add_argument('--out', required=True, help="JSONL file the results are appended to")
+    parser.add_argument('--concurrency', type=int, default=4, help="items processed at the same time")
+    parser.add_argument('--images', type=int, default=2, help="images generated per drawing")
+    parser.add_argument('--images-per-minute', type=float, default=50, help="0 for no limit")
+    parser.add_argument('--completions-per-minute', type=float, default=500, help="0 for no limit")
+    parser.add_argument('--retries', type=int, default=3, help="retries of a rate-limited call")
+    args = parser.parse_args()
+    if not index.OPENAI_API_KEYS:
+        parser.error("Neither OPENAI_API_KEYS nor OPENAI_API_KEY is set")
+    counts = run(args)
+    sys.exit(1 if counts['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Cold start: how long `import index` takes and how long the first request
+to each route takes after it, the way a serverless function (vercel.json
+sends everything to index.py) pays for them on a new instance.
+
+Every measurement is a new interpreter. The fake OpenAI server
+(benchmarks/fake_openai.py) stands in for the API, answering at once. The
+median of --runs is reported per route, with the second request for
+comparison and the heavy libraries that were loaded by the time the first
+request was answered.
+
+With --budget-ms, exits 1 if the median import time is over budget, and
+with --route-budget-ms if a route's median import plus first request is
+over its budget, so a cold start regression fails the run.
+
+Run from the repository root:
+
+    python benchmarks/bench_cold_start.py [--runs 7] [--budget-ms 400] \
+        [--route-budget-ms 600] [--route-budget-ms process-drawing=900]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('openai', 'aiohttp', 'requests', 'PIL.Image')
+RESULT_PREFIX = 'cold start result: '
+STROKES = {'canvas': [500, 330], 'description': 'a storm cloud',
+           'strokes': [{'color': '#0057e7', 'width': 20, 'points': [10, 10, 200, 150, 300, 40]}]}
+
+# name: (method, path, request keyword arguments); the path may be a
+# function of the imported index module
+ROUTES = {
+    'home': ('GET', '/', {}),
+    'asset': ('GET', lambda index: index.assets.url('home.js'), {'headers': {'Accept-Encoding': 'br, gzip'}}),
+    'reflection': ('GET', '/reflection', {}),
+    'question': ('POST', '/api/question', {'json': {'response': 'happy'}}),
+    'process-drawing': ('POST', '/api/process-drawing', {'json': STROKES}),
+    'proxy': ('GET', lambda index: f"/proxy?url={os.environ['FAKE_OPENAI_URL']}/images/cold.png&w=256", {}),
+    'metrics': ('GET', '/metrics', {}),
+}
+
+
+def child(route):
+    # Runs in the new interpreter: import, then two requests through WSGI
+    sys.path.insert(0, ROOT)
+    from werkzeug.test import EnvironBuilder
+
+    started = time.perf_counter()
+    import index
+    imported = time.perf_counter()
+
+    method, path, kwargs = ROUTES[route]
+    if callable(path):
+        path = path(index)
+
+    def request():
+        builder = EnvironBuilder(path=path, method=method, **kwargs)
+        environ = builder.get_environ()
+        builder.close()
+        statuses = []
+        start = time.perf_counter()
+        body = b''.join(index.app(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+        return time.perf_counter() - start, statuses[0], len(body)
+
+    first, status, _ = request()
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    second, _, _ = request()
+    # Prefixed: the app's background threads print too
+    sys.stdout.write(RESULT_PREFIX + json.dumps({'import': imported - started, 'first': first, 'second': second,
+                                                 'status': status, 'loaded': loaded}) + '\n')
+
+
+def measure(route, fake_url):
+    # VERCEL=1 as on the platform, where the question pool isn't filled at startup
+    env = dict(os.environ, OPENAI_API_KEY='fake', OPENAI_API_BASE=f'{fake_url}/v1', FAKE_OPENAI_URL=fake_url,
+               VERCEL='1')
+    env.pop('OPENAI_API_KEYS', None)
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', route], env=env, cwd=ROOT,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output[output.index(RESULT_PREFIX) + len(RESULT_PREFIX):].splitlines()[0])
+
+
+def start_fake(port):
+    # Only imported here: the child interpreters must not load aiohttp
+    from load_async import check_running
+
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_openai.py'),
+                                '--port', str(port), '--latency', '0', '--download-latency', 'fixed:0'])
+    for _ in range(100):
+        check_running([process])
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/stats').close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("fake OpenAI server didn't start")
+
+
+def route_budgets(values):
+    # --route-budget-ms values, 'MS' for every route or 'ROUTE=MS' for one:
+    # {route: ms}
+    budgets = {}
+    for value in values:
+        route, _, ms = value.rpartition('=')
+        for name in [route] if route else ROUTES:
+            if name not in ROUTES:
+                raise SystemExit(f"no route {name!r}, one of {', '.join(ROUTES)}")
+            budgets[name] = float(ms)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=None, help="fail if the median import takes longer")
+    parser.add_argument('--route-budget-ms', action='append', default=[], metavar='[ROUTE=]MS',
+                        help="fail if a route's median import plus first request takes longer; "
+                             "repeat with ROUTE= for a route's own budget")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    # Only imported here: the child interpreters must not load aiohttp
+    from load_async import check_running, free_port
+
+    budgets = route_budgets(args.route_budget_ms)
+    port = free_port()
+    fake_url = f'http://127.0.0.1:{port}'
+    process = start_fake(port)
+    imports = []
+    over = []
+    try:
+        print(f"median of {args.runs} new interpreters per route")
+        print(f"{'route':<16} {'status':<7} {'import ms':>9} {'first ms':>9} {'second ms':>10}  loaded by the first request")
+        for route in ROUTES:
+            results = [measure(route, fake_url) for _ in range(args.runs)]
+            imports += [result['import'] for result in results]
+            cold = statistics.median(r['import'] + r['first'] for r in results) * 1000
+            if route in budgets and cold > budgets[route]:
+                over.append(f"{route}: import + first request {cold:.0f} ms, over its {budgets[route]:.0f} ms budget")
+            print(f"{route:<16} {results[0]['status'].split()[0]:<7} "
+                  f"{statistics.median(r['import'] for r in results) * 1000:>9.0f} "
+                  f"{statistics.median(r['first'] for r in results) * 1000:>9.1f} "
+                  f"{statistics.median(r['second'] for r in results) * 1000:>10.1f}  "
+                  f"{', '.join(results[0]['loaded']) or '-'}")
+        # The fake must have served the whole run, not died part way
+        check_running([process])
+    finally:
+        process.terminate()
+        process.wait()
+
+    median_import = statistics.median(imports) * 1000
+    print(f"\nimport index: {median_import:.0f} ms median over {len(imports)} starts")
+    if args.budget_ms is not None and median_import > args.budget_ms:
+        over.insert(0, f"import index over the {args.budget_ms:.0f} ms budget")
+    if over:
+        print('\n'.join(over), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
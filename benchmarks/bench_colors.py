@@ -0,0 +1,61 @@
+"""Color extraction: set comprehension over getdata() vs ColorAnalyzer.
+
+Run from the repository root:
+
+    python benchmarks/bench_colors.py
+"""
+import os
+import random
+import sys
+import timeit
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from colors import ColorAnalyzer  # noqa: E402
+from index import BRUSH_COLORS  # noqa: E402
+
+CANVAS_SIZE = (500, 330)
+SCALES = (1, 4, 16)  # multiples of the canvas pixel count
+STROKES = 40
+
+
+def make_drawing(scale, seed=0):
+    # Draw at 4x and downsample so stroke edges are antialiased like the
+    # browser canvas output.
+    factor = scale ** 0.5
+    width, height = int(CANVAS_SIZE[0] * factor), int(CANVAS_SIZE[1] * factor)
+    big = Image.new('RGBA', (width * 4, height * 4), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(big)
+    rng = random.Random(seed)
+    colors = list(BRUSH_COLORS)
+    for _ in range(STROKES):
+        color = colors[rng.randrange(len(colors))]
+        points = [(rng.randrange(big.width), rng.randrange(big.height)) for _ in range(6)]
+        draw.line(points, fill=color, width=int(20 * 4 * factor), joint='curve')
+    return big.resize((width, height), Image.LANCZOS)
+
+
+def legacy(image):
+    raw_colors = {(r, g, b) for r, g, b, a in image.getdata() if a > 0}
+    raw_colors_hex = {f"#{r:02x}{g:02x}{b:02x}" for r, g, b in raw_colors}
+    return [BRUSH_COLORS[hex_color] for hex_color in raw_colors_hex if hex_color in BRUSH_COLORS]
+
+
+def main():
+    print(f"{'scale':>6} {'pixels':>10} {'legacy ms':>10} {'analyzer ms':>12} {'speedup':>8}")
+    for scale in SCALES:
+        image = make_drawing(scale)
+        analyzer = ColorAnalyzer(BRUSH_COLORS)
+        number = max(1, 10 // scale)
+        legacy_ms = min(timeit.repeat(lambda: legacy(image), number=number, repeat=3)) / number * 1000
+        new_ms = min(timeit.repeat(lambda: analyzer.coverage(image), number=number, repeat=3)) / number * 1000
+        print(f"{scale:>5}x {image.width * image.height:>10} {legacy_ms:>10.1f} {new_ms:>12.1f} "
+              f"{legacy_ms / new_ms:>7.1f}x")
+        print(f"        legacy colors:   {sorted(legacy(image))}")
+        print(f"        analyzer ranked: {analyzer.ranked_names(image)}")
+
+
+if __name__ == '__main__':
+    main()
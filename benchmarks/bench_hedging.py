@@ -0,0 +1,109 @@
+"""Tail latency of reappraisal completions with and without hedging, and
+what the circuit breaker serves during an outage.
+
+Starts the fake OpenAI server (benchmarks/fake_openai.py) with a heavy-tailed
+completion latency, then makes CALLS calls to index.generate_reappraisal_text
+from THREADS threads: first with hedging off, then on (after a warmup that
+fills the latency window). Reports p50/p95/p99, the share of calls hedged
+and the extra upstream requests. Then upstream fails every call, and the
+breaker's fallbacks are timed.
+
+Run from the repository root:
+
+    python benchmarks/bench_hedging.py [--completion-latency lognormal:0.3:0.8]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_PORT = 8767
+CALLS = 400
+THREADS = 16
+
+# The key's token budget would otherwise throttle the run (and hedges use
+# it twice as fast): this measures hedging alone
+os.environ.update(OPENAI_API_KEY='fake', OPENAI_API_BASE=f'http://127.0.0.1:{FAKE_PORT}/v1',
+                  QUESTION_POOL_SIZE='0', UPSTREAM_MAX_RETRIES='0',
+                  OPENAI_KEY_REQUESTS_PER_MINUTE='1000000', OPENAI_KEY_TOKENS_PER_MINUTE='100000000')
+sys.path.insert(0, ROOT)
+
+import index  # noqa: E402
+from resilience import Guard  # noqa: E402
+
+
+def start_fake(latency, error_rate=0.0):
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_openai.py'),
+                                '--port', str(FAKE_PORT), '--completion-latency', latency,
+                                '--error-rate', str(error_rate)])
+    for _ in range(100):
+        try:
+            return process, fake_calls()
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("fake OpenAI server didn't start")
+
+
+def fake_calls():
+    with urllib.request.urlopen(f'http://127.0.0.1:{FAKE_PORT}/stats') as response:
+        return json.load(response).get('completions', 0)
+
+
+def run_calls(count):
+    def one(i):
+        start = time.perf_counter()
+        text = index.generate_reappraisal_text(f'a storm cloud {i}')
+        return time.perf_counter() - start, text
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        return list(executor.map(one, range(count)))
+
+
+def report(name, results, guard, upstream_calls):
+    seconds = [s for s, _ in results]
+    cuts = statistics.quantiles(seconds, n=100)
+    print(f"{name:<14} {statistics.median(seconds) * 1000:>8.0f} {cuts[94] * 1000:>8.0f} {cuts[98] * 1000:>8.0f} "
+          f"{guard.hedged / max(1, guard.calls):>10.1%} {upstream_calls / len(results) - 1:>11.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--completion-latency', default='lognormal:0.3:0.8')
+    args = parser.parse_args()
+
+    process, _ = start_fake(args.completion_latency)
+    try:
+        print(f"{CALLS} calls from {THREADS} threads, completion latency {args.completion_latency}")
+        print(f"{'':<14} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'hedged':>10} {'extra reqs':>11}")
+        for hedge in (False, True):
+            guard = index.upstream_guards['reappraisal'] = Guard('reappraisal', index.hedge_executor, hedge=hedge)
+            run_calls(guard.min_samples * 2)
+            guard.calls = guard.hedged = 0
+            before = fake_calls()
+            results = run_calls(CALLS)
+            report('hedged' if hedge else 'not hedged', results, guard, fake_calls() - before)
+    finally:
+        process.terminate()
+        process.wait()
+
+    process, _ = start_fake('fixed:0.2', error_rate=1.0)
+    try:
+        guard = index.upstream_guards['reappraisal'] = Guard('reappraisal', index.hedge_executor, cooldown=60)
+        results = run_calls(100)
+        fallbacks = [s for s, text in results if text == index.REAPPRAISAL_FAILED_TEXTS[2]]
+        print(f"\nupstream down: {len(results) - len(fallbacks)} calls reached it before the breaker opened, "
+              f"{len(fallbacks)} got the fallback in {statistics.median(fallbacks) * 1e6:.0f} us (median); "
+              f"breaker {guard.stats()['state']}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""RGBA vs palette-indexed PNG uploads: payload bytes, and the server's time
+from the PNG to the ranked colors (drawing_colors: decode plus analysis).
+
+The RGBA PNG is what canvas.toBlob() sends. The indexed PNG is what the page
+sends now: the same pixels snapped to color_analyzer.palette, index 0
+transparent. Drawings are antialiased freehand strokes on their own, and
+the same strokes over a picture, as when a generated image has been put on
+the canvas (the only time the page uploads pixels rather than strokes).
+
+Run from the repository root:
+
+    python benchmarks/bench_indexed_png.py
+"""
+import os
+import statistics
+import sys
+import time
+from io import BytesIO
+
+os.environ.setdefault('QUESTION_POOL_SIZE', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+import index  # noqa: E402
+from bench_strokes import CANVAS_SIZE, freehand_strokes, png_for  # noqa: E402
+
+STROKE_COUNTS = (10, 50, 200)
+DRAWINGS = 10
+RUNS = 20
+
+
+def picture():
+    # A stand-in for a generated image: smooth gradients and detail
+    fractal = Image.effect_mandelbrot(CANVAS_SIZE, (-2, -1.2, 1, 1.2), 60)
+    gradient = Image.linear_gradient('L').resize(CANVAS_SIZE)
+    return Image.merge('RGB', (fractal, fractal.rotate(180), gradient)).convert('RGBA')
+
+
+def indexed_png(rgba):
+    # Like the page's indexedPng(): nearest palette color, shifted one up so
+    # index 0 can be transparent
+    palette = index.color_analyzer.palette
+    snapped = rgba.convert('RGB').quantize(palette=index.color_analyzer._palette_image, dither=Image.Dither.NONE)
+    indices = Image.frombytes('L', rgba.size, snapped.tobytes()).point(lambda i: i + 1)
+    indices.paste(0, mask=rgba.getchannel('A').point(lambda a: 255 if a == 0 else 0))
+    image = Image.frombytes('P', rgba.size, indices.tobytes())
+    image.putpalette([0, 0, 0] + [channel for rgb in palette for channel in rgb])
+    buffer = BytesIO()
+    image.save(buffer, format='PNG', transparency=0)
+    return buffer.getvalue()
+
+
+def colors_ms(png):
+    samples = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        colors = index.drawing_colors({'drawing': BytesIO(png)})
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), colors
+
+
+def main():
+    background = picture()
+    print(f"{DRAWINGS} drawings per row, median of {RUNS} runs each")
+    print(f"{'drawing':<18} {'rgba bytes':>10} {'indexed':>8} {'rgba ms':>8} {'indexed ms':>10} {'same colors':>12}")
+    for on_picture in (False, True):
+        for count in STROKE_COUNTS:
+            sizes = {'rgba': [], 'indexed': []}
+            times = {'rgba': [], 'indexed': []}
+            same = 0
+            for seed in range(DRAWINGS):
+                rgba = Image.open(BytesIO(png_for(freehand_strokes(count, seed))))
+                if on_picture:
+                    rgba = Image.alpha_composite(background, rgba)
+                buffer = BytesIO()
+                rgba.save(buffer, format='PNG')
+                pngs = {'rgba': buffer.getvalue(), 'indexed': indexed_png(rgba)}
+                ranked = {}
+                for name, png in pngs.items():
+                    ms, ranked[name] = colors_ms(png)
+                    sizes[name].append(len(png))
+                    times[name].append(ms)
+                same += ranked['rgba'] == ranked['indexed']
+            label = f"{count} strokes" + (" + picture" if on_picture else "")
+            print(f"{label:<18} {statistics.median(sizes['rgba']):>10.0f} {statistics.median(sizes['indexed']):>8.0f} "
+                  f"{statistics.median(times['rgba']):>8.2f} {statistics.median(times['indexed']):>10.2f} "
+                  f"{same:>9}/{DRAWINGS}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Completions spread over one API key vs several, when each key is rate
+limited.
+
+Starts the fake OpenAI server (benchmarks/fake_openai.py) allowing each key
+KEY_RPM calls a minute, then calls index.generate_reappraisal_text
+ARRIVALS_PER_SECOND times a second for SECONDS seconds, a classroom's worth
+of demand, with 1 key and then with 3. The pools start from the default limits (far above KEY_RPM), so
+they have to learn the real ones from the x-ratelimit-* headers. Reports
+throughput, the calls that got an answer vs a canned fallback, the 429s
+upstream sent, and each key's calls and utilization.
+
+Run from the repository root:
+
+    python benchmarks/bench_keypool.py
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_PORT = 8768
+ARRIVALS_PER_SECOND = 3
+SECONDS = 60
+THREADS = 32
+KEY_RPM = 60
+
+os.environ.update(OPENAI_API_KEY='sk-fake', OPENAI_API_BASE=f'http://127.0.0.1:{FAKE_PORT}/v1',
+                  QUESTION_POOL_SIZE='0', UPSTREAM_MAX_RETRIES='0', UPSTREAM_HEDGE='0')
+sys.path.insert(0, ROOT)
+
+import index  # noqa: E402
+from keypool import KeyPool  # noqa: E402
+from resilience import Guard  # noqa: E402
+
+
+def fake_stats():
+    with urllib.request.urlopen(f'http://127.0.0.1:{FAKE_PORT}/stats') as response:
+        return json.load(response)
+
+
+def start_fake():
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_openai.py'),
+                                '--port', str(FAKE_PORT), '--completion-latency', 'fixed:0.2',
+                                '--key-requests-per-minute', str(KEY_RPM)])
+    for _ in range(100):
+        try:
+            fake_stats()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("fake OpenAI server didn't start")
+
+
+def run(key_count):
+    # Keys the fake server hasn't seen yet, with full buckets
+    api_keys = [f'sk-fake-{key_count}-{number:04d}' for number in range(key_count)]
+    index.completion_keys = KeyPool('completions', api_keys, requests_per_minute=3500,
+                                    tokens_per_minute=90000, max_wait=index.OPENAI_KEY_MAX_WAIT)
+    index.upstream_guards['reappraisal'] = Guard('reappraisal', index.hedge_executor, hedge=False)
+    before = fake_stats().get('rate_limited', 0)
+    calls = ARRIVALS_PER_SECOND * SECONDS
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        futures = []
+        for i in range(calls):
+            time.sleep(max(0.0, start + i / ARRIVALS_PER_SECOND - time.perf_counter()))
+            futures.append(executor.submit(index.generate_reappraisal_text, f'a storm cloud {i}'))
+        texts = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    answered = sum(text not in index.REAPPRAISAL_FAILED_TEXTS for text in texts)
+    stats = index.completion_keys.stats()
+    print(f"{key_count} key{'s' if key_count > 1 else ''}: {answered}/{calls} answered in {elapsed:.1f}s "
+          f"({answered / elapsed:.2f}/s), {calls - answered} fallbacks, "
+          f"{fake_stats().get('rate_limited', 0) - before} upstream 429s, "
+          f"{stats['waited_seconds']:.0f}s waited for a key, {stats['exhausted']} gave up waiting")
+    for label, key in stats['keys'].items():
+        print(f"    {label} ({key['key']}): {key['calls']} calls, {key['rate_limited']} rate limited, "
+              f"limit learned {key['requests_limit']:.0f}/min, utilization {key['utilization']:.0%}")
+
+
+def main():
+    process = start_fake()
+    try:
+        print(f"{ARRIVALS_PER_SECOND} reappraisals a second for {SECONDS}s, {KEY_RPM} calls/min allowed per key, "
+              f"keys waited for up to {index.OPENAI_KEY_MAX_WAIT:.0f}s")
+        for key_count in (1, 3):
+            run(key_count)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
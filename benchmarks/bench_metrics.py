@@ -0,0 +1,52 @@
+"""Overhead of the timing instrumentation, on and off.
+
+Reports the cost of one timed() block and the median time of a reflection
+page request through the test client. Timings are on, then off (METRICS=0).
+
+Run from the repository root:
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import index  # noqa: E402
+import metrics  # noqa: E402
+
+BLOCKS = 200000
+REQUESTS = 2000
+
+index.app.secret_key = index.app.secret_key or 'benchmark-secret'
+
+
+def block_ns():
+    start = time.perf_counter()
+    for _ in range(BLOCKS):
+        with metrics.timed('bench'):
+            pass
+    return (time.perf_counter() - start) / BLOCKS * 1e9
+
+
+def request_us():
+    client = index.app.test_client()
+    samples = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        client.get('/reflection')
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    print(f"{'metrics':<8} {'timed() block ns':>17} {'GET /reflection us':>19}")
+    for enabled in (True, False):
+        metrics.ENABLED = enabled
+        print(f"{'on' if enabled else 'off':<8} {block_ns():>17.0f} {request_us():>19.1f}")
+
+
+if __name__ == '__main__':
+    main()
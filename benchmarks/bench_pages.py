@@ -0,0 +1,84 @@
+"""Page render time and bytes on the wire, before and after the asset split.
+
+"Before" rebuilds the old page, with CSS and JS inlined, and renders it
+through render_template_string on every view with no compression. "After"
+renders the precompiled template, compresses the HTML and serves the assets
+once (compressed, then cached by the browser).
+
+Run from the repository root:
+
+    python benchmarks/bench_pages.py
+"""
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template_string  # noqa: E402
+
+import index  # noqa: E402
+from assets import choose_encoding, compress  # noqa: E402
+from werkzeug.datastructures import Accept  # noqa: E402
+
+RUNS = 500
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Public')
+ACCEPT = Accept([('br', 1), ('gzip', 1)])
+PAGES = {
+    'home': (index.HOME_TEMPLATE, index.home_template,
+             {'latest_question': 'Question 1: How are you feeling today?', 'progress_value': 16.6}),
+    'reflection': (index.REFLECTION_TEMPLATE, index.reflection_template,
+                   {'responses': 'Response 1: happy<br>Response 2: a little tired'}),
+}
+
+
+def read_asset(name):
+    with open(os.path.join(PUBLIC_DIR, name)) as f:
+        return f.read()
+
+
+def inline_assets(template):
+    template = re.sub(r'<link rel="stylesheet" href="\{\{ asset_url\(\'([^\']+)\'\) \}\}">',
+                      lambda m: f"<style>\n{read_asset(m.group(1))}</style>", template)
+    return re.sub(r'<script src="\{\{ asset_url\(\'([^\']+)\'\) \}\}"></script>',
+                  lambda m: f"<script>\n{read_asset(m.group(1))}</script>", template)
+
+
+def asset_bytes(template, encoding):
+    total = 0
+    for name in re.findall(r"asset_url\('([^']+)'\)", template):
+        data = read_asset(name).encode()
+        total += len(compress(data, encoding, static=True)) if encoding else len(data)
+    return total
+
+
+def time_ms(fn):
+    samples = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    encoding = choose_encoding(ACCEPT)
+    print(f"compression: {encoding}, median of {RUNS} renders")
+    print(f"{'page':<11} {'render ms':>20} {'first view bytes':>24} {'repeat view bytes':>24}")
+    with index.app.test_request_context('/'):
+        for page, (template, compiled, context) in PAGES.items():
+            legacy = inline_assets(template)
+            before_ms = time_ms(lambda: render_template_string(legacy, **context))
+            after_ms = time_ms(lambda: compress(compiled.render(**context).encode(), encoding))
+
+            before_html = len(render_template_string(legacy, **context).encode())
+            after_html = len(compress(compiled.render(**context).encode(), encoding))
+            first_view = after_html + asset_bytes(template, encoding)
+            print(f"{page:<11} {before_ms:>9.3f} -> {after_ms:<8.3f} "
+                  f"{before_html:>11} -> {first_view:<10} {before_html:>11} -> {after_html:<10}")
+
+
+if __name__ == '__main__':
+    main()
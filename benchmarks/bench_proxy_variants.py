@@ -0,0 +1,55 @@
+"""Bytes per gallery image and transcode cost for /proxy variants.
+
+The upstream image is the fake OpenAI server's 512x512 "painting" PNG,
+standing in for a DALL-E result. It is seeded into the proxy cache, so
+this times the transcode and the cached serve, without the network.
+
+Run from the repository root:
+
+    python benchmarks/bench_proxy_variants.py
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import index  # noqa: E402
+from fake_openai import painting_png  # noqa: E402
+
+RUNS = 200
+IMAGE_URL = 'https://example.invalid/generated.png'
+VARIANTS = [
+    ('original', '', 'image/png'),
+    ('w=256 png', '&w=256&fmt=png', 'image/png'),
+    ('w=256 jpeg', '&w=256&fmt=jpeg', 'image/jpeg'),
+    ('w=256 (Accept webp)', '&w=256', 'image/avif,image/webp,*/*'),
+    ('w=512 webp', '&w=512&fmt=webp', 'image/webp'),
+]
+
+
+def main():
+    png = painting_png()
+    client = index.app.test_client()
+    print(f"upstream image: {len(png)} bytes, median of {RUNS} cached serves")
+    print(f"{'variant':<22} {'bytes':>8} {'vs original':>12} {'first ms':>9} {'cached ms':>10}")
+    for name, query, accept in VARIANTS:
+        index.proxy_cache.set(IMAGE_URL, index.make_proxy_entry(png, 'image/png'))
+        url = f'/proxy?url={IMAGE_URL}{query}'
+        start = time.perf_counter()
+        response = client.get(url, headers={'Accept': accept})
+        first_ms = (time.perf_counter() - start) * 1000
+        size = len(response.data)
+
+        samples = []
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            client.get(url, headers={'Accept': accept})
+            samples.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<22} {size:>8} {len(png) / size:>11.1f}x {first_ms:>9.2f} {statistics.median(samples):>10.3f}"
+              f"  {response.headers['Content-Type']}")
+
+
+if __name__ == '__main__':
+    main()
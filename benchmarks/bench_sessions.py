@@ -0,0 +1,109 @@
+"""Session cost per backend for a session at question 6.
+
+Reports the bytes each request and response carry for the session, the time
+to load and save it per request, and the server memory (or disk) it takes.
+
+Run from the repository root:
+
+    python benchmarks/bench_sessions.py
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Response, request  # noqa: E402
+from flask.sessions import SecureCookieSessionInterface  # noqa: E402
+
+import index  # noqa: E402
+from sessions import MemoryStore, ServerSideSessionInterface, SqliteStore  # noqa: E402
+
+RUNS = 2000
+SESSIONS = 1000
+WORDS = ("i felt kind of sad heavy today because my friend did not want to play with me at recess it was "
+         "like a grey cloud sitting on my chest and i wanted to cry but then my teacher smiled tummy hands "
+         "warm cold fuzzy scratchy bumpy spiky soft blue red storm rainbow sunshine dog cat mom dad brother").split()
+ANSWER_WORDS = 35
+QUESTION_WORDS = 60
+
+app = index.app
+app.secret_key = app.secret_key or 'benchmark-secret'
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def question_six_state():
+    # Varied text, so cookie compression isn't flattered by repetition
+    rng = random.Random(0)
+    history = []
+    for number in range(1, 7):
+        history += [('Therapist', f"Question {number}: {sentence(rng, QUESTION_WORDS)}?"),
+                    ('You', sentence(rng, ANSWER_WORDS))]
+    return {'history': history, 'question_number': 7}
+
+
+def round_trip(interface, cookie):
+    # One request: load the session from its cookie, change it, save it
+    headers = {'Cookie': cookie} if cookie else {}
+    with app.test_request_context('/api/question', headers=headers):
+        session = interface.open_session(app, request)
+        if not session:
+            session.update(question_six_state())
+        session['question_number'] = 7
+        response = Response()
+        interface.save_session(app, session, response)
+        return response.headers.get('Set-Cookie', '')
+
+
+def measure(name, interface):
+    set_cookie = round_trip(interface, None)
+    cookie = set_cookie.split(';', 1)[0]
+    request_bytes = len('Cookie: ') + len(cookie)
+    response_bytes = len(round_trip(interface, cookie))
+    if response_bytes:
+        response_bytes += len('Set-Cookie: ')
+
+    samples = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        round_trip(interface, cookie)
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    print(f"{name:<8} {request_bytes:>14} {response_bytes:>15} {statistics.median(samples):>13.1f}")
+
+
+def memory_per_session():
+    store = MemoryStore()
+    state = question_six_state()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(SESSIONS):
+        store.save(f'session-{i}', state)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / SESSIONS
+
+
+def main():
+    print(f"{'backend':<8} {'request bytes':>14} {'response bytes':>15} {'overhead us':>13}")
+    measure('cookie', SecureCookieSessionInterface())
+    measure('memory', ServerSideSessionInterface(MemoryStore()))
+    with tempfile.TemporaryDirectory() as directory:
+        store = SqliteStore(os.path.join(directory, 'sessions.sqlite3'))
+        measure('sqlite', ServerSideSessionInterface(store))
+        for i in range(SESSIONS):
+            store.save(f'session-{i}', question_six_state())
+        stats = store.stats()
+        print(f"\nsqlite: {stats['bytes'] / stats['sessions']:.0f} bytes of session data per session")
+    print(f"memory: {memory_per_session():.0f} bytes of RAM per session ({SESSIONS} sessions)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Strokes vs PNG uploads: request bytes, time to the ranked colors, and
+whether both rank the colors the same.
+
+Drawings are random freehand strokes sampled the way mousemove samples
+them, a few pixels apart. The PNG is those strokes rasterized, sent as a
+multipart upload; the strokes go as JSON. The PNG is antialiased and the
+JSON has no spaces, as the browser makes them. Timed from the raw request
+to drawing_colors().
+
+Run from the repository root:
+
+    python benchmarks/bench_strokes.py
+"""
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+import index  # noqa: E402
+from colors import rasterize_strokes  # noqa: E402
+
+CANVAS_SIZE = (500, 330)
+STROKE_COUNTS = (10, 50, 200)
+DRAWINGS = 20
+RUNS = 20
+
+
+def freehand_strokes(count, seed):
+    # The JSON the browser sends: wandering paths, a point every 2-6 px
+    rng = random.Random(seed)
+    colors = list(index.BRUSH_COLORS)
+    strokes = []
+    for _ in range(count):
+        x, y = rng.uniform(0, CANVAS_SIZE[0]), rng.uniform(0, CANVAS_SIZE[1])
+        heading = rng.uniform(0, 2 * math.pi)
+        points = []
+        for _ in range(rng.randint(5, 80)):
+            points += [round(x), round(y)]
+            heading += rng.gauss(0, 0.3)
+            step = rng.uniform(2, 6)
+            x = min(max(x + step * math.cos(heading), 0), CANVAS_SIZE[0])
+            y = min(max(y + step * math.sin(heading), 0), CANVAS_SIZE[1])
+        strokes.append({'color': rng.choice(colors), 'width': rng.choice((5, 10, 20, 30)),
+                        'points': points, 'erase': False})
+    return strokes
+
+
+def png_for(strokes):
+    # Drawn at 4x and downsampled, for antialiased edges like the browser's
+    parsed, size = index.read_strokes(strokes, CANVAS_SIZE)
+    for stroke in parsed:
+        stroke['width'] *= 4
+        stroke['points'] = [(x * 4, y * 4) for x, y in stroke['points']]
+    image = rasterize_strokes(parsed, (size[0] * 4, size[1] * 4)).resize(size, Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def environ_for(kwargs):
+    builder = EnvironBuilder(path='/api/process-drawing', method='POST', **kwargs)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def upload_kwargs(strokes, png):
+    return {
+        'png': lambda: dict(data={'drawing': (BytesIO(png), 'drawing.png', 'image/png'),
+                                  'description': 'a storm cloud'}),
+        # Without spaces, like JSON.stringify
+        'strokes': lambda: dict(data=json.dumps({'canvas': CANVAS_SIZE, 'strokes': strokes,
+                                                 'description': 'a storm cloud'}, separators=(',', ':')),
+                                content_type='application/json'),
+    }
+
+
+def colors_of(kwargs):
+    return index.drawing_colors(index.read_drawing(index.app.request_class(environ_for(kwargs))))
+
+
+def measure(make_kwargs):
+    body_bytes = int(environ_for(make_kwargs())['CONTENT_LENGTH'])
+    samples = []
+    for _ in range(RUNS):
+        kwargs = make_kwargs()
+        start = time.perf_counter()
+        colors_of(kwargs)
+        samples.append((time.perf_counter() - start) * 1000)
+    return body_bytes, statistics.median(samples)
+
+
+def main():
+    print(f"{DRAWINGS} drawings per row, median of {RUNS} runs each")
+    print(f"{'strokes':>8} {'png bytes':>10} {'json bytes':>11} {'png ms':>8} {'strokes ms':>11} "
+          f"{'same top 3':>11} {'same set':>9}")
+    with index.app.app_context():
+        for count in STROKE_COUNTS:
+            sizes = {'png': [], 'strokes': []}
+            times = {'png': [], 'strokes': []}
+            same_top, same_set = 0, 0
+            for seed in range(DRAWINGS):
+                strokes = freehand_strokes(count, seed)
+                uploads = upload_kwargs(strokes, png_for(strokes))
+                for name, make_kwargs in uploads.items():
+                    body_bytes, ms = measure(make_kwargs)
+                    sizes[name].append(body_bytes)
+                    times[name].append(ms)
+                from_pixels = colors_of(uploads['png']())
+                from_strokes = colors_of(uploads['strokes']())
+                same_top += from_pixels[:3] == from_strokes[:3]
+                same_set += set(from_pixels) == set(from_strokes)
+            print(f"{count:>8} {statistics.median(sizes['png']):>10.0f} {statistics.median(sizes['strokes']):>11.0f} "
+                  f"{statistics.median(times['png']):>8.2f} {statistics.median(times['strokes']):>11.3f} "
+                  f"{same_top:>8}/{DRAWINGS} {same_set:>6}/{DRAWINGS}")
+
+
+if __name__ == '__main__':
+    main()
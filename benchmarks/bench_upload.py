@@ -0,0 +1,115 @@
+"""Bytes, parse time and peak memory of a drawing upload, per upload format.
+
+"json (before)" is the old handler: get_json(), split(','), b64decode,
+BytesIO, Image.open. The others go through read_drawing(). Each is timed
+from the raw request to the decoded RGBA image. Peak memory counts Python
+allocations made while parsing. Pillow's pixel buffers are the same size for
+every format and aren't counted.
+
+Run from the repository root:
+
+    python benchmarks/bench_upload.py
+"""
+import base64
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw  # noqa: E402
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+import index  # noqa: E402
+
+RUNS = 300
+STROKES = 400
+
+
+def canvas_png():
+    # A busy 500x330 canvas: a few hundred anti-aliased brush strokes
+    rng = random.Random(0)
+    image = Image.new('RGBA', (1000, 660), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    colors = list(index.BRUSH_COLORS)
+    for _ in range(STROKES):
+        points = [(rng.randrange(1000), rng.randrange(660)) for _ in range(rng.randint(2, 6))]
+        draw.line(points, fill=rng.choice(colors), width=rng.randint(30, 60), joint='curve')
+    image = image.resize((500, 330), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def legacy_parse(request):
+    data = request.get_json()
+    image_data = base64.b64decode(data['drawing'].split(',')[1])
+    return Image.open(BytesIO(image_data)).convert('RGBA')
+
+
+def parse(request):
+    return index.open_drawing(index.read_drawing(request)['drawing']).convert('RGBA')
+
+
+def formats(png):
+    data_url = index.DATA_URL_PREFIX + base64.b64encode(png).decode()
+    json_body = {'drawing': data_url, 'description': 'a storm cloud'}
+    return {
+        'json (before)': (legacy_parse, dict(json=json_body)),
+        'json': (parse, dict(json=json_body)),
+        'multipart': (parse, dict(data={'drawing': (BytesIO(png), 'drawing.png', 'image/png'),
+                                        'description': 'a storm cloud'})),
+        'raw png': (parse, dict(data=png, content_type='image/png',
+                                query_string={'description': 'a storm cloud'})),
+    }
+
+
+def environ_for(kwargs):
+    kwargs = dict(kwargs)
+    if 'data' in kwargs and isinstance(kwargs['data'], dict):
+        # File objects are consumed by each build
+        kwargs['data'] = {k: (BytesIO(v[0].getvalue()), *v[1:]) if isinstance(v, tuple) else v
+                          for k, v in kwargs['data'].items()}
+    builder = EnvironBuilder(path='/api/process-drawing', method='POST', **kwargs)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def measure(fn, kwargs):
+    environ = environ_for(kwargs)
+    body_bytes = int(environ['CONTENT_LENGTH'])
+
+    samples = []
+    for _ in range(RUNS):
+        environ = environ_for(kwargs)
+        start = time.perf_counter()
+        fn(index.app.request_class(environ))
+        samples.append((time.perf_counter() - start) * 1000)
+
+    environ = environ_for(kwargs)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fn(index.app.request_class(environ))
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return body_bytes, statistics.median(samples), peak
+
+
+def main():
+    png = canvas_png()
+    print(f"canvas PNG: {len(png)} bytes, median of {RUNS} parses")
+    print(f"{'format':<14} {'request bytes':>14} {'parse ms':>9} {'peak KiB':>9}")
+    with index.app.app_context():
+        for name, (fn, kwargs) in formats(png).items():
+            body_bytes, parse_ms, peak = measure(fn, kwargs)
+            print(f"{name:<14} {body_bytes:>14} {parse_ms:>9.3f} {peak / 1024:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
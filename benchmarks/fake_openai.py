@@ -0,0 +1,235 @@
+"""A local stand-in for the OpenAI endpoints the app calls.
+
+Serves /v1/completions (plain and streamed), /v1/images/generations and the
+image files those return, so load tests run offline and measure the app
+rather than OpenAI. Point the app at it with
+
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake
+
+Latencies are distributions, given as fixed:S, uniform:LOW:HIGH,
+lognormal:MEDIAN:SIGMA or exp:MEAN (seconds). A share of the API calls can
+fail with 5xx or 429 answers. With --key-requests-per-minute, each API key
+gets that many calls a minute, reported in x-ratelimit-* headers as OpenAI
+does, and is answered 429 past it. Images are flat colour or a textured
+"painting" about the size of a real DALL-E PNG. GET /stats counts the calls.
+
+Run from the repository root:
+
+    python benchmarks/fake_openai.py --port 8765 --completion-latency lognormal:1.0:0.4
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import Counter
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image, ImageDraw, ImageFilter
+
+QUESTION = "How does that feeling show up in your body, like a tight tummy or warm cheeks?"
+
+
+class Latency:
+    def __init__(self, spec):
+        kind, *params = spec.split(':')
+        params = [float(p) for p in params]
+        if kind == 'fixed':
+            self.sample = lambda: params[0]
+        elif kind == 'uniform':
+            self.sample = lambda: random.uniform(params[0], params[1])
+        elif kind == 'lognormal':
+            # params: median, sigma of the underlying normal
+            self.sample = lambda: random.lognormvariate(math.log(params[0]), params[1])
+        elif kind == 'exp':
+            self.sample = lambda: random.expovariate(1 / params[0])
+        else:
+            raise ValueError(f"Unknown latency distribution {spec!r}")
+        self.spec = spec
+
+    async def wait(self):
+        await asyncio.sleep(self.sample())
+
+
+def flat_png(size=512):
+    buffer = BytesIO()
+    Image.new('RGB', (size, size), (120, 170, 220)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def painting_png(size=512, seed=0):
+    # Blurred colour fields with a noise texture: compresses about as badly
+    # as a DALL-E PNG (~440 KB at 512x512)
+    rng = random.Random(seed)
+    image = Image.new('RGB', (size, size), (250, 230, 200))
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x, y, r = rng.randrange(size), rng.randrange(size), rng.randint(size // 25, size // 4)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    image = image.filter(ImageFilter.GaussianBlur(size / 40))
+    texture = Image.effect_noise((size, size), 40).convert('RGB')
+    image = Image.blend(image, texture, 0.12)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class KeyLimits:
+    # A token bucket of requests per minute for each API key
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.buckets = {}
+
+    def take(self, authorization):
+        # (allowed, x-ratelimit-* and Retry-After headers)
+        now = time.monotonic()
+        level, updated = self.buckets.get(authorization, (self.per_minute, now))
+        level = min(self.per_minute, level + (now - updated) * self.per_minute / 60)
+        allowed = level >= 1
+        if allowed:
+            level -= 1
+        self.buckets[authorization] = (level, now)
+        headers = {
+            'x-ratelimit-limit-requests': str(int(self.per_minute)),
+            'x-ratelimit-remaining-requests': str(int(level)),
+            'x-ratelimit-reset-requests': f'{(self.per_minute - level) * 60 / self.per_minute:.3f}s',
+        }
+        if not allowed:
+            headers['Retry-After'] = f'{math.ceil((1 - level) * 60 / self.per_minute)}'
+        return allowed, headers
+
+
+def make_app(completion_latency, image_latency, download_latency, error_rate=0.0, rate_limit_rate=0.0,
+             image_kind='flat', image_size=512, key_requests_per_minute=0):
+    png = painting_png(image_size) if image_kind == 'painting' else flat_png(image_size)
+    calls = Counter()
+    key_limits = KeyLimits(key_requests_per_minute) if key_requests_per_minute else None
+
+    @web.middleware
+    async def rate_limit_keys(request, handler):
+        if key_limits is None or not request.path.startswith('/v1/'):
+            return await handler(request)
+        authorization = request.headers.get('Authorization', '')
+        calls[f'key ...{authorization[-4:]}'] += 1
+        allowed, headers = key_limits.take(authorization)
+        if not allowed:
+            calls['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                                     status=429, headers=headers)
+        request['rate_limit_headers'] = headers
+        response = await handler(request)
+        if not response.prepared:
+            response.headers.update(headers)
+        return response
+
+    def injected_failure():
+        roll = random.random()
+        if roll < rate_limit_rate:
+            calls['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                                     status=429, headers={'Retry-After': '1'})
+        if roll < rate_limit_rate + error_rate:
+            calls['errors'] += 1
+            return web.json_response({'error': {'message': 'The server had an error', 'type': 'server_error'}},
+                                     status=random.choice((500, 502, 503)))
+        return None
+
+    async def completions(request):
+        body = await request.json()
+        calls['completions'] += 1
+        await completion_latency.wait()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        if body.get('stream'):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                                   **request.get('rate_limit_headers', {})})
+            await response.prepare(request)
+            for word in QUESTION.split(' '):
+                chunk = {'id': 'cmpl-fake', 'object': 'text_completion', 'created': int(time.time()),
+                         'model': body.get('model'), 'choices': [{'text': f' {word}', 'index': 0}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        return web.json_response({
+            'id': 'cmpl-fake', 'object': 'text_completion', 'created': int(time.time()), 'model': body.get('model'),
+            'choices': [{'text': f"\n\n{QUESTION}", 'index': 0, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 20, 'total_tokens': 30},
+        })
+
+    async def images(request):
+        body = await request.json()
+        calls['image_generations'] += 1
+        await image_latency.wait()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        base = f"{request.scheme}://{request.host}"
+        return web.json_response({'created': int(time.time()), 'data': [
+            {'url': f"{base}/images/{uuid.uuid4().hex}.png"} for _ in range(body.get('n', 1))
+        ]})
+
+    async def image(request):
+        calls['image_downloads'] += 1
+        await download_latency.wait()
+        return web.Response(body=png, content_type='image/png')
+
+    async def stats(request):
+        return web.json_response(dict(calls))
+
+    app = web.Application(middlewares=[rate_limit_keys])
+    app.router.add_post('/v1/completions', completions)
+    app.router.add_post('/v1/engines/{engine}/completions', completions)
+    app.router.add_post('/v1/images/generations', images)
+    app.router.add_get('/images/{name}', image)
+    app.router.add_get('/stats', stats)
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--completion-latency', type=Latency, default=Latency('fixed:1.0'))
+    parser.add_argument('--image-latency', type=Latency, default=Latency('fixed:1.0'),
+                        help="latency of an image generation")
+    parser.add_argument('--download-latency', type=Latency, default=Latency('fixed:0.05'),
+                        help="latency of fetching a generated image")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of API calls answering 5xx")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of API calls answering 429")
+    parser.add_argument('--key-requests-per-minute', type=float, default=0,
+                        help="API calls a minute allowed per key, 0 for no limit")
+    parser.add_argument('--image-kind', choices=('flat', 'painting'), default='flat')
+    parser.add_argument('--image-size', type=int, default=512)
+
+
+def command_line(args, port):
+    # The arguments that start this server with the same settings as args
+    return ['--port', str(port),
+            '--completion-latency', args.completion_latency.spec,
+            '--image-latency', args.image_latency.spec,
+            '--download-latency', args.download_latency.spec,
+            '--error-rate', str(args.error_rate),
+            '--rate-limit-rate', str(args.rate_limit_rate),
+            '--key-requests-per-minute', str(args.key_requests_per_minute),
+            '--image-kind', args.image_kind,
+            '--image-size', str(args.image_size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=None,
+                        help="shorthand for a fixed completion and image generation latency")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.latency is not None:
+        args.completion_latency = args.image_latency = Latency(f'fixed:{args.latency}')
+    app = make_app(args.completion_latency, args.image_latency, args.download_latency,
+                   args.error_rate, args.rate_limit_rate, args.image_kind, args.image_size,
+                   args.key_requests_per_minute)
+    web.run_app(app, host='127.0.0.1', port=args.port, print=None, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Concurrent users one process can carry, threaded WSGI vs ASGI.
+
+Starts the fake OpenAI server, then serves the app from a single process,
+first with gunicorn's threaded worker (index:app) and then with uvicorn
+(asgi:app). Simulated users answer a question, submit a drawing and fetch
+the generated images through /proxy, over and over. The number of users goes
+up step by step. A step passes when every route's p95 is within the SLO and
+under 1% of requests fail. Capacity is the last step that passes.
+
+Run from the repository root:
+
+    python benchmarks/load_async.py [--latency 1.0] [--threads 32] [--duration 10]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+
+import aiohttp
+from PIL import Image, ImageDraw
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_STEPS = [16, 32, 64, 128, 256, 512]
+# The app's own per-key rate limit buckets would otherwise throttle the run
+# long before the server does: this measures the server
+UNLIMITED_KEYS = {
+    'OPENAI_KEY_REQUESTS_PER_MINUTE': '1000000',
+    'OPENAI_KEY_TOKENS_PER_MINUTE': '100000000',
+    'OPENAI_KEY_IMAGES_PER_MINUTE': '1000000',
+}
+
+
+def drawing_data_url():
+    image = Image.new('RGBA', (500, 330), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((100, 60, 260, 220), fill='#0057e7')
+    draw.line((280, 40, 460, 300), fill='#f44336', width=20)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def free_port():
+    # A port nothing listens on now, for a server started next: a fixed one
+    # might already be taken, and the run would measure whatever has it
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def check_running(processes):
+    for process in processes:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(map(str, process.args))} exited with {process.returncode}")
+
+
+def server_commands(threads, port):
+    address = f'127.0.0.1:{port}'
+    return {
+        f'gunicorn gthread, {threads} threads': [
+            sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+            '-b', address, 'index:app'],
+        'uvicorn asgi': [
+            sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', '1', '--host', '127.0.0.1',
+            '--port', str(port), '--no-access-log', '--log-level', 'warning'],
+    }
+
+
+async def wait_until_up(url, processes=(), timeout=30):
+    # Until url answers, failing as soon as one of the processes serving it
+    # has exited (e.g. its port was taken)
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as client:
+        while time.monotonic() < deadline:
+            check_running(processes)
+            try:
+                async with client.get(url) as response:
+                    if response.status < 500:
+                        check_running(processes)
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def user(base, drawing, number, stop_at, samples, errors):
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True), timeout=timeout) as client:
+
+        async def call(route, method, url, **kwargs):
+            start = time.perf_counter()
+            try:
+                async with client.request(method, base + url, **kwargs) as response:
+                    body = await response.read()
+                    ok = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok, body = False, b''
+            samples[route].append(time.perf_counter() - start)
+            if not ok:
+                errors[route] += 1
+            return body if ok else None
+
+        await call('/', 'GET', '/')
+        turn = 0
+        while time.monotonic() < stop_at:
+            turn += 1
+            await call('/api/question', 'POST', '/api/question', json={'response': f'I feel a bit sad today ({turn})'})
+            body = await call('/api/process-drawing', 'POST', '/api/process-drawing', json={
+                'drawing': drawing, 'description': f'a blue storm cloud number {number}-{turn}'})
+            if body:
+                for url in json.loads(body).get('image_urls', []):
+                    await call('/proxy', 'GET', '/proxy', params={'url': url})
+
+
+async def run_step(base, drawing, users, duration):
+    samples, errors = defaultdict(list), defaultdict(int)
+    start = time.monotonic()
+    await asyncio.gather(*(user(base, drawing, i, start + duration, samples, errors) for i in range(users)))
+    elapsed = time.monotonic() - start
+    return samples, errors, elapsed
+
+
+def p95(values):
+    return statistics.quantiles(values, n=100)[94] if len(values) > 1 else (values[0] if values else 0)
+
+
+async def measure(name, command, port, args, env):
+    print(f"\n{name}")
+    print(f"{'users':>6} {'req/s':>8} {'question p95':>13} {'drawing p95':>12} {'proxy p95':>10} {'errors':>7}")
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    capacity = 0
+    try:
+        base = f'http://127.0.0.1:{port}'
+        await wait_until_up(base + '/upstream/stats', [server])
+        drawing = drawing_data_url()
+        for users in USER_STEPS:
+            samples, errors, elapsed = await run_step(base, drawing, users, args.duration)
+            total = sum(len(values) for values in samples.values())
+            failed = sum(errors.values())
+            worst = {route: p95(values) for route, values in samples.items()}
+            print(f"{users:>6} {total / elapsed:>8.1f} {worst.get('/api/question', 0):>12.2f}s "
+                  f"{worst.get('/api/process-drawing', 0):>11.2f}s {worst.get('/proxy', 0):>9.2f}s {failed:>7}")
+            check_running([server])
+            if max(worst.values()) > args.slo or failed > total * 0.01:
+                break
+            capacity = users
+    finally:
+        server.terminate()
+        server.wait()
+    return capacity
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=1.0, help="fake OpenAI seconds per call")
+    parser.add_argument('--threads', type=int, default=32, help="gunicorn worker threads")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per step")
+    parser.add_argument('--slo', type=float, default=None, help="p95 limit in seconds (default 2.5x latency)")
+    args = parser.parse_args()
+    args.slo = args.slo or args.latency * 2.5
+
+    fake_port, app_port = free_port(), free_port()
+    env = dict(os.environ, OPENAI_API_KEY='fake', OPENAI_API_BASE=f'http://127.0.0.1:{fake_port}/v1',
+               SESSION_BACKEND='memory', **UNLIMITED_KEYS)
+    fake = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_openai.py'),
+                             '--port', str(fake_port), '--latency', str(args.latency)])
+    try:
+        await wait_until_up(f'http://127.0.0.1:{fake_port}/images/probe.png', [fake])
+        print(f"fake OpenAI latency {args.latency}s, p95 SLO {args.slo}s, {args.duration}s per step")
+        capacities = {}
+        for name, command in server_commands(args.threads, app_port).items():
+            capacities[name] = await measure(name, command, app_port, args, env)
+        check_running([fake])
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    print("\nconcurrent users per process within the SLO:")
+    for name, capacity in capacities.items():
+        print(f"  {name:<28} {capacity}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
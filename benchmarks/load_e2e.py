@@ -0,0 +1,248 @@
+"""End-to-end load benchmark, fully offline.
+
+Starts the fake OpenAI server (benchmarks/fake_openai.py) and the app, then
+runs simulated users through whole sessions:
+
+- load / (question 1)
+- answer questions 1 to 6 through /api/question (the sixth answer restarts)
+- after question 4, submit a drawing to /api/process-drawing
+- fetch the gallery thumbnails and the full-size image through /proxy
+
+Reports throughput and p50/p95/p99 latency per route. --save writes the
+results as JSON. --baseline compares against saved results and exits
+non-zero when a route's p95 is more than --tolerance slower, or its error
+rate grew, so it can gate changes.
+
+Run from the repository root:
+
+    python benchmarks/load_e2e.py --users 32 --duration 30 [--server uvicorn]
+    python benchmarks/load_e2e.py --save baseline.json
+    python benchmarks/load_e2e.py --baseline baseline.json --tolerance 0.2
+
+Fake upstream options (latency distributions, error rates, image payloads)
+are the same as fake_openai.py's, e.g. --completion-latency lognormal:1.0:0.4
+--error-rate 0.02 --image-kind painting.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+
+import aiohttp
+from PIL import Image, ImageDraw
+
+import fake_openai
+from load_async import UNLIMITED_KEYS, check_running, free_port, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ['/', '/api/question', '/api/process-drawing', '/proxy']
+ANSWERS = [
+    "I feel kind of sad and grumpy",
+    "It feels heavy in my tummy, like a big rock",
+    "My friend didn't want to play with me at recess",
+    "It looks like a grey storm cloud with spikes",
+    "Scratchy, like a wool sweater",
+    "I think I can ask someone else to play tomorrow",
+]
+DRAW_AFTER_QUESTION = 4
+
+
+def drawing_png(seed):
+    rng = random.Random(seed)
+    image = Image.new('RGBA', (500, 330), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    colors = ['#f44336', '#0057e7', '#646765', '#faab09', '#000000']
+    for _ in range(rng.randint(5, 25)):
+        points = [(rng.randrange(500), rng.randrange(330)) for _ in range(rng.randint(2, 5))]
+        draw.line(points, fill=rng.choice(colors), width=rng.randint(15, 30), joint='curve')
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def server_command(server, threads, port):
+    if server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', '1', '--host', '127.0.0.1',
+                '--port', str(port), '--no-access-log', '--log-level', 'warning']
+    return [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+            '-b', f'127.0.0.1:{port}', 'index:app']
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sessions = 0
+
+    def record(self, route, seconds, ok):
+        self.samples[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+
+async def session(client, base, drawings, recorder, number, stop_at):
+    async def call(route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with client.request(method, base + url, **kwargs) as response:
+                body = await response.read()
+                ok = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok, body = False, b''
+        recorder.record(route, time.perf_counter() - start, ok)
+        return body if ok else None
+
+    await call('/', 'GET', '/')
+    for question, answer in enumerate(ANSWERS, start=1):
+        if time.monotonic() >= stop_at:
+            return
+        await call('/api/question', 'POST', '/api/question', json={'response': answer})
+        if question != DRAW_AFTER_QUESTION:
+            continue
+        form = aiohttp.FormData()
+        form.add_field('drawing', drawings[number % len(drawings)], filename='drawing.png', content_type='image/png')
+        form.add_field('description', f'a grey storm cloud with spikes, session {number}')
+        body = await call('/api/process-drawing', 'POST', '/api/process-drawing', data=form)
+        if body:
+            image_urls = json.loads(body).get('image_urls', [])
+            for url in image_urls:
+                await call('/proxy', 'GET', '/proxy', params={'url': url, 'w': '256'},
+                           headers={'Accept': 'image/webp,*/*'})
+            if image_urls:
+                await call('/proxy', 'GET', '/proxy', params={'url': image_urls[0]})
+    recorder.sessions += 1
+
+
+async def user(base, drawings, recorder, user_number, stop_at):
+    timeout = aiohttp.ClientTimeout(total=120)
+    number = user_number
+    while time.monotonic() < stop_at:
+        # A new cookie jar per session, like a new child at the computer
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True), timeout=timeout) as client:
+            await session(client, base, drawings, recorder, number, stop_at)
+        number += 10000
+
+
+def percentiles(values):
+    if len(values) < 2:
+        value = values[0] if values else 0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100)
+    return statistics.median(values), cuts[94], cuts[98]
+
+
+def summarize(recorder, elapsed):
+    results = {'elapsed': elapsed, 'sessions': recorder.sessions, 'routes': {}}
+    for route in ROUTES:
+        values = recorder.samples.get(route, [])
+        p50, p95, p99 = percentiles(values)
+        results['routes'][route] = {
+            'requests': len(values),
+            'errors': recorder.errors.get(route, 0),
+            'throughput': len(values) / elapsed,
+            'p50': p50, 'p95': p95, 'p99': p99,
+        }
+    return results
+
+
+def report(results):
+    print(f"{results['sessions']} complete sessions in {results['elapsed']:.1f}s "
+          f"({results['sessions'] / results['elapsed'] * 60:.1f}/min)")
+    print(f"{'route':<22} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in results['routes'].items():
+        print(f"{route:<22} {stats['requests']:>9} {stats['errors']:>7} {stats['throughput']:>8.1f} "
+              f"{stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for route, stats in results['routes'].items():
+        before = baseline['routes'].get(route)
+        if not before or not stats['requests']:
+            continue
+        if before['p95'] and stats['p95'] > before['p95'] * (1 + tolerance):
+            found.append(f"{route}: p95 {before['p95'] * 1000:.1f} -> {stats['p95'] * 1000:.1f} ms")
+        error_rate = stats['errors'] / stats['requests']
+        before_rate = before['errors'] / before['requests'] if before['requests'] else 0
+        if error_rate > before_rate + 0.01:
+            found.append(f"{route}: error rate {before_rate:.1%} -> {error_rate:.1%}")
+    return found
+
+
+async def run(args):
+    fake_port, app_port = free_port(), free_port()
+    env = dict(os.environ, OPENAI_API_KEY='fake', OPENAI_API_BASE=f'http://127.0.0.1:{fake_port}/v1',
+               SESSION_BACKEND='memory', **UNLIMITED_KEYS)
+    processes = []
+    try:
+        if args.app_url is None:
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_openai.py')]
+                + fake_openai.command_line(args, fake_port)))
+            await wait_until_up(f'http://127.0.0.1:{fake_port}/stats', processes)
+            processes.append(subprocess.Popen(server_command(args.server, args.threads, app_port), cwd=ROOT,
+                                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            base = f'http://127.0.0.1:{app_port}'
+        else:
+            base = args.app_url.rstrip('/')
+        await wait_until_up(base + '/upstream/stats', processes)
+
+        drawings = [drawing_png(seed) for seed in range(16)]
+        if args.warmup:
+            await asyncio.gather(*(user(base, drawings, Recorder(), -i - 1, time.monotonic() + args.warmup)
+                                   for i in range(args.users)))
+        recorder = Recorder()
+        start = time.monotonic()
+        await asyncio.gather(*(user(base, drawings, recorder, i, start + args.duration) for i in range(args.users)))
+        # Results from a server that died mid-run aren't a result
+        check_running(processes)
+        return summarize(recorder, time.monotonic() - start)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of measured load")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds of unmeasured load first")
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn'), default='gunicorn')
+    parser.add_argument('--threads', type=int, default=32, help="gunicorn worker threads")
+    parser.add_argument('--app-url', default=None,
+                        help="drive an app that is already running (against its own upstream) instead")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare with results saved by --save")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown against the baseline")
+    fake_openai.add_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"{args.users} users, {args.server}, completions {args.completion_latency.spec}, "
+          f"images {args.image_latency.spec}, errors {args.error_rate:.0%} 5xx / {args.rate_limit_rate:.0%} 429")
+    results = asyncio.run(run(args))
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if found:
+            print("\nregressions against the baseline:")
+            for line in found:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nno regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    # Least-recently-used cache bounded by the total size of its values, as
+    # measured by sizeof(value), and optionally by age: entries older than
+    # ttl seconds are treated as missing. Safe to share between threads.
+    def __init__(self, max_bytes, sizeof=len, ttl=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                del self._entries[key]
+                self._bytes -= entry[1]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+                'evictions': self.evictions,
+                'expired': self.expired,
+            }
+
+
+class SingleFlight:
+    # Collapses concurrent calls for the same key into one: the first caller
+    # runs fn, everyone arriving while it runs waits for and shares its result.
+    # At most max_waiters callers wait on one call; any more run fn themselves.
+    def __init__(self, max_waiters=None):
+        self.max_waiters = max_waiters
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.coalesced = 0
+        self.overflowed = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = {'future': Future(), 'waiters': 0}
+                self.issued += 1
+                leader = True
+            elif self.max_waiters is not None and call['waiters'] >= self.max_waiters:
+                self.overflowed += 1
+                call = None
+                leader = False
+            else:
+                call['waiters'] += 1
+                self.coalesced += 1
+                leader = False
+        if call is None:
+            return fn()
+        if not leader:
+            return call['future'].result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call['future'].set_exception(e)
+            raise
+        else:
+            call['future'].set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'waiting': sum(call['waiters'] for call in self._calls.values()),
+                'issued': self.issued,
+                'coalesced': self.coalesced,
+                'overflowed': self.overflowed,
+            }
+
+
+class AsyncSingleFlight(SingleFlight):
+    # SingleFlight for coroutines running on one event loop: fn is an async
+    # callable and waiters await the leader's result instead of blocking.
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = {'future': asyncio.get_running_loop().create_future(), 'waiters': 0}
+            self.issued += 1
+        elif self.max_waiters is not None and call['waiters'] >= self.max_waiters:
+            self.overflowed += 1
+            return await fn()
+        else:
+            call['waiters'] += 1
+            self.coalesced += 1
+            return await asyncio.shield(call['future'])
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            call['future'].cancel()
+            raise
+        except BaseException as e:
+            call['future'].set_exception(e)
+            # Mark it retrieved, there may be no waiters to do it
+            call['future'].exception()
+            raise
+        else:
+            call['future'].set_result(result)
+            return result
+        finally:
+            del self._calls[key]
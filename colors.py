@@ -0,0 +1,181 @@
+import functools
+import math
+from itertools import product
+
+from lazy import LazyModule
+
+# PIL is only needed for pixels; stroke geometry is analyzed without it
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+
+# Canvas strokes are antialiased, so edge pixels carry blended colors that
+# never match a brush exactly. Pixels within half this RGB distance of a brush
+# color are always snapped to it; pixels far from every brush are ignored.
+SNAP_DISTANCE = 80
+
+# Colors covering less than this share of the painted pixels are dropped, so
+# the blend where two strokes overlap doesn't show up as a third color.
+MIN_COVERAGE = 0.005
+
+# Levels per channel of the grid of "no brush" colors that far-off pixels
+# snap to instead of a brush color.
+REJECT_GRID_LEVELS = 6
+
+
+def hex_to_rgb(hex_color):
+    hex_color = hex_color.lstrip('#')
+    return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def _distance_sq(a, b):
+    return sum((x - y) ** 2 for x, y in zip(a, b))
+
+
+def _clip_segment(x0, y0, x1, y1, width, height):
+    # Liang-Barsky: the length of the segment inside the canvas
+    dx, dy = x1 - x0, y1 - y0
+    low, high = 0.0, 1.0
+    for p, q in ((-dx, x0), (dx, width - x0), (-dy, y0), (dy, height - y0)):
+        if p == 0:
+            if q < 0:
+                return 0.0
+        else:
+            t = q / p
+            if p < 0:
+                low = max(low, t)
+            else:
+                high = min(high, t)
+    if low >= high:
+        return 0.0
+    return (high - low) * math.hypot(dx, dy)
+
+
+def stroke_area(points, line_width, size):
+    # Area painted by a polyline drawn with round caps, as the canvas draws
+    # it: its length inside the canvas times the line width, plus one dot.
+    # Self-overlap is counted twice.
+    width, height = size
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    if 0 <= min(xs) and max(xs) <= width and 0 <= min(ys) and max(ys) <= height:
+        # The usual case, since the canvas stops a stroke at its edge
+        length = sum(map(math.dist, points, points[1:]))
+    else:
+        length = sum(_clip_segment(x0, y0, x1, y1, width, height)
+                     for (x0, y0), (x1, y1) in zip(points, points[1:]))
+    x, y = points[0]
+    dot = math.pi * line_width ** 2 / 4 if 0 <= x <= width and 0 <= y <= height else 0.0
+    return length * line_width + dot
+
+
+def rasterize_strokes(strokes, size):
+    # The strokes drawn in order onto a transparent canvas; eraser strokes
+    # clear what is under them
+    image = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for stroke in strokes:
+        fill = (0, 0, 0, 0) if stroke['erase'] else (*stroke['color'], 255)
+        line_width = max(1, round(stroke['width']))
+        radius = line_width / 2
+        if len(stroke['points']) > 1:
+            draw.line(stroke['points'], fill=fill, width=line_width, joint='curve')
+        for x, y in (stroke['points'][0], stroke['points'][-1]):
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=fill)
+    return image
+
+
+class ColorAnalyzer:
+    def __init__(self, brush_colors, snap_distance=SNAP_DISTANCE, min_coverage=MIN_COVERAGE):
+        self.names = list(brush_colors.values())
+        self.min_coverage = min_coverage
+
+        # Palette layout: brush colors first, then a coarse grid over the RGB
+        # cube minus any grid points close to a brush color. Quantizing to it
+        # maps each pixel to its nearest entry in one C pass, and the index
+        # histogram gives per-brush coverage without touching pixels in Python.
+        brush_rgb = [hex_to_rgb(hex_color) for hex_color in brush_colors]
+        self._brush_rgb = brush_rgb
+        self.snap_distance = snap_distance
+        step = 255 / (REJECT_GRID_LEVELS - 1)
+        levels = [round(i * step) for i in range(REJECT_GRID_LEVELS)]
+        reject_rgb = [
+            point for point in product(levels, repeat=3)
+            if all(_distance_sq(point, rgb) >= snap_distance ** 2 for rgb in brush_rgb)
+        ]
+        self.palette = brush_rgb + reject_rgb
+        if len(self.palette) > 256:
+            raise ValueError("Too many brush colors for a 256 entry palette")
+
+    @functools.cached_property
+    def _palette_image(self):
+        palette = [channel for rgb in self.palette for channel in rgb]
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(palette + [0] * (768 - len(palette)))
+        return palette_image
+
+    def coverage(self, image):
+        # Returns [(color_name, pixel_count)] for every brush color in the
+        # drawing, ranked by area.
+        if image.mode == 'P':
+            counts = self._palette_counts(image)
+        else:
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+            alpha = image.getchannel('A')
+            indexed = image.convert('RGB').quantize(palette=self._palette_image, dither=Image.Dither.NONE)
+            counts = indexed.histogram(mask=alpha)
+
+        painted = sum(counts)
+        threshold = max(1, painted * self.min_coverage)
+        ranked = [(name, counts[i]) for i, name in enumerate(self.names) if counts[i] >= threshold]
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked
+
+    def _palette_counts(self, image):
+        # The index histogram of a palette-indexed image, folded onto our
+        # palette: only its palette entries are snapped, not its pixels.
+        # Fully transparent entries aren't painted.
+        histogram = image.histogram()
+        colors = image.getpalette('RGB') or []
+        entries = list(zip(colors[0::3], colors[1::3], colors[2::3]))
+        transparency = image.info.get('transparency')
+        if isinstance(transparency, int):
+            transparency = bytes(255 if i != transparency else 0 for i in range(len(entries)))
+        alpha = transparency or b''
+
+        strip = Image.new('RGB', (max(1, len(entries)), 1))
+        strip.putdata(entries)
+        snapped = strip.quantize(palette=self._palette_image, dither=Image.Dither.NONE).getdata()
+        counts = [0] * 256
+        for i, ours in enumerate(snapped):
+            if i < len(histogram) and (i >= len(alpha) or alpha[i]):
+                counts[ours] += histogram[i]
+        return counts
+
+    def ranked_names(self, image):
+        return [name for name, _ in self.coverage(image)]
+
+    def brush_name(self, rgb):
+        # The brush color nearest to rgb, or None if none is within snap distance
+        distance, name = min((_distance_sq(rgb, brush), name) for brush, name in zip(self._brush_rgb, self.names))
+        return name if distance < self.snap_distance ** 2 else None
+
+    def stroke_coverage(self, strokes, size):
+        # coverage() from stroke geometry instead of pixels, in O(points):
+        # [(color_name, area)] ranked by area. Strokes painted over each other
+        # all count, so it can't be used with eraser strokes.
+        areas = {}
+        names = {}
+        for stroke in strokes:
+            color = stroke['color']
+            name = names[color] if color in names else names.setdefault(color, self.brush_name(color))
+            if name is not None:
+                areas[name] = areas.get(name, 0) + stroke_area(stroke['points'], stroke['width'], size)
+
+        threshold = max(1, sum(areas.values()) * self.min_coverage)
+        ranked = [(name, area) for name, area in areas.items() if area >= threshold]
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked
+
+    def ranked_stroke_names(self, strokes, size):
+        return [name for name, _ in self.stroke_coverage(strokes, size)]
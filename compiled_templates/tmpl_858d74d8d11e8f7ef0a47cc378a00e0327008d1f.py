@@ -0,0 +1,33 @@
+from jinja2.runtime import LoopContext, Macro, Markup, Namespace, TemplateNotFound, TemplateReference, TemplateRuntimeError, Undefined, escape, identity, internalcode, markup_join, missing, str_join
+name = 'home-bca88722ab36.html'
+
+def root(context, missing=missing):
+    resolve = context.resolve_or_missing
+    undefined = environment.undefined
+    concat = environment.concat
+    cond_expr_undefined = Undefined
+    if 0: yield None
+    l_0_asset_url = resolve('asset_url')
+    l_0_latest_question = resolve('latest_question')
+    l_0_progress_value = resolve('progress_value')
+    l_0_drawing_palette = resolve('drawing_palette')
+    l_0_drawing_jobs = resolve('drawing_jobs')
+    pass
+    yield '\n    <html>\n        <head>\n            <title>Mind Palette for kids!</title>\n            <link rel="stylesheet" href="'
+    yield escape(context.call((undefined(name='asset_url') if l_0_asset_url is missing else l_0_asset_url), 'home.css'))
+    yield '">\n\n\n            <script src="'
+    yield escape(context.call((undefined(name='asset_url') if l_0_asset_url is missing else l_0_asset_url), 'home.js'))
+    yield '"></script>\n        </head>\n        <body>\n            <div class="container">\n                <div class="left">\n                <h1>Mind Palette for kids!</h1>\n                <div id="question">'
+    yield escape((undefined(name='latest_question') if l_0_latest_question is missing else l_0_latest_question))
+    yield '</div>\n                <progress value="'
+    yield escape((undefined(name='progress_value') if l_0_progress_value is missing else l_0_progress_value))
+    yield '" max="100"></progress>  <!-- Progress bar here -->\n                <form onsubmit="return sendResponse();">\n                    <input type="text" id="response" autocomplete="off" style="width: 430px; margin-top: 15px;" value="" placeholder="Enter your response here..." />\n                    <input type="submit" value="Respond" class="button-style" />\n                </form>\n                <div class="canvas-container ">\n                    <canvas id="drawingCanvas" width="500" height="330" data-palette="'
+    yield escape((undefined(name='drawing_palette') if l_0_drawing_palette is missing else l_0_drawing_palette))
+    yield '" data-jobs="'
+    yield escape((1 if (undefined(name='drawing_jobs') if l_0_drawing_jobs is missing else l_0_drawing_jobs) else 0))
+    yield '"></canvas>\n                    <button id="backButton" class="tool-button" onclick="undoLastAction()">Back</button>\n                </div>\n                <div class>\n                    <div class="brush" style="background-color: #f44336;" onclick="changeColor(\'#f44336\')"></div>\n                    <div class="brush" style="background-color: #ff5800;" onclick="changeColor(\'#ff5800\')"></div>\n                    <div class="brush" style="background-color: #faab09;" onclick="changeColor(\'#faab09\')"></div>\n                    <div class="brush" style="background-color: #008744;" onclick="changeColor(\'#008744\')"></div>\n                    <div class="brush" style="background-color: #0057e7;" onclick="changeColor(\'#0057e7\')"></div>\n                    <div class="brush" style="background-color: #a200ff;" onclick="changeColor(\'#a200ff\')"></div>\n                    <div class="brush" style="background-color: #ff00c1;" onclick="changeColor(\'#ff00c1\')"></div>\n                    <div class="brush" style="background-color: #ffffff; border: 1px solid lightgray;" onclick="changeColor(\'#ffffff\')"></div>\n                    <div class="brush" style="background-color: #646765; border: 1px solid lightgray;" onclick="changeColor(\'#646765\')"></div>\n                    <div class="brush" style="background-color: black;" onclick="changeColor(\'black\')"></div>\n                </div>\n                <div style="margin-top: 10px;">\n                    Brush size: <input type="range" id="strokeSizeSlider" min="15" max="30" value="2" style="width: 200px;" >\n                    <button id="brushButton" class="tool-button" onclick="selectTool(\'brush\')">Brush</button>\n                    <button id="eraserButton" class="tool-button" onclick="selectTool(\'eraser\')">Eraser</button>\n                </div>\n\n\n\n                <script src="'
+    yield escape(context.call((undefined(name='asset_url') if l_0_asset_url is missing else l_0_asset_url), 'canvas.js'))
+    yield '"></script>\n\n\n                </div>\n                <div class="divider"></div>\n                <!-- Visual Metaphor section starts here -->\n                <div class="right">\n                    <h1>Visual Metaphor</h1>\n                    <form onsubmit="return generateImage(event);">\n                        <label for="description" class="helper-text">\n                            I\'m here to help you express your emotions. <br> \n                            Please describe what you drew on the canvas! <br>\n                        </label><br>\n                        <input type="text" id="description" autocomplete="off" style="width: 400px; padding: 5px; margin-top: 10px;" placeholder="Describe your drawing..." />\n                        <input type="submit" value="Generate" class="button-style" />\n                        <br>\n                        <label style="font-size: 14px;">\n                            <input type="checkbox" id="freshImages" /> Always make brand new pictures\n                        </label>\n                    </form>\n                    <!-- Loading indicator placed right below the form -->\n                    <div id="loading" style="display: none; text-align: center;">\n                        <div class="spinner"></div>\n                        <p id="loadingText">Loading...</p>\n                    </div>\n                    <div id="images">\n                        <!-- Dynamically added images will go here -->\n                    </div>\n                    <div id="reappraisalText" style="padding: 20px; font-size: 18px; line-height: 1.6; color: black;">\n                        <!-- Reappraisal text will appear here -->\n                    </div>\n                    <input type="button" \n                           value="View Reflections" \n                           class="button-style" \n                           style="background-color: #f3f4f6; color: black;" \n                           onclick="location.href=\'/reflection\'" />\n                    <div id="reflectionContainer" style="display: none; margin-top: 20px; padding: 10px; border-radius: 10px; background-color: white; box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);">\n                        <!-- Reflections will be added dynamically here -->\n                    </div>\n                </div>\n\n\n        </body>\n    </html>'
+
+blocks = {}
+debug_info = '5=17&8=19&14=21&15=23&21=25&44=29'
\ No newline at end of file
@@ -0,0 +1,31 @@
+from jinja2.runtime import LoopContext, Macro, Markup, Namespace, TemplateNotFound, TemplateReference, TemplateRuntimeError, Undefined, escape, identity, internalcode, markup_join, missing, str_join
+name = 'reflection-e09b86ef6a57.html'
+
+def root(context, missing=missing):
+    resolve = context.resolve_or_missing
+    undefined = environment.undefined
+    concat = environment.concat
+    cond_expr_undefined = Undefined
+    if 0: yield None
+    l_0_asset_url = resolve('asset_url')
+    l_0_responses = resolve('responses')
+    l_0_has_entries = resolve('has_entries')
+    try:
+        t_1 = environment.filters['safe']
+    except KeyError:
+        @internalcode
+        def t_1(*unused):
+            raise TemplateRuntimeError("No filter named 'safe' found.")
+    pass
+    yield '\n    <html>\n        <head>\n            <title>Your Reflections</title>\n            <link rel="stylesheet" href="'
+    yield escape(context.call((undefined(name='asset_url') if l_0_asset_url is missing else l_0_asset_url), 'reflection.css'))
+    yield '">\n        </head>\n        <body>\n            <h1>Here is what your kids thought about today.</h1>\n            <div class="responses">'
+    yield escape(t_1((undefined(name='responses') if l_0_responses is missing else l_0_responses)))
+    yield '</div>\n            <button class="button-style" style="margin-top: 20px;" onclick="window.location.href=\'/\'">Restart Session</button>\n            '
+    if (undefined(name='has_entries') if l_0_has_entries is missing else l_0_has_entries):
+        pass
+        yield '\n            <button class="button-style" style="margin-top: 20px;" onclick="window.location.href=\'/reflection.pdf\'">Save as PDF</button>\n            '
+    yield '\n        </body>\n    </html>'
+
+blocks = {}
+debug_info = '5=21&9=23&11=25'
\ No newline at end of file
@@ -1,13 +1,126 @@
-from flask import Flask, request, jsonify, make_response, render_template_string, session
-import requests
+from flask import Flask, request, jsonify, session, g, Response, send_file, stream_with_context
 import base64
-import openai
+import contextlib
 from io import BytesIO
-from PIL import Image
 import os
+import random
+import tempfile
+import json
+import hashlib
+import re
+import sys
+import threading
+import time
+import uuid
+import contextvars
+import functools
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from jinja2 import ModuleLoader, TemplateNotFound
+from colors import ColorAnalyzer, hex_to_rgb, rasterize_strokes
+from cache import LRUCache, SingleFlight
+from question_pool import QuestionPool
+from resilience import OPEN, CircuitOpen, Guard
+from keypool import KeyPool, KeysExhausted
+from jobs import JobQueue, QueueFull
+from assets import AssetManifest, compress_response
+from sessions import ServerSideSessionInterface, make_session_interface
+from prompt_context import ContextBuilder, count_tokens
+from lazy import LazyModule
+import metrics
+import reflection
+import upstream
+
+# vercel.json sends every request to this module, so each new instance pays
+# for what it imports. The heavy libraries are imported by the first request
+# that uses them: openai (and aiohttp under it) by completions, requests by
+# upstream calls, PIL by the proxy and pixel uploads.
+requests = LazyModule('requests')
+Image = LazyModule('PIL.Image')
+
+# OpenAI calls are spread over the keys in OPENAI_API_KEYS (comma separated),
+# or made with OPENAI_API_KEY alone. Each call passes its key to the client;
+# openai.api_key is never set.
+OPENAI_API_KEYS = [key.strip() for key in os.environ.get('OPENAI_API_KEYS', '').split(',') if key.strip()]
+if not OPENAI_API_KEYS and os.environ.get('OPENAI_API_KEY'):
+    OPENAI_API_KEYS = [os.environ['OPENAI_API_KEY']]
 
 app = Flask(__name__)
-app.secret_key = os.environ.get('OPENAI_API_KEY')
+app.secret_key = os.environ.get('OPENAI_API_KEY') or next(iter(OPENAI_API_KEYS), None)
+
+
+def use_upstream_session(module):
+    # Completions go through the same pooled keep-alive session as everything
+    # else
+    module.requestssession = upstream.session
+
+
+openai = LazyModule('openai', configure=use_upstream_session)
+
+# Each key gets token buckets per kind of call (keypool.KeyPool), starting
+# from these per-minute limits and then kept to the x-ratelimit-* headers
+# and 429s upstream answers with. A call waits up to OPENAI_KEY_MAX_WAIT
+# seconds for a key with room before giving up.
+OPENAI_KEY_MAX_WAIT = float(os.environ.get('OPENAI_KEY_MAX_WAIT', 5))
+completion_keys = KeyPool(
+    'completions', OPENAI_API_KEYS,
+    requests_per_minute=float(os.environ.get('OPENAI_KEY_REQUESTS_PER_MINUTE', 3500)),
+    tokens_per_minute=float(os.environ.get('OPENAI_KEY_TOKENS_PER_MINUTE', 90000)),
+    max_wait=OPENAI_KEY_MAX_WAIT,
+)
+image_keys = KeyPool(
+    'images', OPENAI_API_KEYS,
+    requests_per_minute=float(os.environ.get('OPENAI_KEY_IMAGES_PER_MINUTE', 50)),
+    max_wait=OPENAI_KEY_MAX_WAIT,
+)
+
+
+def observe_openai_response(url, authorization, status, headers):
+    # Hands a response to the pool of the key it was made with
+    if '/images/generations' in url:
+        image_keys.observe(authorization, status, headers)
+    elif '/completions' in url:
+        completion_keys.observe(authorization, status, headers)
+
+
+upstream.add_response_hook(
+    lambda response, *args, **kwargs: observe_openai_response(
+        response.url, response.request.headers.get('Authorization'), response.status_code, response.headers))
+
+
+def completion_tokens(completion_args):
+    # What a completion counts against its key's tokens per minute
+    return count_tokens(completion_args['prompt']) + completion_args['max_tokens'] * completion_args.get('n', 1)
+
+
+def is_rate_limit(error):
+    # A 429, from the openai client or a requests call
+    if isinstance(error, openai.error.RateLimitError):
+        return True
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code == 429
+
+
+def with_openai_key(pool, call, tokens=0):
+    # call(api_key) with the pool's best key. A 429 moves the call to
+    # another key (or waits out the Retry-After), in place of the retries
+    # upstream's session makes for other hosts.
+    return pool.call(call, tokens, is_rate_limit, attempts=len(pool) + upstream.MAX_RETRIES)
+
+
+def create_completion(completion_args):
+    def create(api_key):
+        return openai.Completion.create(api_key=api_key, **completion_args)
+
+    return with_openai_key(completion_keys, create, completion_tokens(completion_args))
+
+
+# Signed-cookie sessions unless a server-side store is asked for, see
+# sessions.py for the trade-off
+session_interface = make_session_interface(os.environ.get('SESSION_BACKEND', 'cookie'))
+if session_interface is not None:
+    app.session_interface = session_interface
 
 # Define the fixed set of colors that can be used in the brush
 BRUSH_COLORS = {
@@ -23,50 +136,590 @@ BRUSH_COLORS = {
     '#000000': 'black'
 }
 
+color_analyzer = ColorAnalyzer(BRUSH_COLORS)
+
+# Upstream OpenAI calls that belong to one request run side by side here
+upstream_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('UPSTREAM_WORKERS', 16)))
+
+# Each OpenAI operation is hedged past its p95 and has a circuit breaker
+# (resilience.Guard); while a breaker is open, canned fallbacks are served.
+# UPSTREAM_HEDGE=0 turns hedging off. A hedged call's first attempt and its
+# hedge each run on a thread of their own pool, split between the operations
+# so none waits for a thread; past its share a call isn't hedged.
+GUARDED_OPERATIONS = ('questions', 'question_stream', 'reappraisal', 'dalle')
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 32))
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='upstream-hedge')
+ATTEMPT_WORKERS = int(os.environ.get('HEDGED_ATTEMPT_WORKERS', 64))
+attempt_executor = ThreadPoolExecutor(max_workers=ATTEMPT_WORKERS, thread_name_prefix='upstream-attempt')
+
+
+def error_status(error):
+    # The HTTP status an upstream error carries: openai's errors,
+    # requests.HTTPError, asgi's UpstreamStatusError. None without one.
+    status = getattr(error, 'http_status', None) or getattr(error, 'status', None)
+    response = getattr(error, 'response', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    return status
+
+
+def is_upstream_failure(error):
+    # What counts against a breaker: 5xx answers, timeouts and connection
+    # errors. A request upstream turned down (4xx: a content-policy 400 on a
+    # child's description, a 401, a 429) says nothing about its health, and
+    # KeysExhausted is our own back-pressure: no call was made.
+    if isinstance(error, KeysExhausted):
+        return False
+    status = error_status(error)
+    return status is None or status >= 500
+
+
+def make_guard(name, **options):
+    return Guard(
+        name, hedge_executor,
+        hedge=os.environ.get('UPSTREAM_HEDGE', '1') != '0',
+        failures=int(os.environ.get('BREAKER_FAILURES', 5)),
+        cooldown=float(os.environ.get('BREAKER_COOLDOWN', 30)),
+        max_hedges=max(1, HEDGE_WORKERS // len(GUARDED_OPERATIONS)),
+        is_failure=is_upstream_failure,
+        attempt_executor=attempt_executor,
+        max_attempts=max(1, ATTEMPT_WORKERS // len(GUARDED_OPERATIONS)),
+        **options,
+    )
+
+
+upstream_guards = {name: make_guard(name) for name in ('questions', 'reappraisal', 'dalle')}
+# A streamed question is timed to its first text, not to a whole completion,
+# so it is hedged from a latency window of its own. It fails with the other
+# questions, though: one breaker for both.
+upstream_guards['question_stream'] = make_guard(
+    'question_stream', breaker=upstream_guards['questions'].breaker,
+    discard=lambda opened: close_question_stream(opened))
+
+# Seconds /api/process-drawing waits for DALL-E and the reappraisal text together
+PROCESS_DRAWING_DEADLINE = float(os.environ.get('PROCESS_DRAWING_DEADLINE', 30))
+
+# Images and reappraisal texts are reused for matching descriptions and colors.
+# DALL-E image URLs stop working after about an hour, so entries must expire
+# well before that.
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 1800))
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 4 * 1024 * 1024))
+response_cache = LRUCache(RESPONSE_CACHE_BYTES, sizeof=lambda value: len(json.dumps(value)), ttl=RESPONSE_CACHE_TTL)
+
+
+# Identical generations that are already running are joined rather than
+# started again, e.g. a whole class pressing Generate on the same description
+GENERATION_MAX_WAITERS = int(os.environ.get('GENERATION_MAX_WAITERS', 32))
+generation_flights = SingleFlight(max_waiters=GENERATION_MAX_WAITERS)
+
+
+def cached_generation(key, fresh, generate, is_usable):
+    # fresh skips the lookup; a usable fresh result still refreshes the cache
+    if not fresh:
+        value = response_cache.get(key)
+        if value is not None:
+            return value
+
+    def generate_and_store():
+        value = generate()
+        if is_usable(value):
+            response_cache.set(key, value)
+        return value
+
+    return generation_flights.do(key, generate_and_store)
+
+# Every generated image is requested through /proxy at least twice, so recent
+# ones are kept in memory and concurrent fetches of the same URL are shared
+PROXY_CACHE_BYTES = int(os.environ.get('PROXY_CACHE_BYTES', 64 * 1024 * 1024))
+proxy_cache = LRUCache(PROXY_CACHE_BYTES, sizeof=lambda entry: len(entry['content']))
+proxy_fetches = SingleFlight()
+
+
+class ProxyFetchError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Upstream image request failed with status {status_code}")
+        self.status_code = status_code
+
+
+def fetch_proxied_image(image_url):
+    entry = proxy_cache.get(image_url)
+    if entry is not None:
+        return entry
+
+    def fetch():
+        with metrics.timed('proxy_fetch'):
+            response = upstream.session.get(image_url, timeout=upstream.TIMEOUT)
+        if not response.ok:
+            raise ProxyFetchError(response.status_code)
+        fetched = make_proxy_entry(response.content, response.headers.get('Content-Type'))
+        proxy_cache.set(image_url, fetched)
+        return fetched
+
+    return proxy_fetches.do(image_url, fetch)
+
+
+def make_proxy_entry(content, content_type):
+    if not content_type or not content_type.startswith('image/'):
+        content_type = sniff_image_type(content)
+    return {
+        'content': content,
+        'content_type': content_type,
+        'etag': hashlib.sha1(content).hexdigest(),
+    }
+
+
+def sniff_image_type(content):
+    if content.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if content.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'image/webp'
+    if content.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+# Smaller and lighter variants of proxied images: /proxy?url=...&w=256&fmt=webp.
+# Widths snap up to the next size here so only a few variants get cached.
+# Without fmt, or with fmt=auto, the format follows the Accept header.
+PROXY_VARIANT_WIDTHS = (64, 128, 256, 512)
+PROXY_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True}),
+    'png': ('PNG', 'image/png', {'optimize': True}),
+}
+
+
+def proxy_variant(args, accept_mimetypes):
+    # Returns (width or None, format or None, whether the format was picked
+    # from Accept); (None, None, False) asks for the original bytes
+    width, fmt = args.get('w'), args.get('fmt')
+    if width is None and fmt is None:
+        return None, None, False
+    if width is not None:
+        try:
+            width = int(width)
+        except ValueError:
+            raise ValueError(f"w must be a number of pixels, not {width!r}")
+        if width <= 0:
+            raise ValueError("w must be positive")
+        width = next((size for size in PROXY_VARIANT_WIDTHS if size >= width), PROXY_VARIANT_WIDTHS[-1])
+    negotiated = fmt in (None, 'auto')
+    if negotiated:
+        # Only an explicit image/webp counts; image/* is sent by browsers without it
+        fmt = 'webp' if any(value == 'image/webp' for value, quality in accept_mimetypes if quality > 0) else 'jpeg'
+    elif fmt not in PROXY_FORMATS:
+        raise ValueError(f"fmt must be one of {', '.join(PROXY_FORMATS)} or auto")
+    return width, fmt, negotiated
+
+
+@metrics.timed_function('transcode')
+def transcode_image(content, width, fmt):
+    image = Image.open(BytesIO(content))
+    if width is not None:
+        image.thumbnail((width, width), Image.LANCZOS)
+    pil_format, _, options = PROXY_FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode == 'P':
+        image = image.convert('RGBA')
+    output = BytesIO()
+    image.save(output, pil_format, **options)
+    return output.getvalue()
+
+
+def fetch_proxy_variant(image_url, width, fmt):
+    key = (image_url, width, fmt)
+    entry = proxy_cache.get(key)
+    if entry is not None:
+        return entry
+
+    def transcode():
+        original = fetch_proxied_image(image_url)
+        variant = make_proxy_entry(transcode_image(original['content'], width, fmt), PROXY_FORMATS[fmt][1])
+        proxy_cache.set(key, variant)
+        return variant
+
+    return proxy_fetches.do(key, transcode)
+
+
+def proxy_response(entry, request):
+    proxy_response = Response(entry['content'])
+    proxy_response.headers['Content-Type'] = entry['content_type']
+    proxy_response.headers['Access-Control-Allow-Origin'] = '*'
+    # The bytes behind a generated image URL never change
+    proxy_response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    proxy_response.set_etag(entry['etag'])
+    return proxy_response.make_conditional(request)
+
+
 @app.route('/proxy')
 def proxy_image():
     image_url = request.args.get('url')
-    response = requests.get(image_url)
-    proxy_response = make_response(response.content)
-    proxy_response.headers['Content-Type'] = 'image/jpeg'
-    proxy_response.headers['Access-Control-Allow-Origin'] = '*'
-    return proxy_response
+    if not image_url:
+        return jsonify({'error': 'Missing url parameter'}), 400
+    try:
+        width, fmt, negotiated = proxy_variant(request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if fmt is None:
+            entry = fetch_proxied_image(image_url)
+        else:
+            entry = fetch_proxy_variant(image_url, width, fmt)
+    except (ProxyFetchError, requests.exceptions.RequestException) as e:
+        print(f"Error proxying image: {str(e)}")
+        return jsonify({'error': str(e)}), 502
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"Error transcoding image: {str(e)}")
+        return jsonify({'error': 'Upstream content is not a readable image'}), 502
+    response = proxy_response(entry, request)
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+
+@app.route('/proxy/stats')
+def proxy_stats():
+    return jsonify({'cache': proxy_cache.stats(), 'fetches': proxy_fetches.stats()})
+
+
+@app.before_request
+def start_metrics():
+    g.metrics_started = metrics.start_request()
+
+
+@app.after_request
+def finish_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.finish_request(g.get('metrics_started'), route, request.method, response.status_code, response.headers)
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        return jsonify({'error': 'Metrics are turned off'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+for component, stats in {
+    'response_cache': lambda: response_cache.stats(),
+    'proxy_cache': lambda: proxy_cache.stats(),
+    'generations': lambda: generation_flights.stats(),
+    'opening_questions': lambda: opening_questions.stats(),
+    'question_prompts': lambda: context_builder.stats(),
+    'drawing_jobs': lambda: drawing_jobs.stats(),
+    'reflection_pdfs': lambda: reflection_pdfs.stats(),
+}.items():
+    metrics.register(component, stats)
+for name, guard in upstream_guards.items():
+    metrics.register(f'upstream_{name}', guard.stats)
+for pool in (completion_keys, image_keys):
+    for key in pool.keys:
+        metrics.register(f'openai_{pool.name}_{key.label}', functools.partial(pool.key_stats, key))
+
+
+@app.route('/upstream/stats')
+def upstream_stats():
+    return jsonify({
+        'pools': upstream.pool_stats(),
+        'opening_questions': opening_questions.stats(),
+        'question_prompts': context_builder.stats(),
+        'response_cache': response_cache.stats(),
+        'generations': generation_flights.stats(),
+        'drawing_jobs': drawing_jobs.stats(),
+        'reflection_pdfs': reflection_pdfs.stats(),
+        'guards': {name: guard.stats() for name, guard in upstream_guards.items()},
+        'keys': {pool.name: pool.stats() for pool in (completion_keys, image_keys)},
+    })
 
 @app.route('/api/process-drawing', methods=['POST'])
 def api_process_drawing():
     try:
-        data = request.get_json()
-        drawing_data = data['drawing']
-        text_description = data['description']
-
-        # Decode image from base64
-        image_data = base64.b64decode(drawing_data.split(',')[1])
-        image = Image.open(BytesIO(image_data)).convert('RGBA')
+        result = process_drawing(read_drawing(request))
+        record_drawing_result(session, result)
+        return jsonify(result)
+    except DrawingRejected as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        print(f"Error processing drawing: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        # Extract colors used in the drawing
-        raw_colors = {(r, g, b) for r, g, b, a in image.getdata() if a > 0}
-        raw_colors_hex = {f"#{r:02x}{g:02x}{b:02x}" for r, g, b in raw_colors}
-        used_colors_names = [BRUSH_COLORS[hex_color] for hex_color in raw_colors_hex if hex_color in BRUSH_COLORS]
 
-        # Generate prompt using colors and description
-        prompt = generate_prompt(text_description, used_colors_names)
-        print(f"Generated prompt for DALL-E: {prompt}")
+def record_drawing_result(sess, result):
+    # The reappraisal goes into the reflection; the images are remembered so
+    # the one the child picks can be added
+    if result['reappraisal_text']:
+        reflection.append(sess, 'reappraisal', result['reappraisal_text'])
+    sess['offered_images'] = result['image_urls']
+
+
+def process_drawing(data, progress=None):
+    # data is what read_drawing() returns. progress(stage) is told when the
+    # work moves on: 'colors', then 'generating', then 'images' or
+    # 'reappraisal' if one side finishes first.
+    progress = progress or (lambda stage: None)
+    text_description = data['description']
+
+    # Extract colors used in the drawing, most used first
+    progress('colors')
+    used_colors_names = drawing_colors(data)
+
+    # Generate prompt using colors and description
+    prompt = generate_prompt(text_description, used_colors_names)
+    print(f"Generated prompt for DALL-E: {prompt}")
+
+    # Generate the images and the reappraisal advice text at the same time,
+    # and answer with whatever is ready once the deadline passes
+    progress('generating')
+    fresh = data['fresh']
+    description_key, colors_key = prompt_cache_key(text_description, used_colors_names)
+    # The copied context carries the request's timings into the worker threads
+    images_future = upstream_executor.submit(
+        contextvars.copy_context().run, cached_generation, ('images', description_key, colors_key), fresh,
+        lambda: call_dalle_api(prompt, n=2), bool
+    )
+    text_future = upstream_executor.submit(
+        contextvars.copy_context().run, cached_generation, ('reappraisal', description_key), fresh,
+        lambda: generate_reappraisal_text(text_description),
+        lambda text: text not in REAPPRAISAL_FAILED_TEXTS
+    )
+    deadline = time.monotonic() + PROCESS_DRAWING_DEADLINE
+    done, pending = wait([images_future, text_future], timeout=PROCESS_DRAWING_DEADLINE, return_when=FIRST_COMPLETED)
+    if done and pending:
+        progress('images' if images_future in pending else 'reappraisal')
+        wait(pending, timeout=max(0, deadline - time.monotonic()))
+
+    image_urls = images_future.result() if images_future.done() else []
+    reappraisal_text = text_future.result() if text_future.done() else None
+    for future in (images_future, text_future):
+        future.cancel()
+    return drawing_result(image_urls, reappraisal_text)
+
+
+# Job mode: the drawing is processed in the background and the client polls
+# for the result, so no request is held open for the whole generation.
+# Jobs live in the memory of the process that accepted them, so they are off
+# where the poll may reach another instance or find this one frozen after
+# its 202: on Vercel by default, or with DRAWING_JOBS=0 (e.g. several
+# workers). The page then waits on /api/process-drawing instead.
+DRAWING_JOBS = os.environ.get('DRAWING_JOBS', '0' if os.environ.get('VERCEL') else '1') == '1'
+drawing_jobs = JobQueue(
+    process_drawing,
+    workers=int(os.environ.get('DRAWING_JOB_WORKERS', 8)),
+    max_queued=int(os.environ.get('DRAWING_JOB_QUEUE_LIMIT', 64)),
+    ttl=float(os.environ.get('DRAWING_JOB_TTL', 600)),
+)
+
+
+@app.route('/api/process-drawing/jobs', methods=['POST'])
+def api_process_drawing_job():
+    if not DRAWING_JOBS:
+        return jsonify({'error': 'Drawing jobs are off, use /api/process-drawing'}), 404
+    try:
+        data = read_drawing(request)
+    except DrawingRejected as e:
+        return jsonify({'error': str(e)}), e.status_code
+    # The upload's own buffers are closed with the request
+    if data['drawing'] is not None:
+        data['drawing'] = BytesIO(data['drawing'].read())
+    try:
+        job_id = drawing_jobs.submit(data)
+    except QueueFull as e:
+        return jsonify({'error': f"Too many drawings in progress: {str(e)}"}), 503, {'Retry-After': '5'}
+    # Its result is added to this session's reflection when it's polled
+    session['drawing_jobs'] = session.get('drawing_jobs', [])[-4:] + [job_id]
+    return jsonify({'job_id': job_id, 'status_url': f'/api/process-drawing/jobs/{job_id}'}), 202
+
+
+@app.route('/api/process-drawing/jobs/<job_id>', methods=['GET'])
+def api_process_drawing_job_status(job_id):
+    job = drawing_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    if job['status'] == 'done' and job_id in session.get('drawing_jobs', ()):
+        session['drawing_jobs'] = [other for other in session['drawing_jobs'] if other != job_id]
+        record_drawing_result(session, job['result'])
+    return jsonify(job), 200, {'Cache-Control': 'no-store'}
+
+
+# Drawings arrive as a PNG, either as the body itself (Content-Type
+# image/png, description and fresh in the query string), as the 'drawing'
+# file of a multipart form, or base64 in a data URL in JSON (the old way,
+# a third bigger on the wire and decoded through several copies). The page
+# sends palette-indexed PNGs over color_analyzer.palette, one byte a pixel,
+# whose colors are counted from the index histogram; any other PNG works too.
+# Or as the strokes that drew it, in JSON:
+#   {"canvas": [width, height], "strokes": [{"color": "#f44336", "width": 20,
+#    "points": [x0, y0, x1, y1, ...], "erase": false}, ...], "description": ...}
+# Colors are then measured from the stroke geometry, without any pixels.
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DATA_URL_PREFIX = 'data:image/png;base64,'
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 2 * 1024 * 1024))
+MAX_DRAWING_PIXELS = int(os.environ.get('MAX_DRAWING_PIXELS', 2000 * 2000))
+MAX_STROKE_POINTS = int(os.environ.get('MAX_STROKE_POINTS', 200000))
+MAX_STROKE_WIDTH = 200
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DrawingRejected(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@metrics.timed_function('parse')
+def read_drawing(request):
+    # Returns {'drawing': seekable file holding the PNG, 'description',
+    # 'fresh'}, or for strokes {'drawing': None, 'strokes', 'size', ...}.
+    # Payloads that are too big or aren't PNGs are turned away from their
+    # headers, before the image is decoded.
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if request.content_length is not None and request.content_length > limit:
+        raise DrawingRejected(f"Drawing is larger than {limit} bytes", 413)
+
+    if request.mimetype == 'image/png':
+        fields = request.args
+        png = BytesIO()
+        head = request.stream.read(len(PNG_SIGNATURE))
+        if head != PNG_SIGNATURE:
+            raise DrawingRejected("Drawing must be a PNG", 415)
+        png.write(head)
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            png.write(chunk)
+            if png.tell() > limit:
+                raise DrawingRejected(f"Drawing is larger than {limit} bytes", 413)
+        png.seek(0)
+    elif request.mimetype == 'multipart/form-data':
+        fields = request.form
+        upload = request.files.get('drawing')
+        if upload is None:
+            raise DrawingRejected("Missing drawing")
+        png = upload.stream
+    else:
+        fields = request.get_json(silent=True) or {}
+        if 'strokes' in fields:
+            if 'description' not in fields:
+                raise DrawingRejected("Missing description")
+            strokes, size = read_strokes(fields.get('strokes'), fields.get('canvas'))
+            return {
+                'drawing': None,
+                'strokes': strokes,
+                'size': size,
+                'description': fields['description'],
+                'fresh': fields.get('fresh') in (True, '1', 'true', 'on'),
+            }
+        data_url = fields.get('drawing')
+        if not isinstance(data_url, str) or not data_url.startswith(DATA_URL_PREFIX):
+            raise DrawingRejected("Missing drawing, or it isn't a PNG data URL", 415 if data_url else 400)
+        with metrics.timed('b64decode'):
+            png = BytesIO(base64.b64decode(data_url[len(DATA_URL_PREFIX):]))
+
+    if 'description' not in fields:
+        raise DrawingRejected("Missing description")
+    open_drawing(png)
+    png.seek(0)
+    return {
+        'drawing': png,
+        'description': fields['description'],
+        'fresh': fields.get('fresh') in (True, '1', 'true', 'on'),
+    }
+
+
+def read_strokes(strokes, canvas):
+    # The JSON strokes as [{'color': (r, g, b), 'width', 'points': [(x, y)],
+    # 'erase'}] and the canvas (width, height)
+    try:
+        width, height = (int(n) for n in canvas)
+    except (TypeError, ValueError):
+        raise DrawingRejected("Missing canvas size, or it isn't [width, height]")
+    if width <= 0 or height <= 0:
+        raise DrawingRejected(f"Canvas is {width}x{height}")
+    if width * height > MAX_DRAWING_PIXELS:
+        raise DrawingRejected(f"Canvas is {width}x{height}, more than {MAX_DRAWING_PIXELS} pixels", 413)
+    if not isinstance(strokes, list):
+        raise DrawingRejected("Strokes must be a list")
+
+    parsed = []
+    total_points = 0
+    for stroke in strokes:
+        try:
+            color = hex_to_rgb(stroke['color']) if not stroke.get('erase') else (0, 0, 0)
+            line_width = float(stroke['width'])
+            coordinates = [float(n) for n in stroke['points']]
+        except (TypeError, ValueError, KeyError, AttributeError):
+            raise DrawingRejected("Each stroke needs a #rrggbb color, a width and a list of points")
+        if not 0 < line_width <= MAX_STROKE_WIDTH or not coordinates or len(coordinates) % 2:
+            raise DrawingRejected(f"Stroke widths go up to {MAX_STROKE_WIDTH} and points come in x, y pairs")
+        total_points += len(coordinates) // 2
+        if total_points > MAX_STROKE_POINTS:
+            raise DrawingRejected(f"Drawing has more than {MAX_STROKE_POINTS} stroke points", 413)
+        parsed.append({
+            'color': color,
+            'width': line_width,
+            'points': list(zip(coordinates[::2], coordinates[1::2])),
+            'erase': bool(stroke.get('erase')),
+        })
+    return parsed, (width, height)
+
+
+def open_drawing(png):
+    # Image.open only reads the header; the pixels are decoded on first use
+    if png.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise DrawingRejected("Drawing must be a PNG", 415)
+    png.seek(0)
+    try:
+        image = Image.open(png, formats=['PNG'])
+    except Exception:
+        raise DrawingRejected("Drawing is not a readable PNG", 415)
+    width, height = image.size
+    if width * height > MAX_DRAWING_PIXELS:
+        raise DrawingRejected(f"Drawing is {width}x{height}, more than {MAX_DRAWING_PIXELS} pixels", 413)
+    return image
+
+
+def drawing_colors(data):
+    # The brush colors of a drawing from read_drawing(), most used first
+    strokes = data.get('strokes')
+    if strokes is None:
+        with metrics.timed('png_decode'):
+            image = open_drawing(data['drawing'])
+            image.load()
+            # A palette-indexed PNG, as the page sends, is measured from its
+            # palette and index histogram as it is
+            if image.mode != 'P':
+                image = image.convert('RGBA')
+    elif any(stroke['erase'] for stroke in strokes):
+        # What an eraser took away depends on what was under it: only the
+        # pixels can tell
+        with metrics.timed('rasterize'):
+            image = rasterize_strokes(strokes, data['size'])
+    else:
+        with metrics.timed('colors'):
+            return color_analyzer.ranked_stroke_names(strokes, data['size'])
+    with metrics.timed('colors'):
+        return color_analyzer.ranked_names(image)
 
-        # Generate image using the DALL-E API
-        image_urls = call_dalle_api(prompt, n=2)
-        if not image_urls:
-            raise ValueError("Failed to generate images")
 
-        # Generate reappraisal advice text
-        reappraisal_text = generate_reappraisal_text(text_description)
-        print(f"Generated reappraisal text: {reappraisal_text}")
+def drawing_result(image_urls, reappraisal_text):
+    # reappraisal_text is None when it didn't arrive before the deadline
+    if not image_urls and reappraisal_text is None:
+        raise ValueError("Failed to generate images")
+    print(f"Generated reappraisal text: {reappraisal_text}")
 
-        return jsonify({'image_urls': image_urls, 'reappraisal_text': reappraisal_text})
-    except Exception as e:
-        print(f"Error processing drawing: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+    result = {'image_urls': image_urls, 'reappraisal_text': reappraisal_text or ''}
+    if not image_urls or reappraisal_text is None:
+        result['partial'] = True
+        result['retry'] = not image_urls
+    return result
 
 
+@metrics.timed_function('prompt')
 def generate_prompt(description, colors=None):
     if colors:
         color_description = ', '.join(colors)
@@ -85,44 +738,99 @@ def generate_prompt(description, colors=None):
     return prompt
 
 
+# Words that don't change what a description is about
+DESCRIPTION_FILLER_WORDS = {'a', 'an', 'the', 'my', 'is', 'it', 'its', 'very', 'really', 'so'}
+
+
+def prompt_cache_key(description, colors=None):
+    # Descriptions that only differ in case, punctuation, spacing or filler
+    # words ("sad cloud", "A sad cloud!") produce the same key, as do the same
+    # colors in a different order
+    words = re.findall(r"[a-z0-9']+", description.lower())
+    normalized = ' '.join(word for word in words if word not in DESCRIPTION_FILLER_WORDS)
+    return normalized, tuple(sorted(colors or ()))
+
+
+# Texts that stand in for a generated reappraisal; they are never cached.
+# The last one is served while the completions circuit is open.
+REAPPRAISAL_FAILED_TEXTS = (
+    "Could not generate a response. Please try again.",
+    "Could not generate reappraisal text.",
+    "Feelings are like weather: even the biggest storm cloud moves on, and the sun comes back out. "
+    "You were brave to draw yours!",
+)
+
+
+def reappraisal_completion_args(description):
+    return dict(
+        engine="gpt-3.5-turbo-instruct",
+        prompt=(
+            f"A child has described a feeling in this way: '{description}'. "
+            f"Please offer a single piece of positive reappraisal advice in response, "
+            f"beginning with a new, complete sentence that helps the child view the emotion in a brighter, hopeful way. "
+            f"Keep the language simple and friendly, and focus on encouragement and optimism."
+        ),
+        max_tokens=80,
+        request_timeout=upstream.TIMEOUT
+    )
+
+
+def reappraisal_text_from(response):
+    if 'choices' in response and len(response.choices) > 0:
+        return response.choices[0].text.strip()
+    else:
+        return REAPPRAISAL_FAILED_TEXTS[0]
+
+
 def generate_reappraisal_text(description):
+    completion_args = reappraisal_completion_args(description)
+
+    def attempt():
+        with metrics.timed('completion'):
+            return create_completion(completion_args)
+
     try:
-        response = openai.Completion.create(
-            engine="gpt-3.5-turbo-instruct",
-            prompt=(
-                f"A child has described a feeling in this way: '{description}'. "
-                f"Please offer a single piece of positive reappraisal advice in response, "
-                f"beginning with a new, complete sentence that helps the child view the emotion in a brighter, hopeful way. "
-                f"Keep the language simple and friendly, and focus on encouragement and optimism."
-            ),
-            max_tokens=80
-        )
-        if 'choices' in response and len(response.choices) > 0:
-            return response.choices[0].text.strip()
-        else:
-            return "Could not generate a response. Please try again."
+        return reappraisal_text_from(upstream_guards['reappraisal'].call(attempt))
+    except CircuitOpen:
+        return REAPPRAISAL_FAILED_TEXTS[2]
     except Exception as e:
         print(f"Error generating reappraisal text: {str(e)}")
-        return "Could not generate reappraisal text."
+        return REAPPRAISAL_FAILED_TEXTS[1]
 
 
-def call_dalle_api(prompt, n=2):
-    api_key = app.secret_key
+def dalle_request(prompt, n, api_key):
+    # URL, headers and JSON body of an image generation request
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     payload = {"prompt": prompt, "n": n, "size": "512x512"}
+    return f"{openai.api_base}/images/generations", headers, payload
 
-    try:
-        response = requests.post(
-            "https://api.openai.com/v1/images/generations",
+
+def dalle_image_urls(body):
+    images = body.get('data', [])
+    if not images:
+        print("No images returned from DALL-E.")
+    return [image['url'] for image in images]
+
+
+@metrics.timed_function('dalle')
+def call_dalle_api(prompt, n=2):
+    def generate(api_key):
+        url, headers, payload = dalle_request(prompt, n, api_key)
+        response = upstream.session.post(
+            url,
             json=payload,
-            headers=headers
+            headers=headers,
+            timeout=upstream.TIMEOUT
         )
         response.raise_for_status()
-        images = response.json().get('data', [])
-        if not images:
-            print("No images returned from DALL-E.")
-        return [image['url'] for image in images]
-    except requests.exceptions.RequestException as e:
+        return response.json()
+
+    def attempt():
+        return with_openai_key(image_keys, generate)
+
+    try:
+        return dalle_image_urls(upstream_guards['dalle'].call(attempt))
+    except (requests.exceptions.RequestException, CircuitOpen, KeysExhausted) as e:
         print(f"Error from OpenAI API: {e}")
         return []
 
@@ -134,352 +842,365 @@ predefined_sentences = {
 }
 
 
-def generate_art_therapy_question(api_key, question_number, session_history):
-    openai.api_key = api_key
-    question_prompts = [
-        "Generate a question to ask user (children) about their current emotion. Do not use 'kiddo'.",
-        "Based on the previous responses, generate a short question for identifying and describing the emotion, such as asking about the intensity of the emotion or where in the body it is felt the most. Users are kids, so please use easy and friendly expressions.",
-        "Based on the previous responses, generate a short question that explores the context, such as asking what triggered this emotion or describing the situation or thought that led to these feelings. Users are kids, so please use easy and friendly expressions.",
-        "Based on the previous responses, generate a short question that asks the user to describe and visualize their emotion as an 'abstract shape or symbol' to create their own metaphor for their mind. Users are kids, so please use easy and friendly expressions, and provide some metaphors or examples.",
-        "Based on the previous responses, generate a short question that asks the user to describe and visualize their emotions as a 'texture' to create their own metaphor for their mind. Users are kids, so please use easy and friendly expressions, and provide some metaphors or examples.",
-        "Based on the previous responses, provide a summary of user's response. Then, provide a personalized cognitive reappraisal advice to help think about the situation that user described in the previous response in a more positive way. Or, if user's previous response was already positive, please assist user to think about the good things they might learn from this experience. Please incorporating a playful and engaging approach consistent with CBT theory. Make sure the advice is directly relevant to the emotions and situations described by the child, using examples or activities that are fun and easy for kids to understand. Also, make this less than four sentences."
-    ]
-    
-    user_responses = " ".join([resp for who, resp in session_history if who == 'You'])
-    context = f"Based on the user's previous responses: {user_responses}"
+QUESTION_PROMPTS = [
+    "Generate a question to ask user (children) about their current emotion. Do not use 'kiddo'.",
+    "Based on the previous responses, generate a short question for identifying and describing the emotion, such as asking about the intensity of the emotion or where in the body it is felt the most. Users are kids, so please use easy and friendly expressions.",
+    "Based on the previous responses, generate a short question that explores the context, such as asking what triggered this emotion or describing the situation or thought that led to these feelings. Users are kids, so please use easy and friendly expressions.",
+    "Based on the previous responses, generate a short question that asks the user to describe and visualize their emotion as an 'abstract shape or symbol' to create their own metaphor for their mind. Users are kids, so please use easy and friendly expressions, and provide some metaphors or examples.",
+    "Based on the previous responses, generate a short question that asks the user to describe and visualize their emotions as a 'texture' to create their own metaphor for their mind. Users are kids, so please use easy and friendly expressions, and provide some metaphors or examples.",
+    "Based on the previous responses, provide a summary of user's response. Then, provide a personalized cognitive reappraisal advice to help think about the situation that user described in the previous response in a more positive way. Or, if user's previous response was already positive, please assist user to think about the good things they might learn from this experience. Please incorporating a playful and engaging approach consistent with CBT theory. Make sure the advice is directly relevant to the emotions and situations described by the child, using examples or activities that are fun and easy for kids to understand. Also, make this less than four sentences."
+]
 
+
+# Keeps the conversation part of question prompts within a token budget
+context_builder = ContextBuilder()
+
+
+@metrics.timed_function('prompt')
+def build_question_prompt(question_number, session_history, context_state=None):
+    # context_state caches the summary of older turns between questions;
+    # pass the same dict (kept in the session) every time
+    conversation = context_builder.build(session_history, {} if context_state is None else context_state)
+    if conversation:
+        prompt_text = f"Based on the conversation so far:\n{conversation}\n\n{QUESTION_PROMPTS[question_number - 1]}"
+    else:
+        prompt_text = QUESTION_PROMPTS[question_number - 1]
+    prompt_tokens = count_tokens(prompt_text)
+    context_builder.record(prompt_tokens)
+    print(f"Question {question_number} prompt: {prompt_tokens} tokens")
+    return prompt_text
+
+
+def question_prefix(question_number):
+    if question_number in predefined_sentences:
+        return f"Question {question_number}: {predefined_sentences[question_number]} "
+    return f"Question {question_number}: "
+
+
+def question_completion_args(prompt_text, **extra):
+    return dict(
+        engine="gpt-3.5-turbo-instruct",
+        prompt=prompt_text,
+        max_tokens=180,
+        n=1,
+        temperature=0.7,
+        request_timeout=upstream.TIMEOUT,
+        **extra
+    )
+
+
+def generate_art_therapy_question(question_number, session_history, context_state=None):
     if 1 <= question_number <= 6:
-        prompt_text = f"{context} {question_prompts[question_number - 1]}"
-        response = openai.Completion.create(
-            engine="gpt-3.5-turbo-instruct",
-            prompt=prompt_text,
-            max_tokens=180,
-            n=1,
-            temperature=0.7
-        )
-        question_text = response.choices[0].text.strip()
+        prompt_text = build_question_prompt(question_number, session_history, context_state)
+        completion_args = question_completion_args(prompt_text)
 
-        if question_number in predefined_sentences:
-            full_question_text = f"Question {question_number}: {predefined_sentences[question_number]} {question_text}"
-        else:
-            full_question_text = f"Question {question_number}: {question_text}"
+        def attempt():
+            with metrics.timed('completion'):
+                return create_completion(completion_args)
 
-        return full_question_text
+        response = upstream_guards['questions'].call(attempt)
+        question_text = response.choices[0].text.strip()
+        return f"{question_prefix(question_number)}{question_text}"
     else:
         return "Do you want to restart the session?"
 
 
+def stream_art_therapy_question(question_number, session_history, context_state=None):
+    # Same question as generate_art_therapy_question, yielded piece by piece
+    # as the completion streams in. The prompt is built right away, while
+    # the session can still be updated; the completion starts on first use.
+    if not 1 <= question_number <= 6:
+        return iter(["Do you want to restart the session?"])
+    prompt_text = build_question_prompt(question_number, session_history, context_state)
+    return _stream_question(question_number, prompt_text)
+
+
+def _stream_question(question_number, prompt_text):
+    # The key is leased before anything is sent, so without one the whole
+    # fallback question goes out. If the call is turned away after the
+    # prefix, the rest of the fallback follows it.
+    completion_args = question_completion_args(prompt_text, stream=True)
+    with contextlib.ExitStack() as stack:
+        try:
+            api_key = stack.enter_context(completion_keys.lease(completion_tokens(completion_args)))
+        except KeysExhausted:
+            yield fallback_question(question_number)
+            return
+        prefix = question_prefix(question_number)
+        yield prefix
+        stack.enter_context(metrics.timed('completion_stream'))
+        # The first attempt streams with that key; a hedge leases its own
+        first_key = iter([api_key])
+        try:
+            opened = upstream_guards['question_stream'].call(
+                lambda: open_question_stream(next(first_key, None), completion_args))
+        except (CircuitOpen, KeysExhausted):
+            fallback = fallback_question(question_number)
+            yield fallback[len(prefix):] if fallback.startswith(prefix) else fallback
+            return
+        stack.callback(close_question_stream, opened)
+        first, chunks, _ = opened
+        if first:
+            yield first
+        for chunk in chunks:
+            text = chunk.choices[0].text if chunk.choices else ''
+            if text:
+                yield text
+
+
+def open_question_stream(api_key, completion_args):
+    # Starts a streamed completion and waits for its first text, as one
+    # guarded call: a stream slow to start is hedged, and its failures count
+    # against the breaker, like the whole completion on the other routes.
+    # Without api_key a key is leased for the stream, until it's closed.
+    # Returns (first text, the remaining chunks, what to close), leading
+    # whitespace dropped like strip() does for the full text.
+    held = contextlib.ExitStack()
+    try:
+        if api_key is None:
+            api_key = held.enter_context(completion_keys.lease(completion_tokens(completion_args)))
+        chunks = openai.Completion.create(api_key=api_key, **completion_args)
+        held.callback(chunks.close)
+        for chunk in chunks:
+            text = chunk.choices[0].text.lstrip() if chunk.choices else ''
+            if text:
+                return text, chunks, held
+        return '', chunks, held
+    except BaseException:
+        held.close()
+        raise
+
+
+def close_question_stream(opened):
+    # Drops an opened stream's connection and returns its key, if it leased one
+    opened[2].close()
+
+
+# Question 1 has no session context, so it is generated ahead of time and
+# handed out from a pool instead of making page loads wait on the API
+OPENING_QUESTION_FALLBACKS = [
+    "Question 1: How are you feeling right now? You can use any words you like!",
+    "Question 1: What kind of feeling is visiting you today?",
+    "Question 1: If your feeling had a name today, what would it be?",
+]
+opening_questions = QuestionPool(
+    lambda: generate_art_therapy_question(1, []),
+    size=int(os.environ.get('QUESTION_POOL_SIZE', 8)),
+    refill_workers=int(os.environ.get('QUESTION_POOL_REFILL_WORKERS', 2)),
+    ttl=float(os.environ.get('QUESTION_POOL_TTL', 3600)),
+    fallbacks=OPENING_QUESTION_FALLBACKS,
+)
+# Filled at startup, except on serverless (Vercel sets VERCEL=1) where the
+# instance may be frozen as soon as it answers: there the first take()
+# starts the refill, after the first request rather than racing it
+QUESTION_POOL_PREFILL = os.environ.get('QUESTION_POOL_PREFILL', '0' if os.environ.get('VERCEL') else '1') == '1'
+if QUESTION_POOL_PREFILL and opening_questions.size and completion_keys:
+    opening_questions.refill()
+
+
+def is_opening_question(question_number, session_history):
+    return question_number == 1 and not any(who == 'You' for who, _ in session_history)
+
+
+# Served for questions 2 to 6 while the questions circuit is open
+QUESTION_FALLBACKS = {
+    2: "How big is this feeling, and where in your body do you feel it the most?",
+    3: "What happened just before this feeling came along?",
+    4: "If your feeling were a shape or a symbol, what would it look like? Maybe a spiky star or a round, soft cloud?",
+    5: "If you could touch your feeling, what would it feel like? Fluffy like a cloud, or rough like sandpaper?",
+    6: "You did a great job telling me about your feeling. What is one kind thing you could do for yourself today?",
+}
+
+
+def fallback_question(question_number):
+    if question_number == 1:
+        return random.choice(OPENING_QUESTION_FALLBACKS)
+    return f"{question_prefix(question_number)}{QUESTION_FALLBACKS[question_number]}"
+
+
+def next_question(question_number, session_history, context_state=None):
+    if opening_questions.size and is_opening_question(question_number, session_history):
+        return opening_questions.take()
+    try:
+        return generate_art_therapy_question(question_number, session_history, context_state)
+    except (CircuitOpen, KeysExhausted):
+        return fallback_question(question_number)
+
+
+def session_context_state(sess=None):
+    # Cached summary of older turns, see ContextBuilder.build
+    return (session if sess is None else sess).setdefault('context_summary', {})
+
+
+def begin_question_turn(sess, user_response):
+    # Records the answer and moves the session on to the next question, or
+    # back to question 1 after the last one. Returns the number and history
+    # to generate the next question from, whether the session restarted and
+    # the progress to show.
+    sess['history'] = sess.get('history', [])
+    sess['question_number'] = sess.get('question_number', 1)
+    sess['history'].append(('You', user_response))
+    reflection.append(sess, 'answer', user_response)
+
+    restart = sess['question_number'] > 6
+    if restart:
+        sess.clear()
+        sess['history'] = []
+        sess['question_number'] = 1
+    question_number = sess['question_number']
+    history = list(sess['history'])
+    if not restart:
+        sess['question_number'] += 1
+    progress = 0 if restart else (sess['question_number'] - 1) / 6 * 100
+    # Until its question is added, so a failed stream can be retried
+    sess['pending_turn'] = {'question_number': question_number, 'restart': restart, 'progress': progress}
+    return question_number, history, restart, progress
+
+
+def question_turn(sess, data):
+    # begin_question_turn for the posted answer. With 'retry', sent after a
+    # streamed question failed, the turn that stream began instead: its
+    # answer is already in the history.
+    turn = sess.get('pending_turn') if data.get('retry') else None
+    if turn:
+        return turn['question_number'], list(sess.get('history', [])), turn['restart'], turn['progress']
+    return begin_question_turn(sess, data.get('response', ''))
+
+
+def add_question(sess, question_text):
+    sess.pop('pending_turn', None)
+    sess.setdefault('history', []).append(('Therapist', question_text))
+    reflection.append(sess, 'question', question_text)
+
+
+# Streamed questions finish after their response headers (and so a cookie
+# session) have gone out. With cookie sessions they wait here, keyed by
+# session, and are written into the history on that session's next request.
+# Sessions that never come back are dropped after FINISHED_STREAM_TTL
+# seconds, or oldest first past FINISHED_STREAMS_MAX.
+FINISHED_STREAM_TTL = float(os.environ.get('FINISHED_STREAM_TTL', 3600))
+FINISHED_STREAMS_MAX = int(os.environ.get('FINISHED_STREAMS_MAX', 10000))
+finished_streams = OrderedDict()  # stream id -> (parked at, [question text])
+finished_streams_lock = threading.Lock()
+
+
+# The endpoints that read or change the session. Only these look for parked
+# questions: touching the session adds Vary: Cookie to the response, which
+# would keep shared caches from the assets and /proxy.
+SESSION_ENDPOINTS = {
+    'home', 'api_question', 'api_question_stream', 'api_process_drawing', 'api_process_drawing_job',
+    'api_process_drawing_job_status', 'reflection_page', 'reflection_pdf', 'api_reflection_image',
+}
+
+
+@app.before_request
+def merge_finished_streams():
+    if request.endpoint in SESSION_ENDPOINTS:
+        merge_finished_streams_into(session)
+
+
+def merge_finished_streams_into(sess):
+    stream_id = sess.get('stream_id')
+    if not stream_id:
+        return
+    with finished_streams_lock:
+        parked = finished_streams.pop(stream_id, None)
+    if parked is None or parked[0] < time.monotonic() - FINISHED_STREAM_TTL:
+        return
+    for text in parked[1]:
+        add_question(sess, text)
+
+
+def streamed_question_saver():
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        store, sid = app.session_interface.store, session.sid
+
+        def save(question_text):
+            store.update(sid, lambda data: add_question(data, question_text))
+        return save
+
+    stream_id = session.setdefault('stream_id', uuid.uuid4().hex)
+
+    def park(question_text):
+        now = time.monotonic()
+        with finished_streams_lock:
+            _, questions = finished_streams.pop(stream_id, (now, []))
+            questions.append(question_text)
+            finished_streams[stream_id] = (now, questions)
+            # Oldest first, since every park moves its entry to the end
+            while finished_streams:
+                parked_at, _ = next(iter(finished_streams.values()))
+                if len(finished_streams) <= FINISHED_STREAMS_MAX and parked_at >= now - FINISHED_STREAM_TTL:
+                    break
+                finished_streams.popitem(last=False)
+    return park
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 @app.route('/api/question', methods=['POST'])
 def api_question():
     data = request.json
-    user_response = data.get('response', '')
-    session['history'] = session.get('history', [])
-    session['question_number'] = session.get('question_number', 1)
-    session['history'].append(('You', user_response))
+    question_number, history, restart, progress = question_turn(session, data)
+    question_text = next_question(question_number, history, session_context_state())
+    add_question(session, question_text)
+    return jsonify({'question': question_text, 'progress': progress, 'restart': restart})
 
-    if session['question_number'] <= 6:
-        question_text = generate_art_therapy_question(
-            app.secret_key, session['question_number'], session['history']
-        )
-        session['history'].append(('Therapist', question_text))
-        session['question_number'] += 1
-        progress = (session['question_number'] - 1) / 6 * 100
-        return jsonify({'question': question_text, 'progress': progress, 'restart': False})
-    else:
-        session.clear()
-        session['history'] = []
-        session['question_number'] = 1
-        first_question_text = generate_art_therapy_question(
-            app.secret_key, session['question_number'], session['history']
-        )
-        session['history'].append(('Therapist', first_question_text))
-        return jsonify({'question': first_question_text, 'progress': 0, 'restart': True})
-        
 
-@app.route('/', methods=['GET'])
-def home():
-    session['history'] = session.get('history', [])
-    session['question_number'] = session.get('question_number', 1)
-    initial_question = generate_art_therapy_question(
-        app.secret_key, session['question_number'], session['history']
-    )
-    session['history'].append(('Therapist', initial_question))
-    session['question_number'] += 1
+@app.route('/api/question/stream', methods=['POST'])
+def api_question_stream():
+    # Server-Sent Events version of /api/question: a 'meta' event with the
+    # progress, 'token' events as the question is generated, then 'done'.
+    data = request.json
+    user_response = data.get('response', '')
+    question_number, history, restart, progress = begin_question_turn(session, user_response)
 
-    latest_question = session['history'][-1][1]
-    progress_value = (session['question_number'] - 1) / 6 * 100
-    return render_template_string("""
+    save_question = streamed_question_saver()
+    if opening_questions.size and is_opening_question(question_number, history):
+        chunks = iter([opening_questions.take()])
+    elif 1 <= question_number <= 6 and upstream_guards['questions'].state == OPEN:
+        chunks = iter([fallback_question(question_number)])
+    else:
+        chunks = stream_art_therapy_question(question_number, history, session_context_state())
+
+    def events():
+        yield sse_event('meta', {'progress': progress, 'restart': restart})
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                yield sse_event('token', {'text': text})
+        except Exception as e:
+            print(f"Error streaming question: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+            return
+        question_text = ''.join(parts).rstrip()
+        save_question(question_text)
+        yield sse_event('done', {'question': question_text, 'progress': progress, 'restart': restart})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Pages are compiled once at startup; their CSS, JS and images live in
+# Public/ and are served below under content-hashed URLs
+assets = AssetManifest(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Public'))
+app.jinja_env.globals['asset_url'] = assets.url
+# The colors the page snaps a drawing's pixels to before sending it as a
+# palette-indexed PNG
+app.jinja_env.globals['drawing_palette'] = ' '.join('%02x%02x%02x' % rgb for rgb in color_analyzer.palette)
+app.jinja_env.globals['drawing_jobs'] = DRAWING_JOBS
+
+HOME_TEMPLATE = """
     <html>
         <head>
             <title>Mind Palette for kids!</title>
-            <style>
-                body {
-                    font-family: 'Helvetica', sans-serif;
-                    margin: 0;
-                    padding: 0;
-                }
-                .container {
-                    display: flex;
-                    width: 100%;
-                }
-                .left, .right {
-                    width: 50%;
-                    padding: 20px;
-                }
-                .divider {
-                    background-color: black;
-                    width: 2px;
-                    margin: 0 20px;
-                    height: auto;
-                }
-                .active-tool {
-                    background-color: black;
-                    color: white;
-                }
-                .button-style {
-                    color: white;
-                    background-color: black;
-                    padding: 5px 10px;
-                    cursor: pointer;
-                    border: none;
-                    margin-left: 10px;
-                    border-radius: 4px; 
-                }
-                .helper-text {
-                    font-size: 18px; /* Set font size to 18px */
-                    line-height: 1.6; /* Adjust line height for better readability */
-                    color: black; /* Ensure the text is in black color */
-                }
-                #question {
-                    font-size: 18px; /* Increase the font size for better readability */
-                    line-height: 1.6; /* Adjust line height to add more space between lines */
-                    margin-bottom: 20px; /* Additional margin below the text for spacing */
-                    color: black; 
-                }
-                
-                    progress {
-                        width: 430px;  /* Set width to match the drawing canvas */
-                        height: 10px;
-                        margin-top: 10px;
-                        color: #0057e7; /* Change progress bar color here */
-                        background-color: #eee;
-                        border-radius: 3px;
-                    }
-                    progress::-webkit-progress-bar {
-                        background-color: #eee;
-                        border-radius: 3px;
-                    }
-                    progress::-webkit-progress-value {
-                        background-color: #0057e7;
-                        border-radius: 3px;
-                    }
-                    #.responses {
-                    #margin-top: 20px;
-                    #line-height: 1.6;
-                    #background-color: white;
-                    #padding: 20px;
-                    #border-radius: 5px;
-                    #box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
-                #}
-                #reflectionContainer {
-                    display: none;
-                    background-color: #f0f8ff;
-                    padding: 10px;
-                    border-radius: 5px;
-                }
-                .active-tool {
-                    background-color: black;
-                    color: white;
-                }
-
-                img {
-                    width: 256px;
-                    height: 256px;
-                    margin: 10px;
-                }
-                #images img:hover {
-                    cursor: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" width="32" height="32"><defs><radialGradient id="grad1" cx="50%" cy="50%" r="50%" fx="50%" fy="50%"><stop offset="0%" style="stop-color:rgb(255,255,255);stop-opacity:0.8" /><stop offset="100%" style="stop-color:rgb(255,255,255);stop-opacity:0.3" /></radialGradient></defs><circle cx="16" cy="16" r="15" fill="url(%23grad1)" stroke="gray" stroke-width="1"/></svg>'), auto;
-                }
-                    input[type="text"] {
-                        width: 600px; /* Increased width for larger input box */
-                        height: 40px; /* Optional: Set height for a taller input box */
-                        font-size: 18px; /* Increased font size for better readability */
-                        padding: 10px; /* Add padding for a better user experience */
-                        border: 1px solid #ccc;
-                        box-shadow: 0px 1px 2px rgba(0,0,0,0.1);
-                        border-radius: 4px;
-                        transition: box-shadow 0.3s;
-                    }
-                
-                    input[type="text"]:focus {
-                        box-shadow: 0px 2px 4px rgba(0,0,0,0.2); 
-                        border-radius: 4px;
-                    }
-                
-                .canvas-container {
-                    display: flex;
-                    align-items: start; /* Align items at the start of the flex container */
-                    margin-bottom: 10px;
-                    margin-top: 30px; 
-                }
-            
-            canvas {
-                    background-color: #f3f4f6;
-                    border: 2px solid #cccccc;
-                    border-radius: 4px;
-                    cursor: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24"><circle cx="12" cy="12" r="8" fill="black" fill-opacity="0.4" />stroke="gray" stroke-width="1"/></svg>') 12 12, crosshair;
-                }
-                .brush {
-                    width: 30px;
-                    height: 30px;
-                    border-radius: 50%;
-                    cursor: pointer;
-                    display: inline-block;
-                    margin: 5px;
-                }
-
-                #strokeSizeSlider {
-                    width: 200px;
-                }
-
-                .tool-button {
-                    background-color: white;   /* White background */
-                    border: 1.5px solid black;   /* Black border */
-                    color: black;              /* Black text */
-                    padding: 4px 9px;         /* Padding for better button sizing */
-                    cursor: pointer;           /* Pointer cursor on hover */
-                    margin-left: 13px;         /* Margin on the left for spacing */
-                    border-radius: 4px;        /* Rounded corners */
-                }
-                
-                .spinner {
-                    display: inline-block;
-                    vertical-align: middle;
-                    border: 4px solid rgba(0,0,0,.1);
-                    border-radius: 50%;
-                    border-left-color: #09f;
-                    animation: spin 1s ease infinite;
-                    width: 20px;  /* Smaller size */
-                    height: 20px; /* Smaller size */
-                }
-
-                #loading p {
-                    display: inline-block;
-                    vertical-align: middle;
-                    margin: 0;
-                    padding-left: 10px; /* Space between the spinner and the text */
-                }
-
-                @keyframes spin {
-                    0% { transform: rotate(0deg); }
-                    100% { transform: rotate(360deg); }
-                }
-
-            </style>
-
-
-            <script>
-                function sendResponse() {
-                    const response = document.getElementById('response').value;
-                    fetch('/api/question', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({'response': response})
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        document.getElementById('question').textContent = data.question;
-                        document.querySelector('progress').value = data.progress;
-                        document.getElementById('response').value = ''; // Clear the response box
-                
-                        if (data.progress === 100) {
-                            // Show the reflection area when the last question is reached
-                            //document.getElementById('reflectionContainer').style.display = 'block';
-                            document.getElementById('reflectionContainer').innerHTML = `<div class="responses">${data.responses}</div>`;
-                        }
-                    })
-                    .catch(error => console.error('Error:', error));
-                    return false;
-                }
-
-
-                function viewReflection() {
-                    document.getElementById('reflectionContainer').scrollIntoView({ behavior: 'smooth' });
-                }
-
-
-                function updateProgressBar() {
-                    var currentQuestionNumber = session['question_number'] - 1;  // Assumes this variable is updated correctly from server
-                    var progressPercent = currentQuestionNumber * 20;  // Assuming there are 5 questions
-                    document.querySelector('progress').value = progressPercent;
-                }
-
-
-
-                function generateImage(event) {
-                    event.preventDefault();  // Prevent the form from submitting traditionally
-
-                    const canvas = document.getElementById('drawingCanvas');
-                    const image_data = canvas.toDataURL('image/png');
-                    const description = document.getElementById('description').value;
-
-                    document.getElementById('loading').style.display = 'block'; // Show loading indicator
-
-                    fetch('/api/process-drawing', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ 'drawing': image_data, 'description': description })
-                    })
-                    .then(res => res.json())
-                    .then(data => {
-                        const imagesContainer = document.getElementById('images');
-                        data.image_urls.forEach(url => {
-                            const img = new Image();
-                            img.onload = function() {
-                                imagesContainer.insertBefore(img, imagesContainer.firstChild); // Insert new images at the top
-                            };
-                            img.onclick = function() { replaceCanvas(this.src); }; // use this.src, which is the correct reference
-                            img.src = '/proxy?url=' + encodeURIComponent(url); // use url from the forEach loop
-                            img.width = 256;
-                            img.height = 256;
-                        });
-                        
-                        // Display reappraisal text
-                        document.getElementById('reappraisalText').textContent = data.reappraisal_text;
-                        document.getElementById('loading').style.display = 'none'; // Hide loading indicator
-                    })
-
-                    .catch(error => {
-                        console.error('Error:', error);
-                        document.getElementById('loading').style.display = 'none'; // Hide loading indicator if there is an error
-                    });
-
-                    return false;
-                }
-
-
-                function replaceCanvas(imgSrc) {
-                    const canvas = document.getElementById('drawingCanvas');
-                    const ctx = canvas.getContext('2d');
-                    const img = new Image();
-                    img.crossOrigin = "anonymous";  // Set cross-origin to anonymous
-                    img.onload = function() {
-                        ctx.clearRect(0, 0, canvas.width, canvas.height);
-                        ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
-                    };
-                    img.onerror = function() {
-                        alert('What do you think about this image?');
-                    };
-                    img.src = '/proxy?url=' + encodeURIComponent(imgSrc);
-
-                    // After setting the new image, allow the canvas to be used for new drawings or image generations
-                    painting = false;  // Reset painting state if needed
-                    ctx.beginPath();  // Clear any existing drawing paths
-                }
-
-            </script>
+            <link rel="stylesheet" href="{{ asset_url('home.css') }}">
+
+
+            <script src="{{ asset_url('home.js') }}"></script>
         </head>
         <body>
             <div class="container">
@@ -492,7 +1213,7 @@ def home():
                     <input type="submit" value="Respond" class="button-style" />
                 </form>
                 <div class="canvas-container ">
-                    <canvas id="drawingCanvas" width="500" height="330"></canvas>
+                    <canvas id="drawingCanvas" width="500" height="330" data-palette="{{ drawing_palette }}" data-jobs="{{ 1 if drawing_jobs else 0 }}"></canvas>
                     <button id="backButton" class="tool-button" onclick="undoLastAction()">Back</button>
                 </div>
                 <div class>
@@ -515,130 +1236,7 @@ def home():
 
 
 
-                <script>
-
-                    let currentTool = 'brush'; // Initially set the current tool to brush
-                    updateToolButtonStyles();
-
-                    function selectTool(tool) {
-                        currentTool = tool;
-                        if (tool === 'eraser') {
-                            ctx.globalCompositeOperation = 'destination-out';
-                            ctx.lineWidth = 20; // Eraser size
-                        } else {
-                            ctx.globalCompositeOperation = 'source-over';
-                            ctx.strokeStyle = currentColor; // Use the selected color
-                            ctx.lineWidth = document.getElementById('strokeSizeSlider').value; // Use the slider value
-                        }
-                        updateToolButtonStyles(); // Update button styles based on the selected tool
-                    }
-
-                    function updateToolButtonStyles() {
-                        // Remove active class from all buttons
-                        document.getElementById('brushButton').classList.remove('active-tool');
-                        document.getElementById('eraserButton').classList.remove('active-tool');
-                        document.getElementById('backButton').classList.remove('active-tool');
-
-                        // Add active class to the current tool button
-                        if (currentTool === 'brush') {
-                            document.getElementById('brushButton').classList.add('active-tool');
-                        } else if (currentTool === 'eraser') {
-                            document.getElementById('eraserButton').classList.add('active-tool');
-                        }
-                    }
-
-                    function undoLastAction() {
-                        if (undoStack.length > 0) {
-                            ctx.putImageData(undoStack.pop(), 0, 0);
-                            document.getElementById('backButton').classList.add('active-tool');
-                            setTimeout(() => {
-                                document.getElementById('backButton').classList.remove('active-tool');
-                            }, 500); // Remove the active class after 500 ms
-                        }
-                    }
-
-                    // Bind tool buttons
-                    document.getElementById('brushButton').addEventListener('click', () => selectTool('brush'));
-                    document.getElementById('eraserButton').addEventListener('click', () => selectTool('eraser'));
-                    document.getElementById('backButton').addEventListener('click', undoLastAction);
-
-                    
-                    const canvas = document.getElementById('drawingCanvas');
-                    const ctx = canvas.getContext('2d');
-                    let painting = false;
-                    let undoStack = [];  // Stack to keep track of canvas states for undo
-
-                    // Save the current state of the canvas
-                    function saveCanvasState() {
-                        const imageData = ctx.getImageData(0, 0, canvas.width, canvas.height);
-                        undoStack.push(imageData);
-                    }
-
-                    // Draw on the canvas
-                    function draw(event) {
-                        if (!painting) return;
-                        ctx.lineWidth = document.getElementById('strokeSizeSlider').value;
-                        ctx.lineCap = 'round';
-                        ctx.lineTo(event.offsetX, event.offsetY);
-                        ctx.stroke();
-                        ctx.beginPath();
-                        ctx.moveTo(event.offsetX, event.offsetY);
-                    }
-
-                    // Start painting with mouse down
-                    function startPainting(event) {
-                        painting = true;
-                        draw(event);
-                        saveCanvasState();
-                    }
-
-                    // Stop painting
-                    function stopPainting() {
-                        painting = false;
-                        ctx.beginPath();
-                    }
-
-                    // Undo the last action
-                    function undoLastAction() {
-                        if (undoStack.length > 0) {
-                            const lastState = undoStack.pop();
-                            ctx.putImageData(lastState, 0, 0);
-                        }
-                    }
-
-                    // Set the tool used for drawing
-                    function selectTool(tool) {
-                        if (tool === 'eraser') {
-                            ctx.globalCompositeOperation = 'destination-out';
-                            ctx.lineWidth = 20;  // Make the eraser bigger
-                        } else {
-                            ctx.globalCompositeOperation = 'source-over';
-                            ctx.strokeStyle = document.getElementById('currentColor').value;
-                        }
-                    }
-
-                    // Event listeners for canvas interactions
-                    canvas.addEventListener('mousedown', startPainting);
-                    canvas.addEventListener('mousemove', draw);
-                    canvas.addEventListener('mouseup', stopPainting);
-                    canvas.addEventListener('mouseout', stopPainting);
-
-                    // Change color
-                    function changeColor(color) {
-                        ctx.strokeStyle = color;
-                        document.getElementById('currentColor').value = color;
-                    }
-
-                    // Buttons for tool selection
-                    document.getElementById('brushButton').addEventListener('click', function() { selectTool('brush'); });
-                    document.getElementById('eraserButton').addEventListener('click', function() { selectTool('eraser'); });
-                    document.getElementById('backButton').addEventListener('click', undoLastAction);
-
-                    // Set initial color
-                    let currentColor = '#000000'; // Default black
-                    ctx.strokeStyle = currentColor;
-                    ctx.lineWidth = 5;
-                </script>
+                <script src="{{ asset_url('canvas.js') }}"></script>
 
 
                 </div>
@@ -653,11 +1251,15 @@ def home():
                         </label><br>
                         <input type="text" id="description" autocomplete="off" style="width: 400px; padding: 5px; margin-top: 10px;" placeholder="Describe your drawing..." />
                         <input type="submit" value="Generate" class="button-style" />
+                        <br>
+                        <label style="font-size: 14px;">
+                            <input type="checkbox" id="freshImages" /> Always make brand new pictures
+                        </label>
                     </form>
                     <!-- Loading indicator placed right below the form -->
                     <div id="loading" style="display: none; text-align: center;">
                         <div class="spinner"></div>
-                        <p>Loading...</p>
+                        <p id="loadingText">Loading...</p>
                     </div>
                     <div id="images">
                         <!-- Dynamically added images will go here -->
@@ -678,51 +1280,161 @@ def home():
 
         </body>
     </html>
-    """, latest_question=latest_question, progress_value=progress_value)
+"""
 
-@app.route('/reflection', methods=['GET'])
-def reflection():
-    responses = session.get('responses', [])
-    formatted_responses = "<br>".join([f"Response {i + 1}: {response}" for i, response in enumerate(responses)])
-    return render_template_string("""
+REFLECTION_TEMPLATE = """
     <html>
         <head>
             <title>Your Reflections</title>
-            <style>
-                body {
-                    font-family: 'Helvetica', sans-serif;
-                    padding: 20px;
-                    background-color: #f0f8ff;
-                }
-                h1 {
-                    color: #333;
-                }
-                .responses {
-                    margin-top: 20px;
-                    line-height: 1.6;
-                    background-color: #fff;
-                    padding: 20px;
-                    border-radius: 5px;
-                    box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
-                }
-                .button-style {
-                    color: white;
-                    background-color: black;
-                    padding: 5px 10px;
-                    cursor: pointer;
-                    border: none;
-                    margin-left: 10px;
-                    border-radius: 4px; 
-                }
-            </style>
+            <link rel="stylesheet" href="{{ asset_url('reflection.css') }}">
         </head>
         <body>
             <h1>Here is what your kids thought about today.</h1>
             <div class="responses">{{ responses|safe }}</div>
             <button class="button-style" style="margin-top: 20px;" onclick="window.location.href='/'">Restart Session</button>
+            {% if has_entries %}
+            <button class="button-style" style="margin-top: 20px;" onclick="window.location.href='/reflection.pdf'">Save as PDF</button>
+            {% endif %}
         </body>
     </html>
-    """, responses=formatted_responses)
+"""
+
+# The page templates are compiled to Python modules ahead of time (python
+# index.py --compile-templates) so a cold start only imports them. Their
+# names carry a hash of the source: an edited template that hasn't been
+# compiled again is compiled from the source here, as before.
+COMPILED_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compiled_templates')
+PAGE_TEMPLATES = {'home': HOME_TEMPLATE, 'reflection': REFLECTION_TEMPLATE}
+# Kept for as long as the templates: it owns the package they're imported from
+compiled_template_loader = ModuleLoader(COMPILED_TEMPLATES_DIR)
+
+
+def compiled_template_name(name):
+    digest = hashlib.sha256(PAGE_TEMPLATES[name].encode()).hexdigest()[:12]
+    return f"{name}-{digest}.html"
+
+
+def load_page_template(name):
+    try:
+        return compiled_template_loader.load(app.jinja_env, compiled_template_name(name),
+                                             app.jinja_env.make_globals(None))
+    except TemplateNotFound:
+        return app.jinja_env.from_string(PAGE_TEMPLATES[name])
+
+
+def compile_templates():
+    # Replaces everything in COMPILED_TEMPLATES_DIR with the current templates
+    os.makedirs(COMPILED_TEMPLATES_DIR, exist_ok=True)
+    for filename in os.listdir(COMPILED_TEMPLATES_DIR):
+        if filename.startswith('tmpl_') and filename.endswith('.py'):
+            os.remove(os.path.join(COMPILED_TEMPLATES_DIR, filename))
+    for name, source in PAGE_TEMPLATES.items():
+        template_name = compiled_template_name(name)
+        code = app.jinja_env.compile(source, template_name, raw=True, defer_init=True)
+        path = os.path.join(COMPILED_TEMPLATES_DIR, ModuleLoader.get_module_filename(template_name))
+        with open(path, 'w') as f:
+            f.write(code)
+        print(f"{name}: {os.path.relpath(path)}")
+
+
+home_template = load_page_template('home')
+reflection_template = load_page_template('reflection')
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    response = assets.response(name, request)
+    if response is None:
+        return jsonify({'error': 'Not found'}), 404
+    return response
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings)
+
+
+@app.route('/', methods=['GET'])
+def home():
+    session['history'] = session.get('history', [])
+    session['question_number'] = session.get('question_number', 1)
+    initial_question = next_question(session['question_number'], session['history'], session_context_state())
+    add_question(session, initial_question)
+    session['question_number'] += 1
+
+    latest_question = session['history'][-1][1]
+    progress_value = (session['question_number'] - 1) / 6 * 100
+    with metrics.timed('render'):
+        return home_template.render(latest_question=latest_question, progress_value=progress_value)
+
+def fetch_reflection_image(url):
+    try:
+        return fetch_proxied_image(url)['content']
+    except (requests.exceptions.RequestException, ProxyFetchError) as e:
+        print(f"Error fetching a chosen picture: {str(e)}")
+        return None
+
+
+# PDF exports of reflections, by content digest. /reflection.pdf waits up to
+# REFLECTION_PDF_WAIT seconds for one being rendered before answering 202.
+reflection_pdfs = reflection.PdfExports(
+    os.environ.get('REFLECTION_PDF_DIR', os.path.join(tempfile.gettempdir(), 'mind_palette_reflections')),
+    lambda entries, path: reflection.render_pdf(entries, path, fetch_reflection_image),
+    workers=int(os.environ.get('REFLECTION_PDF_WORKERS', 2)),
+    ttl=float(os.environ.get('REFLECTION_PDF_TTL', 24 * 3600)),
+)
+REFLECTION_PDF_WAIT = float(os.environ.get('REFLECTION_PDF_WAIT', 5))
+# Behind a front server that supports it, let it send the files itself
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+
+@app.route('/reflection', methods=['GET'])
+def reflection_page():
+    entries = reflection.entries(session)
+    if entries:
+        # Start on the PDF now, so it's ready when asked for
+        reflection_pdfs.request(reflection.digest(entries), entries)
+    with metrics.timed('render'):
+        return reflection_template.render(responses=reflection.render_html(entries), has_entries=bool(entries))
+
+
+@app.route('/reflection.pdf', methods=['GET'])
+def reflection_pdf():
+    entries = reflection.entries(session)
+    if not entries:
+        return jsonify({'error': 'Nothing to reflect on yet'}), 404
+    digest = reflection.digest(entries)
+    future = reflection_pdfs.request(digest, entries)
+    try:
+        path = future.result(timeout=REFLECTION_PDF_WAIT)
+    except FutureTimeoutError:
+        return jsonify({'status': 'rendering'}), 202, {'Retry-After': '2', 'Cache-Control': 'no-store'}
+    except Exception as e:
+        print(f"Error rendering reflection PDF: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    # Sent from the file: with a file wrapper or X-Sendfile the server copies
+    # it to the socket itself
+    response = send_file(path, mimetype='application/pdf', download_name='reflection.pdf',
+                         etag=digest, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/reflection/image', methods=['POST'])
+def api_reflection_image():
+    url = (request.get_json(silent=True) or {}).get('url')
+    offered = session.get('offered_images', [])
+    if url not in offered:
+        return jsonify({'error': 'Not one of the pictures made for you'}), 400
+    # Moved from the offered pictures into the reflection, so the session
+    # holds each URL once
+    session['offered_images'] = [offered_url for offered_url in offered if offered_url != url]
+    reflection.append(session, 'image', url)
+    return jsonify({'ok': True})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
+    if sys.argv[1:] == ['--compile-templates']:
+        compile_templates()
+    else:
+        app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,138 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    # Runs `run(payload, progress)` on a bounded pool of worker threads and
+    # keeps each job's status, current stage, timings and result under a
+    # random id for clients to poll. At most `max_queued` jobs wait for a
+    # worker; submit() raises QueueFull beyond that. Finished jobs are kept
+    # for `ttl` seconds. run() reports the stage it enters by calling
+    # progress(stage); the time spent in each stage is recorded.
+    def __init__(self, run, workers=4, max_queued=32, ttl=600):
+        self.run = run
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._jobs = {}
+        self._queued = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.run_seconds_total = 0.0
+        self.wait_seconds_total = 0.0
+
+    def submit(self, payload):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._sweep(time.monotonic())
+            if self._queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull(f"{self._queued} jobs are already waiting")
+            self._jobs[job_id] = {
+                'status': 'queued',
+                'stage': 'queued',
+                'created': time.monotonic(),
+                'stage_started': time.monotonic(),
+                'timings': {},
+                'result': None,
+                'error': None,
+                'finished': None,
+            }
+            self._queued += 1
+            self.submitted += 1
+        self._executor.submit(self._run_job, job_id, payload)
+        return job_id
+
+    def _enter_stage(self, job, stage):
+        # Called with the lock held
+        now = time.monotonic()
+        job['timings'][job['stage']] = job['timings'].get(job['stage'], 0) + now - job['stage_started']
+        job['stage'], job['stage_started'] = stage, now
+
+    def _run_job(self, job_id, payload):
+        with self._lock:
+            job = self._jobs[job_id]
+            self._queued -= 1
+            self._running += 1
+            job['status'] = 'running'
+            self._enter_stage(job, 'running')
+            self.wait_seconds_total += job['timings']['queued']
+
+        def progress(stage):
+            with self._lock:
+                self._enter_stage(job, stage)
+
+        try:
+            result = self.run(payload, progress)
+        except Exception as e:
+            print(f"Error running job {job_id}: {str(e)}")
+            status, result, error = 'failed', None, str(e)
+        else:
+            status, error = 'done', None
+        with self._lock:
+            self._enter_stage(job, status)
+            self._running -= 1
+            job.update(status=status, result=result, error=error, finished=time.monotonic())
+            self.run_seconds_total += job['finished'] - job['created'] - job['timings']['queued']
+            if status == 'done':
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def _sweep(self, now):
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job['finished'] is not None and now - job['finished'] > self.ttl]:
+            del self._jobs[job_id]
+            self.expired += 1
+
+    def get(self, job_id):
+        # A snapshot of the job, or None if it is unknown or has expired
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            timings = dict(job['timings'])
+            if job['finished'] is None:
+                timings[job['stage']] = timings.get(job['stage'], 0) + now - job['stage_started']
+            end = job['finished'] if job['finished'] is not None else now
+            return {
+                'id': job_id,
+                'status': job['status'],
+                'stage': job['stage'],
+                'elapsed': end - job['created'],
+                'timings': timings,
+                'result': job['result'],
+                'error': job['error'],
+            }
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'workers': self.workers,
+                'queued': self._queued,
+                'running': self._running,
+                'max_queued': self.max_queued,
+                'kept': len(self._jobs),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'expired': self.expired,
+                'avg_wait_seconds': self.wait_seconds_total / (finished + self._running) if finished + self._running else 0,
+                'avg_run_seconds': self.run_seconds_total / finished if finished else 0,
+            }
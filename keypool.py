@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import re
+import threading
+import time
+
+# OpenAI reports each key's limits on every response, e.g.
+#   x-ratelimit-limit-requests: 3500
+#   x-ratelimit-remaining-requests: 3499
+#   x-ratelimit-reset-requests: 17ms
+# and the same for -tokens. A 429 says when to come back in Retry-After.
+RATE_LIMIT_HEADER = 'x-ratelimit-{}-{}'
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+DEFAULT_RETRY_AFTER = 10
+
+
+class KeysExhausted(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(text):
+    # '6m0s', '1.5s', '20ms' -> seconds, None if it isn't one
+    parts = DURATION_PART.findall(text or '')
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    # `capacity` per minute, refilled continuously. Levels can go negative
+    # when upstream reports less left than was taken here.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.per_second = capacity / 60
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def wait_for(self, amount):
+        # Seconds until amount can be taken; a cost above the capacity only
+        # waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.per_second
+
+    def reset_to(self, limit, remaining, reset_seconds, now):
+        # Responses arrive out of order, and calls still in flight aren't in
+        # `remaining` yet: once the limit is known, headers only lower the
+        # level
+        self.refill(now)
+        if limit == self.capacity:
+            remaining = min(remaining, self.level)
+        self.capacity = limit
+        self.level = min(limit, remaining)
+        if reset_seconds:
+            self.per_second = max(limit / 60, (limit - remaining) / reset_seconds)
+        else:
+            self.per_second = limit / 60
+        self._updated = now
+
+
+class PooledKey:
+    def __init__(self, label, api_key, requests_per_minute, tokens_per_minute):
+        self.label = label
+        self.api_key = api_key
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.cooling_until = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+
+    def wait_for(self, tokens, now):
+        self.requests.refill(now)
+        wait = max(self.cooling_until - now, self.requests.wait_for(1))
+        if self.tokens is not None:
+            self.tokens.refill(now)
+            wait = max(wait, self.tokens.wait_for(tokens))
+        return wait
+
+    def headroom(self):
+        # The smaller share left of the key's request and token limits
+        share = self.requests.level / self.requests.capacity
+        if self.tokens is not None:
+            share = min(share, self.tokens.level / self.tokens.capacity)
+        return share
+
+
+class KeyPool:
+    # Spreads the calls to one kind of OpenAI endpoint over several API
+    # keys. Each key has token buckets for its requests and tokens per
+    # minute, started from the configured limits and reset from the
+    # x-ratelimit-* headers of every response with that key. A 429 benches
+    # the key for its Retry-After.
+    #
+    # Calls take a key with lease(tokens), or call(): the key with the most
+    # headroom that can afford the call, waiting up to max_wait for one to
+    # refill, then KeysExhausted. The key is passed to the client with each call;
+    # nothing is set globally. observe() is fed every response to a call.
+    def __init__(self, name, api_keys, requests_per_minute, tokens_per_minute=None, max_wait=5.0):
+        self.name = name
+        self.max_wait = max_wait
+        self.keys = [PooledKey(f'key{number}', api_key, requests_per_minute, tokens_per_minute)
+                     for number, api_key in enumerate(api_keys, start=1)]
+        self._by_authorization = {f'Bearer {key.api_key}': key for key in self.keys}
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.exhausted = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _take(self, tokens):
+        # (key, 0) with the call charged to it, or (None, seconds to wait)
+        now = time.monotonic()
+        with self._lock:
+            best_wait, _, _, _, best = min((key.wait_for(tokens, now), -key.headroom(), key.in_flight, number, key)
+                                           for number, key in enumerate(self.keys))
+            if best_wait > 0:
+                return None, best_wait
+            best.requests.level -= 1
+            if best.tokens is not None:
+                best.tokens.level -= tokens
+            best.in_flight += 1
+            best.calls += 1
+            return best, 0
+
+    def _give_up(self, waited, wait):
+        if waited + wait > self.max_wait:
+            with self._lock:
+                self.exhausted += 1
+            raise KeysExhausted(f"Every {self.name} key is at its rate limit for another {wait:.1f}s", wait)
+
+    def _release(self, key, waited):
+        with self._lock:
+            key.in_flight -= 1
+            self.waited += waited
+
+    @contextlib.contextmanager
+    def lease(self, tokens=0):
+        # with pool.lease(estimated_tokens) as api_key: ...
+        if not self.keys:
+            yield None  # the client then says no key is configured
+            return
+        waited = 0.0
+        while True:
+            key, wait = self._take(tokens)
+            if key is not None:
+                break
+            self._give_up(waited, wait)
+            time.sleep(wait)
+            waited += wait
+        try:
+            yield key.api_key
+        finally:
+            self._release(key, waited)
+
+    @contextlib.asynccontextmanager
+    async def alease(self, tokens=0):
+        if not self.keys:
+            yield None
+            return
+        waited = 0.0
+        while True:
+            key, wait = self._take(tokens)
+            if key is not None:
+                break
+            self._give_up(waited, wait)
+            await asyncio.sleep(wait)
+            waited += wait
+        try:
+            yield key.api_key
+        finally:
+            self._release(key, waited)
+
+    def call(self, fn, tokens=0, is_rate_limit=lambda error: False, attempts=None):
+        # fn(api_key) with a leased key. When is_rate_limit(error) says the
+        # key was turned away, the call is made again with the best key
+        # then, up to `attempts` times in all (once per key by default).
+        attempts = attempts or max(1, len(self.keys))
+        for attempt in range(attempts):
+            with self.lease(tokens) as api_key:
+                try:
+                    return fn(api_key)
+                except Exception as e:
+                    if attempt == attempts - 1 or not is_rate_limit(e):
+                        raise
+
+    def observe(self, authorization, status, headers):
+        # Learns from a response to a request made with one of our keys
+        key = self._by_authorization.get(authorization)
+        if key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for kind, bucket in (('requests', key.requests), ('tokens', key.tokens)):
+                if bucket is None:
+                    continue
+                try:
+                    limit = float(headers[RATE_LIMIT_HEADER.format('limit', kind)])
+                    remaining = float(headers[RATE_LIMIT_HEADER.format('remaining', kind)])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if limit > 0:
+                    reset = parse_duration(headers.get(RATE_LIMIT_HEADER.format('reset', kind)))
+                    bucket.reset_to(limit, remaining, reset, now)
+            if status == 429:
+                key.rate_limited += 1
+                try:
+                    retry_after = float(headers.get('Retry-After'))
+                except (TypeError, ValueError):
+                    retry_after = DEFAULT_RETRY_AFTER
+                key.cooling_until = max(key.cooling_until, now + retry_after)
+
+    def key_stats(self, key):
+        now = time.monotonic()
+        with self._lock:
+            key.wait_for(0, now)
+            stats = {
+                'key': f'...{key.api_key[-4:]}',
+                'calls': key.calls,
+                'in_flight': key.in_flight,
+                'rate_limited': key.rate_limited,
+                'cooling': int(key.cooling_until > now),
+                'requests_limit': key.requests.capacity,
+                'requests_remaining': max(0, key.requests.level),
+                'utilization': 1 - max(0, key.requests.level) / key.requests.capacity,
+            }
+            if key.tokens is not None:
+                stats['tokens_limit'] = key.tokens.capacity
+                stats['tokens_remaining'] = max(0, key.tokens.level)
+                stats['utilization'] = max(stats['utilization'], 1 - max(0, key.tokens.level) / key.tokens.capacity)
+        return stats
+
+    def stats(self):
+        return {
+            'waited_seconds': self.waited,
+            'exhausted': self.exhausted,
+            'keys': {key.label: self.key_stats(key) for key in self.keys},
+        }
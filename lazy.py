@@ -0,0 +1,37 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    # Stands in for a module that is only imported when one of its
+    # attributes is first used, so a cold start (each new serverless
+    # instance imports index) doesn't pay for libraries the request at hand
+    # never touches. configure(module) runs once, right after the import.
+    def __init__(self, name, configure=None):
+        self._name = name
+        self._configure = configure
+        self._module = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._configure is not None:
+                        self._configure(module)
+                    self._module = module
+                module = self._module
+        return module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded yet'
+        return f'<lazy module {self._name!r} ({state})>'
@@ -0,0 +1,140 @@
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+
+# Stage and request timings, exported at /metrics in the Prometheus text
+# format and, per response, in a Server-Timing header. METRICS=0 turns it
+# all off; timed() then costs one attribute check.
+ENABLED = os.environ.get('METRICS', '1') != '0'
+PREFIX = 'mindpalette'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Stage totals of the request being handled, for its Server-Timing header.
+# Work submitted to other threads must carry the context along
+# (contextvars.copy_context().run) to be counted.
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def samples(self, name, label_names):
+        with self._lock:
+            series = {labels: ([*counts], total) for labels, (counts, total) in self._series.items()}
+        for labels, (counts, total) in sorted(series.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+            yield f'{name}_sum{{{label_text}}} {total}'
+            yield f'{name}_count{{{label_text}}} {cumulative}'
+
+
+stage_seconds = Histogram()
+request_seconds = Histogram()
+_collectors = {}
+
+
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stage_seconds.observe((self.stage,), seconds)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages[self.stage] = stages.get(self.stage, 0) + seconds
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timed(stage):
+    # with timed('colors'): ...
+    return _Timer(stage) if ENABLED else _null_timer
+
+
+def timed_function(stage):
+    # Decorator form of timed()
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def start_request():
+    if ENABLED:
+        stages = {}
+        _request_stages.set(stages)
+        return time.perf_counter()
+    return None
+
+
+def finish_request(started, route, method, status, headers):
+    # Records the request and adds its Server-Timing header
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    request_seconds.observe((route, method, str(status)), seconds)
+    stages = _request_stages.get() or {}
+    _request_stages.set(None)
+    timings = [f'{stage};dur={value * 1000:.1f}' for stage, value in stages.items()]
+    timings.append(f'total;dur={seconds * 1000:.1f}')
+    headers['Server-Timing'] = ', '.join(timings)
+
+
+def register(component, stats):
+    # Exports the numbers in stats() as gauges named <prefix>_<component>_<key>
+    _collectors[component] = stats
+
+
+def render():
+    lines = [f'# TYPE {PREFIX}_stage_seconds histogram']
+    lines.extend(stage_seconds.samples(f'{PREFIX}_stage_seconds', ('stage',)))
+    lines.append(f'# TYPE {PREFIX}_request_seconds histogram')
+    lines.extend(request_seconds.samples(f'{PREFIX}_request_seconds', ('route', 'method', 'status')))
+    for component, stats in _collectors.items():
+        for key, value in stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{PREFIX}_{component}_{key}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
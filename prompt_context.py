@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budget for the conversation part of a question prompt. The most
+# recent turns are kept word for word; older ones are folded into a running
+# summary that is cached in the session, so each turn is summarized once.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 350))
+SUMMARY_TOKEN_BUDGET = int(os.environ.get('CONTEXT_SUMMARY_TOKEN_BUDGET', 120))
+RECENT_TURNS = int(os.environ.get('CONTEXT_RECENT_TURNS', 4))
+
+# Words kept from each turn when it is folded into the summary
+SUMMARY_WORDS_PER_TURN = 18
+
+SPEAKERS = {'You': 'Child', 'Therapist': 'Therapist'}
+
+_encoding = tiktoken.get_encoding('cl100k_base') if tiktoken is not None else None
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text, tokens):
+    if count_tokens(text) <= tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:tokens])
+    return text[:tokens * 4]
+
+
+def format_turn(who, text):
+    return f"{SPEAKERS.get(who, who)}: {text}"
+
+
+def summarize_turn(who, text):
+    # Keep one sentence of the turn, capped at a handful of words: the first
+    # question it asks if there is one, otherwise its first sentence
+    text = re.sub(r'^Question \d+:\s*', '', text.strip())
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+    sentence = next((s for s in sentences if s.endswith('?')), sentences[0])
+    words = sentence.split()
+    if len(words) > SUMMARY_WORDS_PER_TURN:
+        sentence = ' '.join(words[:SUMMARY_WORDS_PER_TURN]) + '...'
+    return f"{SPEAKERS.get(who, who)}: {sentence}"
+
+
+class ContextBuilder:
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET,
+                 recent_turns=RECENT_TURNS):
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.recent_turns = recent_turns
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+
+    def build(self, history, state):
+        # Returns the conversation text for the prompt. `state` is a dict kept
+        # in the session between calls: {'turns': how many turns the summary
+        # covers, 'lines': one summary line per turn}. It is updated in place.
+        verbatim_budget = self.token_budget - self.summary_budget
+        recent, used = [], 0
+        for who, text in reversed(history):
+            if len(recent) == self.recent_turns:
+                break
+            line = format_turn(who, text)
+            tokens = count_tokens(line)
+            if used + tokens > verbatim_budget:
+                if not recent:
+                    # A single very long answer: keep as much of it as fits
+                    recent.append(truncate_to_tokens(line, verbatim_budget))
+                break
+            recent.append(line)
+            used += tokens
+        recent.reverse()
+
+        older = len(history) - len(recent)
+        if state.get('turns', 0) > older:
+            state.clear()
+        lines = state.get('lines', [])
+        new_turns = history[state.get('turns', 0):older]
+        if new_turns:
+            lines = lines + [summarize_turn(who, text) for who, text in new_turns]
+            # Over budget: the oldest turns drop out of the summary first
+            while len(lines) > 1 and count_tokens(' '.join(lines)) > self.summary_budget:
+                lines.pop(0)
+            state['turns'] = older
+            state['lines'] = lines
+        summary = truncate_to_tokens(' '.join(lines), self.summary_budget)
+
+        parts = []
+        if summary:
+            parts.append(f"Summary of earlier conversation: {summary}")
+        parts.extend(recent)
+        return '\n'.join(parts)
+
+    def record(self, prompt_tokens):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens_total += prompt_tokens
+            self.prompt_tokens_max = max(self.prompt_tokens_max, prompt_tokens)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'prompt_tokens_total': self.prompt_tokens_total,
+                'prompt_tokens_max': self.prompt_tokens_max,
+                'prompt_tokens_avg': self.prompt_tokens_total / self.calls if self.calls else 0,
+            }
@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QuestionPool:
+    # Keeps up to `size` pre-generated questions ready so a page load can take
+    # one in O(1) instead of waiting on the completion API. Questions older
+    # than `ttl` seconds are thrown away; when the pool runs dry one of the
+    # canned `fallbacks` is served and a refill is started in the background.
+    def __init__(self, generate, size, refill_workers=2, ttl=3600, fallbacks=(), error_backoff=30):
+        self.generate = generate
+        self.size = size
+        self.ttl = ttl
+        self.fallbacks = list(fallbacks)
+        self.error_backoff = error_backoff
+        self._questions = deque()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._paused_until = 0
+        self._executor = ThreadPoolExecutor(max_workers=refill_workers, thread_name_prefix='question-pool')
+        self.served = 0
+        self.fallbacks_served = 0
+        self.expired = 0
+        self.failures = 0
+
+    def _drop_expired(self, now):
+        while self._questions and now - self._questions[0][0] > self.ttl:
+            self._questions.popleft()
+            self.expired += 1
+
+    def take(self):
+        with self._lock:
+            self._drop_expired(time.monotonic())
+            question = self._questions.popleft()[1] if self._questions else None
+            if question is None:
+                self.fallbacks_served += 1
+            else:
+                self.served += 1
+        self.refill()
+        return question if question is not None else random.choice(self.fallbacks)
+
+    def refill(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return
+            self._drop_expired(now)
+            missing = self.size - len(self._questions) - self._pending
+            if missing <= 0:
+                return
+            self._pending += missing
+        for _ in range(missing):
+            self._executor.submit(self._generate_one)
+
+    def _generate_one(self):
+        try:
+            question = self.generate()
+        except Exception as e:
+            print(f"Error pre-generating question: {str(e)}")
+            with self._lock:
+                self._pending -= 1
+                self.failures += 1
+                # Don't hammer a failing upstream; the next take() after this retries
+                self._paused_until = time.monotonic() + self.error_backoff
+            return
+        with self._lock:
+            self._pending -= 1
+            self._questions.append((time.monotonic(), question))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': len(self._questions),
+                'pending': self._pending,
+                'size': self.size,
+                'served': self.served,
+                'fallbacks_served': self.fallbacks_served,
+                'expired': self.expired,
+                'failures': self.failures,
+            }
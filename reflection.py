@@ -0,0 +1,200 @@
+import hashlib
+import html
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import quote
+
+from lazy import LazyModule
+
+# Only a PDF export needs PIL
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+
+# A session's reflection is only its entries, [kind, value] pairs in the
+# order they happened, since with the default cookie backend everything in the
+# session travels with every response. The HTML and the digest naming the PDF
+# export of exactly this content are worked out from them when asked for.
+IMAGE_THUMBNAIL_WIDTH = 256
+
+
+def entries(sess):
+    # The session's reflection entries, without adding them to the session
+    doc = sess.get('reflection') or []
+    if isinstance(doc, dict):
+        # Written by an older version, with the HTML kept alongside
+        doc = doc['entries']
+    return doc
+
+
+def append(sess, kind, value):
+    # Assigned, not just mutated, so the session knows it changed
+    sess['reflection'] = entries(sess) + [[kind, value]]
+
+
+def digest(entries):
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def render_html(entries):
+    return ''.join(entry_html(kind, value) for kind, value in entries)
+
+
+def entry_html(kind, value):
+    if kind == 'image':
+        src = f'/proxy?url={quote(value, safe="")}&w={IMAGE_THUMBNAIL_WIDTH}'
+        return f'<img class="chosen" src="{html.escape(src)}" alt="The picture you chose">'
+    return f'<p class="{kind}">{html.escape(value)}</p>'
+
+
+# PDF pages are drawn with Pillow at 150 dpi, US letter
+PAGE_SIZE = (1275, 1650)
+PAGE_MARGIN = 120
+FONT_SIZE = 30
+TITLE_SIZE = 44
+LINE_SPACING = 1.4
+PDF_IMAGE_WIDTH = 600
+ENTRY_STYLES = {
+    'question': ('', (51, 51, 51)),
+    'answer': ('You: ', (0, 87, 231)),
+    'reappraisal': ('Something to think about: ', (0, 135, 68)),
+}
+
+
+def _wrap(text, font, width):
+    lines = []
+    for paragraph in text.splitlines() or ['']:
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def render_pdf(entries, path, fetch_image, title="My Mind Palette reflection"):
+    # Draws the entries onto pages and writes them to path as one PDF.
+    # fetch_image(url) returns the image bytes, or None if it's gone.
+    font = ImageFont.load_default(size=FONT_SIZE)
+    title_font = ImageFont.load_default(size=TITLE_SIZE)
+    line_height = int(FONT_SIZE * LINE_SPACING)
+    text_width = PAGE_SIZE[0] - 2 * PAGE_MARGIN
+    pages = []
+
+    def new_page():
+        page = Image.new('RGB', PAGE_SIZE, 'white')
+        pages.append(page)
+        return ImageDraw.Draw(page), PAGE_MARGIN
+
+    draw, y = new_page()
+    draw.text((PAGE_MARGIN, y), title, font=title_font, fill='black')
+    y += int(TITLE_SIZE * 2)
+    for kind, value in entries:
+        if kind == 'image':
+            picture = None
+            content = fetch_image(value)
+            if content is not None:
+                try:
+                    picture = Image.open(BytesIO(content)).convert('RGB')
+                    picture.thumbnail((PDF_IMAGE_WIDTH, PDF_IMAGE_WIDTH))
+                except (OSError, Image.DecompressionBombError):
+                    picture = None
+            if picture is None:
+                kind, value = 'question', "(The picture you chose is no longer available.)"
+            else:
+                if y + picture.height > PAGE_SIZE[1] - PAGE_MARGIN:
+                    draw, y = new_page()
+                pages[-1].paste(picture, (PAGE_MARGIN, y))
+                y += picture.height + line_height
+                continue
+        prefix, color = ENTRY_STYLES.get(kind, ENTRY_STYLES['question'])
+        for line in _wrap(prefix + value, font, text_width):
+            if y + line_height > PAGE_SIZE[1] - PAGE_MARGIN:
+                draw, y = new_page()
+            draw.text((PAGE_MARGIN, y), line, font=font, fill=color)
+            y += line_height
+        y += line_height // 2
+
+    # Written next to the final name and renamed, so a half-written file is
+    # never served
+    partial = f'{path}.{threading.get_ident()}.tmp'
+    pages[0].save(partial, format='PDF', save_all=True, append_images=pages[1:], resolution=150)
+    os.replace(partial, path)
+
+
+class PdfExports:
+    # PDFs of reflections, rendered on a small pool of background threads
+    # and kept on disk as <directory>/<digest>.pdf, so the same content is
+    # only rendered once and can be sent straight from the file. Files not
+    # touched for `ttl` seconds are removed.
+    def __init__(self, directory, render, workers=2, ttl=24 * 3600):
+        self.directory = directory
+        self.render = render
+        self.ttl = ttl
+        self._rendering = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reflection-pdf')
+        self._last_sweep = 0
+        self.rendered = 0
+        self.reused = 0
+        self.failed = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, f'{digest}.pdf')
+
+    def request(self, digest, entries):
+        # A future for the PDF's path, started unless the PDF is on disk or
+        # already being rendered
+        with self._lock:
+            future = self._rendering.get(digest)
+            if future is not None:
+                return future
+            path = self.path(digest)
+            if os.path.exists(path):
+                self.reused += 1
+                os.utime(path)
+                future = Future()
+                future.set_result(path)
+                return future
+            future = self._rendering[digest] = self._executor.submit(self._render, digest, list(entries))
+        return future
+
+    def _render(self, digest, entries):
+        try:
+            self.render(entries, self.path(digest))
+            self.rendered += 1
+            return self.path(digest)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._rendering.pop(digest, None)
+            self._sweep()
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.ttl / 24:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            rendering = len(self._rendering)
+        return {'rendering': rendering, 'rendered': self.rendered, 'reused': self.reused, 'failed': self.failed}
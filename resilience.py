@@ -0,0 +1,277 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class LatencyWindow:
+    # The last `size` latencies, kept sorted for percentiles
+    def __init__(self, size=200):
+        self._order = deque(maxlen=size)
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            if len(self._order) == self._order.maxlen:
+                del self._sorted[bisect.bisect_left(self._sorted, self._order[0])]
+            self._order.append(seconds)
+            bisect.insort(self._sorted, seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            if not self._sorted:
+                return None
+            return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * p))]
+
+    def __len__(self):
+        return len(self._order)
+
+
+class CircuitBreaker:
+    # After `failures` failed calls in a row the circuit opens and admit()
+    # raises CircuitOpen straight away, for the caller to answer with a
+    # canned fallback. After `cooldown` seconds one call is let through to
+    # probe; its success closes the circuit again. Guards of operations
+    # that fail together (a question streamed or not) can share one.
+    def __init__(self, name, failures=5, cooldown=30):
+        self.name = name
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def admit(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                    raise CircuitOpen(f"{self.name} is failing, not calling it for now")
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpen(f"{self.name} is failing, not calling it for now")
+                self._probing = True
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self._consecutive_failures = 0
+                self._state = CLOSED
+                return
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.opened += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        # The admitted call ended in a way that says nothing about upstream
+        with self._lock:
+            self._probing = False
+
+
+class Guard:
+    # Wraps the calls to one upstream operation:
+    #
+    # - Hedging: once a call has taken longer than the operation's recent
+    #   p95 (over the last `window` successful calls, after `min_samples` of
+    #   them), the same call is started a second time and whichever succeeds
+    #   first is used. The other is cancelled: coroutines really are; a
+    #   thread can't be stopped, so its result is handed to discard() once
+    #   it has one, for anything it holds open to be closed.
+    # - Circuit breaker (CircuitBreaker, made from `failures` and `cooldown`
+    #   unless `breaker` is given). Only errors is_failure(error) says are
+    #   upstream's count; any other leaves the breaker as it was.
+    #
+    # call(fn) runs a blocking fn, acall(fn) awaits the coroutine fn()
+    # returns. Both share the statistics and the breaker. call() runs fn on
+    # the caller's thread while there is nothing to hedge with; otherwise
+    # the first attempt runs on `attempt_executor` (`executor` if not
+    # given), so the caller can take whichever attempt answers first, and
+    # hedges run on `executor`. At most max_attempts first attempts and
+    # max_hedges hedges are out at a time, which the executors should have
+    # threads for: past that a call runs on the caller's thread unhedged,
+    # or a slow call isn't hedged, rather than queued behind others when
+    # the process is busiest.
+    def __init__(self, name, executor, hedge=True, window=200, min_samples=20, hedge_percentile=0.95,
+                 min_hedge_delay=0.1, failures=5, cooldown=30, max_hedges=8, is_failure=lambda error: True,
+                 attempt_executor=None, max_attempts=16, breaker=None, discard=lambda result: None):
+        self.name = name
+        self.is_failure = is_failure
+        self.discard = discard
+        self.hedge = hedge
+        self._hedge_slots = threading.BoundedSemaphore(max_hedges)
+        self._attempt_executor = attempt_executor or executor
+        self._attempt_slots = threading.BoundedSemaphore(max_attempts)
+        self.min_samples = min_samples
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.breaker = breaker or CircuitBreaker(name, failures, cooldown)
+        self.latencies = LatencyWindow(window)
+        self._executor = executor
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        return self.breaker.state
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, self.latencies.percentile(self.hedge_percentile))
+
+    def _admit(self):
+        try:
+            self.breaker.admit()
+        except CircuitOpen:
+            self.rejected += 1
+            raise
+        self.calls += 1
+
+    def _succeeded(self, seconds):
+        self.breaker.record(True)
+        self.latencies.add(seconds)
+
+    def _failed(self, error):
+        if self.is_failure(error):
+            self.failed += 1
+            self.breaker.record(False)
+        else:
+            self.breaker.release()
+
+    def _timed(self, fn):
+        started = time.monotonic()
+        return fn(), time.monotonic() - started
+
+    def _submit(self, executor, slots, context, fn):
+        # self._timed(fn) on executor, holding one of slots until it's done
+        future = executor.submit(context.run, self._timed, fn)
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def _discard_when_done(self, future):
+        # A losing attempt's result, whenever it comes, goes to discard()
+        def discard(future):
+            if not future.cancelled() and future.exception() is None:
+                self.discard(future.result()[0])
+        future.add_done_callback(discard)
+
+    def call(self, fn):
+        self._admit()
+        delay = self.hedge_delay()
+        if delay is None or not self._attempt_slots.acquire(blocking=False):
+            try:
+                result, seconds = self._timed(fn)
+            except Exception as e:
+                self._failed(e)
+                raise
+            self._succeeded(seconds)
+            return result
+
+        # The copied context carries the request's timings into the threads.
+        # The hedge delay counts from when the first attempt starts.
+        context = contextvars.copy_context()
+        attempts = [self._submit(self._attempt_executor, self._attempt_slots, context.copy(), fn)]
+        winner = None
+        try:
+            if not wait(attempts, timeout=delay).done and self._hedge_slots.acquire(blocking=False):
+                attempts.append(self._submit(self._executor, self._hedge_slots, context.copy(), fn))
+                self.hedged += 1
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        winner = attempt
+                        result, seconds = attempt.result()
+                        self._won(attempts, attempt, seconds)
+                        return result
+                    error = attempt.exception()
+            self._failed(error)
+            raise error
+        finally:
+            for attempt in attempts:
+                if attempt is not winner and not attempt.cancel():
+                    self._discard_when_done(attempt)
+
+    async def acall(self, fn):
+        self._admit()
+        attempts = [asyncio.ensure_future(self._atimed(fn))]
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if not done:
+                    attempts.append(asyncio.ensure_future(self._atimed(fn)))
+                    self.hedged += 1
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        result, seconds = attempt.result()
+                        self._won(attempts, attempt, seconds)
+                        return result
+                    error = attempt.exception()
+            self._failed(error)
+            raise error
+        except asyncio.CancelledError:
+            # The caller gave up, which says nothing about upstream
+            self.breaker.release()
+            raise
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+
+    async def _atimed(self, fn):
+        started = time.monotonic()
+        return await fn(), time.monotonic() - started
+
+    def _won(self, attempts, winner, seconds):
+        if winner is not attempts[0]:
+            self.hedge_wins += 1
+        self._succeeded(seconds)
+
+    def stats(self):
+        state = self.state
+        p50, p95 = self.latencies.percentile(0.5), self.latencies.percentile(0.95)
+        return {
+            'state': state,
+            'open': int(state == OPEN),
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'hedge_rate': self.hedged / self.calls if self.calls else 0,
+            'hedge_wins': self.hedge_wins,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'opened': self.breaker.opened,
+            'p50_seconds': p50 or 0,
+            'p95_seconds': p95 or 0,
+        }
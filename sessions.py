@@ -0,0 +1,215 @@
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+# Pick the backend with SESSION_BACKEND:
+#   'cookie' (the default) Flask's signed cookie holds the whole session, so
+#            any instance can serve any request: the only choice on Vercel
+#            or behind a load balancer. Sessions are limited to the ~4 KB a
+#            cookie takes and travel with every request.
+#   'memory' kept in this process, the cookie only carries a signed id.
+#            Small requests and no size limit, but one process only: with
+#            more workers or instances the id points at a store that isn't
+#            there and the session starts over.
+#   'sqlite' like 'memory', in a file shared by the workers on one machine.
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 3600))
+SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'mind_palette_sessions.sqlite3'))
+
+# Expired sessions are swept after this many saves
+SWEEP_EVERY = 200
+
+# Serialized sessions bigger than this are zlib-compressed
+COMPRESS_OVER = 512
+
+# History turns are stored as [role code, text] instead of [role name, text]
+ROLE_CODES = {'You': 'Y', 'Therapist': 'T'}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+
+def serialize(data):
+    data = dict(data)
+    if 'history' in data:
+        data['history'] = [[ROLE_CODES.get(who, who), text] for who, text in data['history']]
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    if len(raw) > COMPRESS_OVER:
+        return b'z' + zlib.compress(raw)
+    return b'j' + raw
+
+
+def deserialize(blob):
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b'z' else blob[1:]
+    data = json.loads(raw)
+    if 'history' in data:
+        data['history'] = [(ROLE_NAMES.get(who, who), text) for who, text in data['history']]
+    return data
+
+
+class MemoryStore:
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return deserialize(entry[1])
+
+    def save(self, sid, data):
+        blob = serialize(data)
+        with self._lock:
+            self._sessions[sid] = (time.time() + self.ttl, blob)
+            self._saves += 1
+            if self._saves % SWEEP_EVERY == 0:
+                self._sweep()
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def update(self, sid, fn):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            data = deserialize(entry[1]) if entry else {}
+            fn(data)
+            self._sessions[sid] = (time.time() + self.ttl, serialize(data))
+
+    def _sweep(self):
+        now = time.time()
+        for sid in [sid for sid, (expires, _) in self._sessions.items() if expires < now]:
+            del self._sessions[sid]
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'bytes': sum(len(blob) for _, blob in self._sessions.values())}
+
+
+class SqliteStore:
+    def __init__(self, path=SQLITE_PATH, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._saves = 0
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, expires REAL, data BLOB)')
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        return db
+
+    def load(self, sid):
+        row = self._connect().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND expires >= ?', (sid, time.time())
+        ).fetchone()
+        return deserialize(row[0]) if row else None
+
+    def save(self, sid, data):
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (sid, time.time() + self.ttl, serialize(data)))
+        self._saves += 1
+        if self._saves % SWEEP_EVERY == 0:
+            db.execute('DELETE FROM sessions WHERE expires < ?', (time.time(),))
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def update(self, sid, fn):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT data FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            data = deserialize(row[0]) if row else {}
+            fn(data)
+            db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (sid, time.time() + self.ttl, serialize(data)))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        row = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions').fetchone()
+        return {'sessions': row[0], 'bytes': row[1]}
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='session-id')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.load(sid)
+                if data is not None:
+                    return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(24), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            self.store.save(session.sid, dict(session))
+        if session.new:
+            response.vary.add('Cookie')
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def make_session_interface(backend):
+    if backend == 'memory':
+        return ServerSideSessionInterface(MemoryStore())
+    if backend == 'sqlite':
+        return ServerSideSessionInterface(SqliteStore())
+    if backend == 'cookie':
+        return None
+    raise ValueError(f"Unknown SESSION_BACKEND {backend!r}")
@@ -0,0 +1,135 @@
+import functools
+import os
+import threading
+
+# (connect, read) timeouts in seconds for every upstream call
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 60))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Retries on connection errors and on 429/5xx answers, waiting
+# backoff_factor * 2 ** (retry - 1) plus up to BACKOFF_JITTER random seconds
+# between attempts (or whatever Retry-After asks for)
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.5))
+BACKOFF_JITTER = float(os.environ.get('UPSTREAM_BACKOFF_JITTER', 0.5))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# OpenAI's 429s are left to the key pools in index, which move the call to
+# another API key or wait out the Retry-After
+OPENAI_HOST = 'api.openai.com'
+
+# Keep-alive connections kept per host. OpenAI gets its own, larger pool;
+# other hosts (the DALL-E image blobs behind /proxy) share the default one.
+# Override with e.g. UPSTREAM_POOL_SIZES="api.openai.com=64,example.com=4".
+DEFAULT_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 16))
+POOL_SIZES = {OPENAI_HOST: 32}
+for item in filter(None, os.environ.get('UPSTREAM_POOL_SIZES', '').split(',')):
+    host, _, size = item.partition('=')
+    POOL_SIZES[host.strip()] = int(size)
+
+
+@functools.cache
+def pooled_adapter_class():
+    # requests is only imported once a session is made
+    from requests.adapters import HTTPAdapter
+
+    class PooledAdapter(HTTPAdapter):
+        # openai closes its session every few minutes; the pooled connections
+        # are shared by the whole process, so only shutdown() really closes
+        # them.
+        def close(self):
+            pass
+
+        def shutdown(self):
+            super().close()
+
+    return PooledAdapter
+
+
+def make_retry(statuses=RETRY_STATUSES):
+    from urllib3.util.retry import Retry
+
+    return Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=0,
+        status=MAX_RETRIES,
+        status_forcelist=statuses,
+        allowed_methods=frozenset(['GET', 'POST']),
+        backoff_factor=BACKOFF_FACTOR,
+        backoff_jitter=BACKOFF_JITTER,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def make_session():
+    import requests
+
+    PooledAdapter = pooled_adapter_class()
+    new_session = requests.Session()
+    adapters = {'default': PooledAdapter(pool_connections=8, pool_maxsize=DEFAULT_POOL_SIZE,
+                                         max_retries=make_retry())}
+    new_session.mount('https://', adapters['default'])
+    new_session.mount('http://', adapters['default'])
+    for host, size in POOL_SIZES.items():
+        statuses = [status for status in RETRY_STATUSES if status != 429] if host == OPENAI_HOST else RETRY_STATUSES
+        adapters[host] = PooledAdapter(pool_connections=1, pool_maxsize=size, max_retries=make_retry(statuses))
+        new_session.mount(f'https://{host}/', adapters[host])
+    new_session.pooled_adapters = adapters
+    return new_session
+
+
+# The one session every upstream call goes through, upstream.session. It is
+# made on first use, so a cold start that serves no upstream call never
+# imports requests; hooks added before then are installed on it.
+_session = None
+_session_lock = threading.Lock()
+_response_hooks = []
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                new_session = make_session()
+                new_session.hooks['response'].extend(_response_hooks)
+                _session = new_session
+    return _session
+
+
+def __getattr__(name):
+    if name == 'session':
+        return get_session()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def add_response_hook(hook):
+    # hook(response, *args, **kwargs) for every response on the session
+    with _session_lock:
+        _response_hooks.append(hook)
+        if _session is not None:
+            _session.hooks['response'].append(hook)
+
+
+def pool_stats():
+    stats = {}
+    if _session is None:
+        return stats
+    for name, adapter in _session.pooled_adapters.items():
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats[f'{key.key_scheme}://{key.key_host}:{key.key_port}'] = {
+                'adapter': name,
+                'max_size': pool.pool.maxsize,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'in_use': pool.pool.maxsize - pool.pool.qsize(),
+                'idle': idle,
+            }
+    return stats